@@ -3,8 +3,12 @@ import logging
 from logging.handlers import RotatingFileHandler
 import traceback
 import uuid
+import time
+from functools import partial
+from pathlib import Path
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from telegram import Bot, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from telegram.error import TelegramError
 from telegram.ext import (
     Application, 
     CommandHandler, 
@@ -31,13 +35,25 @@ from config import (
     ERROR_MESSAGE_LINK,
     AI_CHAT,
     IN_APP_DONATE,
-    MAX_DAILY_CHAT_MESSAGE
+    MAX_DAILY_CHAT_MESSAGE,
+    STREAM_STORY,
+    STREAM_EDIT_INTERVAL,
+    SCENARIO_POOL_INTERVAL,
+    DEDUPE_TTL,
+    WEBHOOK_MODE,
+    CONCURRENT_UPDATES,
+    USER_QUEUE_LIMIT,
+    LEDGER_FLUSH_INTERVAL,
+    COVER_POLL_INTERVAL
 )
-from services import UserService, StoryService, AIStoryResponse, ChatService, user_unlock, asession_lock
-from models import User, Story, Section, StoryScenario
-from utils import replace_english_numbers_with_farsi, ChatCommand
-from exceptions import DailyStoryLimitExceededException, UserNotActiveException, DailyChatLimitExceededException
-from core import get_account_credit
+from services import UserService, StoryService, AIStoryResponse, ChatService, asession_lock, speculator,\
+    scenario_pool, story_context_cache, dedupe_store, UserOrderedUpdateProcessor, user_cache, usage_ledger,\
+    daily_stories, daily_chat_messages, cover_queue
+from models import User, Story, Section, StoryScenario, run_db, shutdown_db_executor
+from utils import replace_english_numbers_with_farsi, ChatCommand, PartialStoryResponse, calculate_token_price
+from exceptions import DailyStoryLimitExceededException, UserNotActiveException, DailyChatLimitExceededException,\
+    LLMBusyException, LLMUnavailableException
+from core import get_account_credit, llm_scheduler, retry_budget, circuit_breakers, hedger, http_sessions, image_store
 
 VERSION = '0.3.0-alpha'
 
@@ -76,9 +92,6 @@ END_STORY_TEXT_FORMAT = '''*{title}*
 # Create sponsor button
 sponsor_button = InlineKeyboardButton(SPONSOR_TEXT, url=SPONSOR_URL)
 
-# Keep track of answered messages to prevent duplicates
-answered_messages = set()
-
 class ButtonType(enum.Enum):
     """Enum to define types of button interactions."""
     OPTION = 'OPTION'  # For story option selection
@@ -96,6 +109,65 @@ start_new_story_keyboard = InlineKeyboardMarkup([
     [InlineKeyboardButton('عضویت در کانال', url=BOT_CHANNEL)]
 ])
 
+class StoryStreamMessage:
+    """
+    Shows a story section while it is being generated.
+
+    The title and story text are sent as soon as they start arriving and the
+    message is then edited in place, at most once per ``STREAM_EDIT_INTERVAL``
+    seconds. Partial text is sent without Markdown because half-written
+    entities would be rejected; ``finish`` applies the final formatting and
+    the option keyboard.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message: Message | None = None
+        self.last_text = ''
+        self.last_edit = 0.0
+        self.started_at = time.monotonic()
+
+    async def update(self, partial: PartialStoryResponse) -> None:
+        if not partial.title or not partial.story:
+            return None
+
+        now = time.monotonic()
+        if self.message and now - self.last_edit < STREAM_EDIT_INTERVAL:
+            return None
+
+        text = replace_english_numbers_with_farsi(f'{partial.title}\n\n{partial.story}')
+        if text == self.last_text:
+            return None
+
+        try:
+            if self.message is None:
+                self.message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+                logger.info(f'First story text visible to {self.chat_id} after {now - self.started_at:.2f}s')
+            else:
+                await self.message.edit_text(text)
+        except TelegramError as e:
+            logger.warning(f'Failed to update streamed story message: {e}')
+        self.last_text = text
+        self.last_edit = now
+
+    async def finish(self, text: str, reply_markup: InlineKeyboardMarkup) -> None:
+        text = replace_english_numbers_with_farsi(text)
+        if self.message:
+            try:
+                await self.message.edit_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+                return None
+            except TelegramError as e:
+                logger.warning(f'Failed to finish streamed story message, sending a new one: {e}')
+
+        await self.bot.send_message(
+            chat_id=self.chat_id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+
+
 # --- user commands ---
 
 def generate_story_rate_button(story: Story) -> InlineKeyboardMarkup:
@@ -159,12 +231,16 @@ async def send_story_section(update: Update, context: ContextTypes.DEFAULT_TYPE,
         action='typing'
     )
     previous_section = section
+    stream_message = StoryStreamMessage(context.bot, chat_id)
     
     # Generate next section based on choice
-    section, ai_response = await story_service.create_section(user, section.story, choice)
+    section, ai_response = await story_service.create_section(
+        user, section.story, choice,
+        on_progress=stream_message.update if STREAM_STORY else None
+    )
     #TODO if error delete section 
     # Mark previous section as used to prevent re-use
-    story_service.mark_section_as_used(previous_section)
+    await run_db(story_service.mark_section_as_used, previous_section)
     
     # Prepare message text and options based on whether story has ended
     if not ai_response.is_end:
@@ -184,12 +260,7 @@ async def send_story_section(update: Update, context: ContextTypes.DEFAULT_TYPE,
         text += '** نظرت درباره این داستان چی‌بود؟ 😃 از ۱ (خیلی بد) تا ۵ (عالی) بهم یه نمره بده! ⭐📖**'
 
     # Send the message with story text
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=replace_english_numbers_with_farsi(text),
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
-    )
+    await stream_message.finish(text, reply_markup)
     logger.info(f'Sent story section to user {update.effective_user.id}')
 
 
@@ -201,7 +272,16 @@ async def send_ai_generated_scenario(update: Update, context: ContextTypes.DEFAU
         update: Telegram update object
     """
     # Get unused AI scenarios
-    scenarios = await story_service.get_unused_scenarios()
+    scenarios = await story_service.get_unused_scenarios(update.effective_user.id)
+    if not scenarios:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text='دارم چند تا سناریوی تازه آماده می‌کنم، چند لحظه دیگه دوباره امتحان کن 😊',
+            reply_markup=start_new_story_keyboard
+        )
+        logger.warning(f'Scenario pool is empty, asked user {update.effective_user.id} to retry')
+        return None
+
     keyboard = []
     text = '*یک داستان رو انتخاب کن:*\n\n' 
     
@@ -290,7 +370,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = user_service.get_user(
+    user = await user_service.aget_user(
         update.effective_user.id,
         update.effective_user.username,
         update.effective_user.first_name,
@@ -405,7 +485,7 @@ async def new_story_command(update: Update,  context: ContextTypes.DEFAULT_TYPE,
     )
     
     if not user:
-        user = user_service.get_user(
+        user = await user_service.aget_user(
             update.effective_user.id,
             update.effective_user.username,
             update.effective_user.first_name,
@@ -427,7 +507,8 @@ async def new_story_command(update: Update,  context: ContextTypes.DEFAULT_TYPE,
     
     # Set up the scenario
     if scenario_text:
-        scenario = story_service.create_scenario(
+        scenario = await run_db(
+            story_service.create_scenario,
             story,
             text=scenario_text
         )
@@ -457,7 +538,11 @@ async def new_story_command(update: Update,  context: ContextTypes.DEFAULT_TYPE,
     )
     
     # Start the story with the chosen scenario
-    section, ai_response = await story_service.start_story(story, scenario, user)
+    stream_message = StoryStreamMessage(context.bot, update.effective_chat.id)
+    section, ai_response = await story_service.start_story(
+        story, scenario, user,
+        on_progress=stream_message.update if STREAM_STORY else None
+    )
     
     # Prepare reply markup with options
     reply_markup = generate_choice_button(section, ai_response)
@@ -470,12 +555,7 @@ async def new_story_command(update: Update,  context: ContextTypes.DEFAULT_TYPE,
     )
 
     # Send the first story section
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=replace_english_numbers_with_farsi(text),
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
-    )
+    await stream_message.finish(text, reply_markup)
     logger.info(f'New story started for user {update.effective_user.id}')
 
 
@@ -490,25 +570,62 @@ async def admin_charge_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 async def admin_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE, *args) -> None:
-    raise NotImplementedError
+    text = f'''Speculation hit rate: {speculator.hit_rate:.0%}
+Speculation hits: {speculator.metrics['hits']}
+Speculation misses: {speculator.metrics['misses']}
+Speculation cancelled branches: {speculator.metrics['cancelled']}
+Speculation wasted tokens: {speculator.metrics['wasted_tokens']} (cancelled branches estimated)
+Speculation wasted cost: {speculator.metrics['wasted_cost']:.4f}
+Story cache hit rate: {story_context_cache.hit_rate:.0%}
+Story cache entries: {len(story_context_cache.entries)}
+Story cache memory: {story_context_cache.size / 1024 / 1024:.1f} MB
+Story cache evictions: {story_context_cache.metrics['evictions']}
+User cache hit rate: {user_cache.hit_rate:.0%}
+User cache entries: {len(user_cache.entries)} ({user_cache.metrics['evictions']} evictions)
+Daily limit cache hit rate: {daily_stories.hit_rate:.0%} stories, {daily_chat_messages.hit_rate:.0%} chats
+Dedupe keys: {len(dedupe_store)} ({dedupe_store.metrics['duplicates']} duplicates ignored)
+Cover jobs: {await cover_queue.pending()} queued, {len(cover_queue.running)} running here
+Covers sent: {cover_queue.metrics['sent']} ({cover_queue.metrics['uploads_saved']} by file_id, {cover_queue.metrics['retried']} retried, {cover_queue.metrics['failed']} failed)
+Images stored: {image_store.metrics['stored']} ({image_store.metrics['deduplicated']} duplicates, {image_store.compression:.0%} of downloaded size, {image_store.average_transcode * 1000:.0f} ms per transcode)
+Images evicted: {image_store.metrics['evicted']} ({image_store.metrics['evicted_bytes'] / 1024 / 1024:.1f} MB)
+Updates in progress: {context.application.update_processor.current_concurrent_updates}
+Users with queued updates: {len(context.application.update_processor.users)}
+Dropped updates: {context.application.update_processor.metrics['dropped']}
+LLM in flight: {llm_scheduler.in_flight}
+LLM queue depth: {llm_scheduler.queue_depth} (max {llm_scheduler.metrics['max_queue_depth']})
+LLM queue wait: avg {llm_scheduler.average_wait:.2f}s, max {llm_scheduler.metrics['max_wait']:.2f}s
+LLM shed requests: {llm_scheduler.metrics['shed']}
+LLM retry budget: {retry_budget.tokens:.1f} (exhausted {retry_budget.exhausted} times)
+Circuit breakers: {', '.join(f'{name} {breaker.state} (opened {breaker.times_opened})' for name, breaker in circuit_breakers.items()) or '-'}
+LLM hedge rate: {hedger.hedge_rate:.0%} ({hedger.metrics['hedged']}/{hedger.metrics['requests']})
+LLM hedge win rate: {hedger.win_rate:.0%}
+LLM hedge extra cost: {calculate_token_price(hedger.metrics['extra_input_tokens'], hedger.metrics['extra_output_tokens']):.4f} ({hedger.metrics['cancelled']} cancelled)'''
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=text
+    )
 
 
 async def admin_user_action_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str, action: str, *args) -> None:
     if user_id.isnumeric():
-        user = user_service.get_user(int(user_id))
+        # banned users too, so they can be unbanned
+        user = await user_service.aget_user(int(user_id), only_active=False)
     else:
-        user = user_service.get_by_username(user_id)
+        user = await run_db(user_service.get_by_username, user_id)
     
     if action == 'chrge':
         amount = int(args[0])
-        user.charge += amount
-        user.save()
+        await run_db(User.add_charge, user.user_id, amount)
+        usage_ledger.record(user, 'charge', -amount)
+        user_cache.invalidate(user.user_id)
     elif action == 'ban':
         user.active = False
-        user.save()
+        await run_db(user.save)
+        user_cache.invalidate(user.user_id)
     elif action == 'unban':
         user.active = True
-        user.save()
+        await run_db(user.save)
+        user_cache.invalidate(user.user_id)
     elif action == 'info':
         report = await story_service.damage_report(user)
         text = f'''ID: {user.user_id}
@@ -601,15 +718,13 @@ async def new_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
         logger.info(f'Ignored non-private message')
         return None
     
-    # Prevent duplicate processing of messages
-    if update.message.id in answered_messages:
+    # Prevent duplicate processing of messages, message ids are only unique per chat
+    if await dedupe_store.seen('message', (update.message.chat_id << 32) | update.message.id):
         logger.debug(f'Ignored duplicate message {update.message.id}')
         return None
-    
-    answered_messages.add(update.message.id)
 
     if not user:
-        user = user_service.get_user(
+        user = await user_service.aget_user(
             update.effective_user.id,
             update.effective_user.username,
             update.effective_user.first_name,
@@ -659,15 +774,13 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE,
         context: Telegram context object
     """
     # Prevent duplicate processing
-    if update.update_id in answered_messages:
+    if await dedupe_store.seen('update', update.update_id):
         logger.debug(f'Ignored duplicate button click {update.update_id}')
         return None
     
-    answered_messages.add(update.update_id)
-    
     if not user:
         # Get user information
-        user = user_service.get_user(
+        user = await user_service.aget_user(
             update.effective_user.id,
             update.effective_user.username,
             update.effective_user.first_name,
@@ -708,7 +821,14 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE,
     elif btype == ButtonType.AI_SCENARIOS.value:
         # Handle AI scenario selection
         scenario_id = int(data[0])
-        scenario = story_service.get_scenario(scenario_id)
+        scenario = await run_db(story_service.claim_scenario, scenario_id, user.user_id)
+        if not scenario:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text='این سناریو دیگه در دسترس نیست، یکی از سناریوهای جدید رو انتخاب کن 😉',
+            )
+            await send_ai_generated_scenario(update, context)
+            return None
         await new_story_command(update, context, user, scenario_obj=scenario)
 
     elif btype == ButtonType.STORY_RATE.value:
@@ -727,13 +847,8 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE,
                     chat_id=update.effective_chat.id,
                     text='یکم صبر کن، دارم برای داستانت کاور درست می‌کنم. 😊',
                 )
-                image_path = await story_service.generate_story_cover(story, user)
-                with open(image_path, 'rb') as f:
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=f,
-                        caption='امیداروم از این داستان لذت برده باشی! 🤗'
-                    )
+                # drawn and sent in the background, see send_story_cover
+                await cover_queue.submit(story, update.effective_chat.id)
             await support_command(update, context)
 
     elif btype == ButtonType.START.value:
@@ -811,10 +926,6 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         update: Telegram update object
         context: Telegram context object with the error
     """
-    if update:
-        user = user_service.get_user(update.effective_user.id, only_active=False)
-        user_unlock(user)
-    
     if isinstance(context.error, DailyStoryLimitExceededException):
         await daily_limit_exception_message(update, context)
         return None
@@ -823,6 +934,16 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await daily_limit_exception_message(update, context, is_story=False)
         return None
 
+    elif isinstance(context.error, (LLMBusyException, LLMUnavailableException)):
+        try:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text='الان سرم خیلی شلوغه 😅 چند لحظه دیگه دوباره امتحان کن!'
+            )
+        except Exception as e:
+            logger.exception(e)
+        return None
+
     elif isinstance(context.error, UserNotActiveException):
         try:
             await context.bot.send_message(
@@ -877,19 +998,69 @@ async def on_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
 
 
-def main() -> None:
+async def scenario_pool_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await scenario_pool.top_up()
+
+
+async def dedupe_prune_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await dedupe_store.prune()
+
+
+async def usage_ledger_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await usage_ledger.flush()
+
+
+async def cover_queue_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await cover_queue.poll()
+
+
+async def send_story_cover(bot: Bot, chat_id: int, photo: str | Path) -> str:
     """
-    Main function to run the bot.
-    
-    Initializes the Telegram bot application, sets up handlers,
-    and starts polling for updates.
+    Send a story cover generated by the cover queue.
+
+    Args:
+        bot: The bot to send with
+        chat_id: The chat to send the cover to
+        photo: The image file, or the file_id of a cover uploaded before
+
+    Returns:
+        The file_id of the photo, to send it again without uploading
     """
-    logger.info('Starting Mystery Bot...')
+    message = await bot.send_photo(
+        chat_id=chat_id,
+        photo=photo,
+        caption='امیداروم از این داستان لذت برده باشی! 🤗'
+    )
+    return message.photo[-1].file_id
+
+
+async def on_shutdown(application: Application) -> None:
+    await cover_queue.stop()
+    await http_sessions.close()
+    image_store.shutdown()
+    await usage_ledger.flush()
+    shutdown_db_executor()
+
+
+def build_application(run_jobs: bool = True, with_updater: bool = True) -> Application:
+    """
+    Build the bot application with every handler registered.
+    
+    Args:
+        run_jobs: Whether to schedule the background jobs, only one process should
+        with_updater: Whether updates are fetched by polling; webhook workers get them from the server
     
+    Returns:
+        The application, not yet initialized
+    """
     # Initialize the application with Bale bot token
-    application = Application.builder().token(BOT_TOKEN)\
-                             .base_url(BASE_URL)\
-                             .build()
+    builder = Application.builder().token(BOT_TOKEN)\
+                         .base_url(BASE_URL)\
+                         .concurrent_updates(UserOrderedUpdateProcessor(CONCURRENT_UPDATES, USER_QUEUE_LIMIT))\
+                         .post_shutdown(on_shutdown)
+    if not with_updater:
+        builder = builder.updater(None)
+    application = builder.build()
     
     if not MAINTENANCE_MODE:
         # Set up command handlers
@@ -909,13 +1080,50 @@ def main() -> None:
         
         # Set up error handler
         application.add_error_handler(error_handler)
+
+        # Keep the AI scenario pool topped up in the background
+        if run_jobs and application.job_queue:
+            application.job_queue.run_repeating(scenario_pool_job, interval=SCENARIO_POOL_INTERVAL, first=0)
+            application.job_queue.run_repeating(dedupe_prune_job, interval=DEDUPE_TTL, first=DEDUPE_TTL)
+        elif run_jobs:
+            logger.warning('Job queue is not available, scenario pool is only refilled on demand')
+        
+        # every process buffers its own usage ledger rows
+        if application.job_queue:
+            application.job_queue.run_repeating(usage_ledger_job, interval=LEDGER_FLUSH_INTERVAL,
+                                                first=LEDGER_FLUSH_INTERVAL)
+
+        # every process works on the cover queue, jobs are claimed in the database
+        if STORY_COVER_GENERATION:
+            cover_queue.deliver = partial(send_story_cover, application.bot)
+            if application.job_queue:
+                application.job_queue.run_repeating(cover_queue_job, interval=COVER_POLL_INTERVAL, first=0)
     else:
         application.add_handler(MessageHandler(filters.TEXT, on_maintenance))
     
+    return application
+
+
+def main() -> None:
+    """
+    Main function to run the bot.
+    
+    Starts the webhook server and its workers in webhook mode,
+    otherwise polls for updates.
+    """
+    logger.info('Starting Mystery Bot...')
+    
+    if WEBHOOK_MODE:
+        from webhook import serve
+        serve(build_application)
+        return None
+    
+    application = build_application()
+    
     # Start the bot
     logger.info('Bot is running!')
     application.run_polling(drop_pending_updates=True)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,477 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+from models import User, Story, Section, db, run_db, create_tables
+
+logger = logging.getLogger('bench')
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def print_latencies(title: str, latencies: list[float], elapsed: float, unit: str = 'updates') -> None:
+    print(f'''
+    ⏱️ **{title}**
+    ---------------------------
+    {unit.capitalize() + ':':<11} {len(latencies):,}
+    Throughput: {len(latencies) / elapsed:,.1f} {unit}/s
+    p50:        {percentile(latencies, 50) * 1000:,.1f} ms
+    p90:        {percentile(latencies, 90) * 1000:,.1f} ms
+    p99:        {percentile(latencies, 99) * 1000:,.1f} ms
+    max:        {max(latencies) * 1000:,.1f} ms
+    mean:       {statistics.mean(latencies) * 1000:,.1f} ms
+    ---------------------------''')
+
+
+def use_temporary_sqlite() -> str:
+    '''Points the models at a throwaway SQLite file so benchmarks never touch real data.'''
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_'), 'bench.db')
+    db.init(path, pragmas={'journal_mode': 'wal'})
+    create_tables()
+    return path
+
+
+def simulated_update(user_id: int, query_latency: float) -> None:
+    '''
+    The database part of a typical button click: resolve the user, check the
+    daily limit and append a section. ``query_latency`` emulates a slow server.
+    '''
+    user, _ = User.get_or_create(user_id)
+    Story.select().where(Story.user == user).count()
+    story = Story.create(user=user)
+    Section.create(story=story, text='1', is_system=False)
+    time.sleep(query_latency)
+
+
+async def db_executor_benchmark(users: int = 200, updates: int = 5, query_latency: float = 0.005) -> None:
+    '''
+    Compares update latency when peewee runs on the event loop against the
+    database executor, with ``users`` users sending ``updates`` updates each.
+    '''
+    use_temporary_sqlite()
+
+    async def user_loop(user_id: int, offload: bool, latencies: list[float]) -> None:
+        for _ in range(updates):
+            # users do not click in lockstep; latency counts from the moment the
+            # update was due, so time spent waiting on a blocked loop is included
+            delay = random.uniform(0, 0.05)
+            arrival = time.perf_counter() + delay
+            await asyncio.sleep(delay)
+            if offload:
+                await run_db(simulated_update, user_id, query_latency)
+            else:
+                simulated_update(user_id, query_latency)
+            latencies.append(time.perf_counter() - arrival)
+
+    for title, offload in (('Event loop (inline peewee)', False), ('DB executor', True)):
+        latencies = []
+        started = time.perf_counter()
+        await asyncio.gather(*(user_loop(user_id, offload, latencies) for user_id in range(users)))
+        print_latencies(title, latencies, time.perf_counter() - started)
+
+
+def dedupe_benchmark(updates: int = 10_000_000, rate: float = 500, chats: int = 50_000) -> None:
+    '''
+    Memory held by the old answered_messages set against DedupeStore after
+    ``updates`` updates arriving at ``rate`` updates/s from ``chats`` chats.
+    '''
+    from services import DedupeStore
+    from config import DEDUPE_TTL, DEDUPE_MAX_KEYS
+
+    checkpoints = {updates * step // 10 for step in range(1, 11)}
+
+    def run(title: str, record: Callable[[int, int], None]) -> None:
+        tracemalloc.start()
+        started = time.perf_counter()
+        message_ids = [0] * chats
+        print(f'\n    {title}')
+        for update_id in range(1, updates + 1):
+            chat = random.randrange(chats)
+            message_ids[chat] += 1
+            record(update_id, (chat << 32) | message_ids[chat])
+            if update_id in checkpoints:
+                current, peak = tracemalloc.get_traced_memory()
+                print(f'    {update_id:>12,} updates: {current / 1024 / 1024:8.1f} MB (peak {peak / 1024 / 1024:.1f} MB)')
+        elapsed = time.perf_counter() - started
+        tracemalloc.stop()
+        print(f'    {updates / elapsed:,.0f} updates/s')
+
+    answered_messages = set()
+
+    def record_set(update_id: int, message_id: int) -> None:
+        answered_messages.add(message_id)
+        answered_messages.add(update_id)
+
+    run('set (answered_messages)', record_set)
+    answered_messages.clear()
+
+    now = 0.0
+    store = DedupeStore(DEDUPE_TTL, DEDUPE_MAX_KEYS, clock=lambda: now)
+
+    def record_store(update_id: int, message_id: int) -> None:
+        nonlocal now
+        now += 1 / rate
+        store.seen_sync('message', message_id)
+        store.seen_sync('update', update_id)
+
+    run(f'DedupeStore (ttl {DEDUPE_TTL}s, max {DEDUPE_MAX_KEYS:,} keys)', record_store)
+    print(f'    keys held: {len(store):,}, generation rotations: {store.metrics["rotations"]:,}')
+
+
+async def webhook_load_test(url: str, users: int = 100, updates: int = 10, concurrency: int = 50,
+                            text: str = '/help', secret: str = '', workers: int = 2) -> None:
+    '''
+    Posts synthetic message updates from ``users`` users to a running webhook
+    server (``python app.py`` with WEBHOOK_MODE=True) and reports how fast
+    they are accepted. Handlers really run, so point the bot at a test account.
+    '''
+    import aiohttp
+    from collections import Counter
+    from webhook import HashRing
+
+    ring = HashRing(workers)
+    print(f'    Users per worker: {dict(sorted(Counter(ring.node(user_id) for user_id in range(1, users + 1)).items()))}')
+
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    pending = asyncio.Queue()
+    update_id = int(time.time())
+    for message_id in range(1, updates + 1):
+        for user_id in range(1, users + 1):
+            update_id += 1
+            pending.put_nowait({
+                'update_id': update_id,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': f'Load {user_id}'},
+                    'text': text,
+                },
+            })
+
+    latencies = []
+    statuses = Counter()
+
+    async def sender(session: aiohttp.ClientSession) -> None:
+        while not pending.empty():
+            update = pending.get_nowait()
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses[response.status] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    print_latencies(f'Webhook ingestion ({url})', latencies, time.perf_counter() - started)
+    print(f'    Responses: {dict(statuses)}')
+
+
+async def update_processing_benchmark(users: int = 200, updates: int = 3, handler_latency: float = 0.5,
+                                      burst: float = 0.2) -> None:
+    '''
+    Compares handling ``updates`` quick successive updates from each of ``users``
+    users, with handlers taking ``handler_latency`` seconds (an LLM call):
+    sequential processing, concurrent processing where a busy user's update is
+    dropped (the old session lock), and per-user ordered concurrent processing.
+    '''
+    from telegram import Update
+    from telegram.ext import SimpleUpdateProcessor
+    from services import UserOrderedUpdateProcessor
+    from config import CONCURRENT_UPDATES, USER_QUEUE_LIMIT
+
+    def make_update(update_id: int, user_id: int, message_id: int) -> Update:
+        return Update.de_json({
+            'update_id': update_id,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+                'text': str(message_id),
+            },
+        }, None)
+
+    async def run(title: str, processor, drop_when_busy: bool) -> None:
+        busy = set()
+        handled = {}
+        latencies = []
+        dropped = 0
+
+        async def handle(update: Update, arrival: float) -> None:
+            nonlocal dropped
+            user_id = update.effective_user.id
+            if drop_when_busy and user_id in busy:
+                dropped += 1
+                return None
+            busy.add(user_id)
+            try:
+                await asyncio.sleep(handler_latency)
+            finally:
+                busy.discard(user_id)
+            handled.setdefault(user_id, []).append(update.message.message_id)
+            latencies.append(time.perf_counter() - arrival)
+
+        # updates arrive like the application's update fetcher hands them over
+        events = sorted(
+            (offset, user_id, message_id)
+            for user_id in range(users)
+            for message_id, offset in enumerate(sorted(random.uniform(0, burst) for _ in range(updates)))
+        )
+        started = time.perf_counter()
+        tasks = []
+        for update_id, (offset, user_id, message_id) in enumerate(events):
+            await asyncio.sleep(max(0.0, started + offset - time.perf_counter()))
+            update = make_update(update_id, user_id, message_id)
+            tasks.append(asyncio.create_task(
+                processor.process_update(update, handle(update, time.perf_counter()))
+            ))
+        await asyncio.gather(*tasks)
+
+        out_of_order = sum(messages != sorted(messages) for messages in handled.values())
+        print_latencies(title, latencies, time.perf_counter() - started)
+        print(f'    dropped: {dropped + getattr(processor, "metrics", {}).get("dropped", 0)}, '
+              f'users handled out of order: {out_of_order}')
+
+    await run('Sequential (concurrent_updates off)', SimpleUpdateProcessor(1), drop_when_busy=False)
+    await run('Concurrent, busy users dropped', SimpleUpdateProcessor(CONCURRENT_UPDATES), drop_when_busy=True)
+    await run('Concurrent, per-user ordered', UserOrderedUpdateProcessor(CONCURRENT_UPDATES, USER_QUEUE_LIMIT),
+              drop_when_busy=False)
+
+
+async def http_download_benchmark(downloads: int = 200, concurrency: int = 10, size: int = 1_500_000,
+                                  handshake: float = 0.05) -> None:
+    '''
+    Downloads ``downloads`` images of about ``size`` bytes from a local HTTP
+    stub, ``concurrency`` at a time: with a new session per image and the body
+    read into memory (as download_image used to), and with core.download_image
+    (shared keep-alive pool, streamed to disk). The stub answers the first
+    request of every connection ``handshake`` seconds late, standing in for
+    the DNS lookup and TLS handshake of a remote host.
+
+    The stub always serves the same PNG, which is stored (transcoded) in a
+    temporary image store before timing starts, so download_image only
+    deduplicates it: the comparison is about the HTTP side.
+    '''
+    import io
+    import aiofiles
+    import aiohttp
+    from aiohttp import web
+    from PIL import Image
+    import core
+    from images import ImageStore
+
+    # random pixels do not compress, so the PNG is about ``size`` bytes
+    side = int((size / 3) ** 0.5)
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(buffer, 'PNG')
+    body = buffer.getvalue()
+    connections = 0
+    seen = set()
+
+    async def image(request: web.Request) -> web.StreamResponse:
+        if request.transport not in seen:
+            seen.add(request.transport)
+            await asyncio.sleep(handshake)
+        return web.Response(body=body, content_type='image/png')
+
+    def on_connection(*_) -> None:
+        nonlocal connections
+        connections += 1
+
+    server = web.Server(lambda request: image(request))
+    loop = asyncio.get_running_loop()
+    listener = await loop.create_server(
+        lambda: (on_connection(), server())[1], '127.0.0.1', 0
+    )
+    url = f'http://127.0.0.1:{listener.sockets[0].getsockname()[1]}/image.png'
+    directory = tempfile.TemporaryDirectory(prefix='bench_images_')
+    # download_image looks both up when called
+    core.IMAGE_DIR = Path(directory.name)
+    core.image_store = ImageStore(core.IMAGE_DIR)
+
+    async def per_request_session(url: str) -> str:
+        filename = core.IMAGE_DIR / f'old_{time.perf_counter_ns()}.png'
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                async with aiofiles.open(filename, 'wb') as f:
+                    await f.write(await response.read())
+        os.remove(filename)
+        return str(filename)
+
+    try:
+        await core.download_image(url)
+        for title, download in (('New session per image, buffered', per_request_session),
+                                ('Pooled session, streamed (download_image)', core.download_image)):
+            connections = 0
+            semaphore = asyncio.Semaphore(concurrency)
+            latencies = []
+
+            async def one() -> None:
+                async with semaphore:
+                    started = time.perf_counter()
+                    await download(url)
+                    latencies.append(time.perf_counter() - started)
+
+            tracemalloc.start()
+            started = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(downloads)))
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print_latencies(title, latencies, elapsed, 'downloads')
+            print(f'    TCP connections: {connections}, peak Python memory: {peak / 1024 / 1024:.1f} MB')
+    finally:
+        await core.http_sessions.close()
+        core.image_store.shutdown()
+        listener.close()
+        await listener.wait_closed()
+        directory.cleanup()
+
+async def download_check() -> bool:
+    '''
+    Checks core.download_image against a local HTTP stub: a good image lands
+    in the image store, a non-200 answer returns None, and a truncated or
+    cancelled download raises without leaving its ``.part`` file behind.
+    Uses a temporary image store like http_download_benchmark.
+
+    Returns:
+        bool: Whether every check passed
+    '''
+    import io
+    from aiohttp import web
+    from PIL import Image
+    import core
+    from images import ImageStore
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), 'red').save(buffer, 'PNG')
+    body = buffer.getvalue()
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        if request.path == '/missing.png':
+            return web.Response(status=404)
+        response = web.StreamResponse(headers={'Content-Type': 'image/png', 'Content-Length': str(len(body))})
+        await response.prepare(request)
+        if request.path == '/image.png':
+            await response.write(body)
+            return response
+        await response.write(body[:len(body) // 2])
+        if request.path == '/slow.png':
+            await asyncio.sleep(5)
+        # the connection drops before the announced length is sent
+        request.transport.close()
+        return response
+
+    server = web.Server(handle)
+    listener = await asyncio.get_running_loop().create_server(server, '127.0.0.1', 0)
+    base = f'http://127.0.0.1:{listener.sockets[0].getsockname()[1]}'
+    directory = tempfile.TemporaryDirectory(prefix='download_check_')
+    # download_image looks both up when called
+    core.IMAGE_DIR = Path(directory.name)
+    core.image_store = ImageStore(core.IMAGE_DIR)
+    failures = []
+
+    def check(title: str, passed: bool) -> None:
+        print(f'{"ok" if passed else "FAILED"}: {title}')
+        if not passed:
+            failures.append(title)
+
+    def no_partial_files() -> bool:
+        return not list(core.IMAGE_DIR.rglob('*.part'))
+
+    try:
+        path = await core.download_image(f'{base}/image.png')
+        check('image is stored', path is not None and Path(path).is_file()
+              and Path(path).parent.parent == core.IMAGE_DIR)
+        check('no partial file after a download', no_partial_files())
+
+        check('non-200 answer returns None', await core.download_image(f'{base}/missing.png') is None)
+        check('no partial file after a non-200 answer', no_partial_files())
+
+        try:
+            await core.download_image(f'{base}/truncated.png')
+            check('truncated download raises', False)
+        except Exception:
+            check('truncated download raises', True)
+        check('no partial file after a truncated download', no_partial_files())
+
+        try:
+            await asyncio.wait_for(core.download_image(f'{base}/slow.png'), 0.5)
+            check('cancelled download raises', False)
+        except asyncio.TimeoutError:
+            check('cancelled download raises', True)
+        check('no partial file after a cancelled download', no_partial_files())
+    finally:
+        await core.http_sessions.close()
+        core.image_store.shutdown()
+        listener.close()
+        await listener.wait_closed()
+        directory.cleanup()
+    return not failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    db_parser = subparsers.add_parser('db_executor', help='Update latency with and without the DB executor')
+    db_parser.add_argument('--users', type=int, default=200, help='Number of concurrent simulated users')
+    db_parser.add_argument('--updates', type=int, default=5, help='Updates sent by each user')
+    db_parser.add_argument('--query-latency', type=float, default=0.005, help='Extra seconds spent per update in the database')
+
+    dedupe_parser = subparsers.add_parser('dedupe', help='Memory of update de-duplication')
+    dedupe_parser.add_argument('--updates', type=int, default=10_000_000, help='Number of simulated updates')
+    dedupe_parser.add_argument('--rate', type=float, default=500, help='Simulated updates per second')
+    dedupe_parser.add_argument('--chats', type=int, default=50_000, help='Number of simulated chats')
+
+    webhook_parser = subparsers.add_parser('webhook', help='Post synthetic updates to a running webhook server')
+    webhook_parser.add_argument('--url', type=str, default='http://localhost:8080/webhook', help='Webhook endpoint')
+    webhook_parser.add_argument('--users', type=int, default=100, help='Number of simulated users')
+    webhook_parser.add_argument('--updates', type=int, default=10, help='Updates sent by each user')
+    webhook_parser.add_argument('--concurrency', type=int, default=50, help='Requests in flight')
+    webhook_parser.add_argument('--text', type=str, default='/help', help='Text of the synthetic messages')
+    webhook_parser.add_argument('--secret', type=str, default='', help='WEBHOOK_SECRET of the server')
+    webhook_parser.add_argument('--workers', type=int, default=2, help='WEBHOOK_WORKERS of the server, to show the sharding')
+
+    updates_parser = subparsers.add_parser('updates', help='Update throughput of the update processors')
+    updates_parser.add_argument('--users', type=int, default=200, help='Number of simulated users')
+    updates_parser.add_argument('--updates', type=int, default=3, help='Updates sent by each user in a burst')
+    updates_parser.add_argument('--handler-latency', type=float, default=0.5, help='Seconds a handler takes')
+    updates_parser.add_argument('--burst', type=float, default=0.2, help='Seconds over which a user sends the burst')
+
+    http_parser = subparsers.add_parser('http', help='Image download with and without the pooled HTTP session')
+    http_parser.add_argument('--downloads', type=int, default=200, help='Number of images to download')
+    http_parser.add_argument('--concurrency', type=int, default=10, help='Downloads in flight')
+    http_parser.add_argument('--size', type=int, default=1_500_000, help='Bytes per image')
+    http_parser.add_argument('--handshake', type=float, default=0.05, help='Seconds added to the first request of a connection')
+
+    subparsers.add_parser('download_check', help='Check that download_image stores images and cleans up failed downloads')
+
+    args = parser.parse_args()
+
+    if args.command == 'db_executor':
+        asyncio.run(db_executor_benchmark(args.users, args.updates, args.query_latency))
+    elif args.command == 'dedupe':
+        dedupe_benchmark(args.updates, args.rate, args.chats)
+    elif args.command == 'updates':
+        asyncio.run(update_processing_benchmark(args.users, args.updates, args.handler_latency, args.burst))
+    elif args.command == 'http':
+        asyncio.run(http_download_benchmark(args.downloads, args.concurrency, args.size, args.handshake))
+    elif args.command == 'download_check':
+        if not asyncio.run(download_check()):
+            raise SystemExit(1)
+    elif args.command == 'webhook':
+        asyncio.run(webhook_load_test(args.url, args.users, args.updates, args.concurrency,
+                                      args.text, args.secret, args.workers))
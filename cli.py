@@ -1,10 +1,19 @@
 import argparse
+import asyncio
+import hashlib
 import logging
 import json
+import os
+import tempfile
+from collections import defaultdict
 from datetime import datetime, timedelta, date, time
+from pathlib import Path
+from time import perf_counter
 
 from telegram import Bot
-from models import User, Story, StoryScenario, Section, LLMHistory, Session, Chat, db
+from peewee import PostgresqlDatabase
+from playhouse.migrate import SchemaMigrator, migrate
+from models import User, Story, StoryScenario, Section, LLMHistory, Session, Chat, Prompt, CoverJob, MODELS, db, fn
 from config import BOT_TOKEN
 
 logger = logging.getLogger('CLI')
@@ -81,6 +90,87 @@ def daily_activity_report() -> None:
     report_lines.append('✅ Daily Activity Report Generated Successfully!')
     print('\n'.join(report_lines))
 
+def cost_report(days: int = 30, top: int = 10) -> None:
+    '''
+    LLM usage and cost per day, per model and per story over the last ``days`` days,
+    from the usage recorded on sections and chat messages when they were written.
+
+    Only the rows of AI responses carry a model, so the GROUP BY queries read the
+    (created_at, model) index instead of every section and message.
+    '''
+    start = datetime.combine(date.today() - timedelta(days=days - 1), time.min)
+    # day or model -> [requests, input tokens, output tokens, cached tokens, cost, latency sum, latency count]
+    by_day = defaultdict(lambda: [0, 0, 0, 0, 0.0, 0.0, 0])
+    by_model = defaultdict(lambda: [0, 0, 0, 0, 0.0, 0.0, 0])
+
+    for model in (Section, Chat):
+        totals = (
+            fn.COUNT(model.id),
+            fn.SUM(model.input_tokens),
+            fn.SUM(model.output_tokens),
+            fn.SUM(model.cached_tokens),
+            fn.SUM(model.cost),
+            fn.SUM(model.latency),
+            fn.COUNT(model.latency),
+        )
+        recorded = (model.created_at >= start) & (model.model.is_null(False))
+        day = fn.DATE(model.created_at).coerce(False)
+        for key, *values in model.select(day, *totals).where(recorded).group_by(day).tuples():
+            row = by_day[str(key)]
+            for index, value in enumerate(values):
+                row[index] += value or 0
+        for key, *values in model.select(model.model, *totals).where(recorded).group_by(model.model).tuples():
+            row = by_model[key]
+            for index, value in enumerate(values):
+                row[index] += value or 0
+
+    def average_latency(row: list) -> str:
+        return f'{row[5] / row[6]:.2f}s' if row[6] else '-'
+
+    report_lines = [
+        f'\n💰 **Cost Report (Last {days} Days)** 💰',
+        '----------------------------------------------------------------------------',
+        '| Date       | Requests | Input tokens | Output tokens | Cached   | Cost     |',
+        '|------------|----------|--------------|---------------|----------|----------|',
+    ]
+    for key in sorted(by_day):
+        requests, input_tokens, output_tokens, cached_tokens, cost, *_ = by_day[key]
+        report_lines.append(f'| {key:<10} | {requests:<8,} | {input_tokens:<12,} | {output_tokens:<13,} | {cached_tokens:<8,} | {cost:<8,.4f} |')
+
+    report_lines += [
+        '',
+        '| Model                          | Requests | Cost       | Cached % | Latency |',
+        '|--------------------------------|----------|------------|----------|---------|',
+    ]
+    for key, row in sorted(by_model.items(), key=lambda item: -item[1][4]):
+        requests, input_tokens, _, cached_tokens, cost, *_ = row
+        cached_share = cached_tokens / input_tokens if input_tokens else 0
+        report_lines.append(f'| {key:<30} | {requests:<8,} | {cost:<10,.4f} | {cached_share:<8.0%} | {average_latency(row):<7} |')
+
+    stories = (
+        Section
+        .select(Section.story, Story.user, fn.COUNT(Section.id), fn.SUM(Section.input_tokens + Section.output_tokens),
+                fn.SUM(Section.cost).alias('cost'))
+        .join(Story)
+        .where((Section.created_at >= start) & (Section.model.is_null(False)))
+        .group_by(Section.story, Story.user)
+        .order_by(fn.SUM(Section.cost).desc())
+        .limit(top)
+        .tuples()
+    )
+    report_lines += [
+        '',
+        f'Top {top} stories by cost:',
+        '| Story        | User         | Sections | Tokens       | Cost       |',
+        '|--------------|--------------|----------|--------------|------------|',
+    ]
+    for story_id, user_id, sections, tokens, cost in stories:
+        report_lines.append(f'| {story_id:<12} | {user_id:<12} | {sections:<8,} | {tokens or 0:<12,} | {cost or 0:<10,.4f} |')
+
+    report_lines.append('----------------------------------------------------------------------------')
+    report_lines.append('✅ Cost Report Generated Successfully!')
+    print('\n'.join(report_lines))
+
 def export_db_as_json(path: str = 'dump.json'):
     '''Backup important data to a JSON file.
 
@@ -106,8 +196,19 @@ def export_db_as_json(path: str = 'dump.json'):
                                 "id": int,
                                 "story": int,
                                 "text": str,
+                                "prompt_id": int | null,
                                 "is_system": bool,
                                 "used": bool,
+                                "title": str | null,
+                                "body": str | null,
+                                "options": {"1": str, ...} | null,
+                                "is_end": bool | null,
+                                "model": str | null,
+                                "input_tokens": int,
+                                "output_tokens": int,
+                                "cached_tokens": int,
+                                "latency": float | null,
+                                "cost": float,
                                 "created_at": str
                             }
                         ]
@@ -123,6 +224,15 @@ def export_db_as_json(path: str = 'dump.json'):
                 "is_system": bool,
                 "created_at": str
             }
+        ],
+        "prompts": [
+            {
+                "id": int,
+                "name": str,
+                "content_hash": str,
+                "text": str,
+                "created_at": str
+            }
         ]
     }
     '''
@@ -140,7 +250,8 @@ def export_db_as_json(path: str = 'dump.json'):
 
     final = {
         'users': data,
-        'story_scenarios': [story_scenario.as_dict for story_scenario in StoryScenario.select()]
+        'story_scenarios': [story_scenario.as_dict for story_scenario in StoryScenario.select()],
+        'prompts': [prompt.as_dict for prompt in Prompt.select()]
     }
     with open(path, '+w') as f:
         f.write(json.dumps(final, ensure_ascii=False, indent=4))
@@ -154,6 +265,18 @@ def import_db_from_json(path: str = 'dump.json'):
         data = json.loads(f.read())
     
     with db.atomic():
+        # Prompts, referenced by sections and chats (older dumps have none)
+        Prompt.bulk_create([
+            Prompt(
+                id=prompt['id'],
+                name=prompt['name'],
+                content_hash=prompt['content_hash'],
+                text=prompt['text'],
+                created_at=prompt['created_at']
+            )
+            for prompt in data.get('prompts', [])
+        ], batch_size=50)
+
         # Users
         for user in data['users']:
             u = User.create(
@@ -183,8 +306,19 @@ def import_db_from_json(path: str = 'dump.json'):
                         id=section['id'],
                         story=s.id,
                         text=section['text'],
+                        prompt=section.get('prompt_id'),
                         is_system=section['is_system'],
                         used=section['used'],
+                        title=section.get('title'),
+                        body=section.get('body'),
+                        options=section.get('options'),
+                        is_end=section.get('is_end'),
+                        model=section.get('model'),
+                        input_tokens=section.get('input_tokens', 0),
+                        output_tokens=section.get('output_tokens', 0),
+                        cached_tokens=section.get('cached_tokens', 0),
+                        latency=section.get('latency'),
+                        cost=section.get('cost', 0),
                         created_at=section['created_at']
                     ))
                 Section.bulk_create(section_data, batch_size=50)
@@ -207,9 +341,311 @@ def import_db_from_json(path: str = 'dump.json'):
         db.execute_sql("SELECT setval('story_id_seq', (SELECT MAX(id) FROM story))")
         db.execute_sql("SELECT setval('section_id_seq', (SELECT MAX(id) FROM section))")
         db.execute_sql("SELECT setval('storyscenario_id_seq', (SELECT MAX(id) FROM storyscenario))")
+        if data.get('prompts'):
+            db.execute_sql("SELECT setval('prompt_id_seq', (SELECT MAX(id) FROM prompt))")
 
         print('Data imported successfully')
 
+def migrate_schema() -> None:
+    '''
+    Bring an existing database up to date with models.py.
+
+    Missing tables, columns and indexes are created; running it again is a no-op.
+    Indexes on existing tables are built without blocking writes, see ``create_indexes``.
+    '''
+    migrator = SchemaMigrator.from_database(db)
+    new_columns = {
+        Story: [Story.cover_file_id, Story.text, Story.text_sections, Story.visual_prompt, Story.visual_prompt_chars,
+                Story.visual_prompt_input_tokens, Story.visual_prompt_output_tokens, Story.visual_prompt_cost],
+        StoryScenario: [StoryScenario.reserved_by, StoryScenario.reserved_until],
+        Section: [Section.prompt, Section.title, Section.body, Section.options, Section.is_end, Section.model, Section.input_tokens, Section.output_tokens,
+                  Section.cached_tokens, Section.latency, Section.cost],
+        Chat: [Chat.prompt, Chat.model, Chat.input_tokens, Chat.output_tokens,
+               Chat.cached_tokens, Chat.latency, Chat.cost],
+    }
+
+    with db.atomic():
+        # first, since new columns may reference them (Postgres checks the target of a foreign key);
+        # new tables are empty, their indexes are built right away
+        new_tables = [model for model in MODELS if not model.table_exists()]
+        db.create_tables(new_tables)
+        for model in new_tables:
+            print(f'Created table {model._meta.table_name}')
+        for model, fields in new_columns.items():
+            if model in new_tables:
+                continue
+            table = model._meta.table_name
+            existing = {column.name for column in db.get_columns(table)}
+            for field in fields:
+                if field.column_name not in existing:
+                    migrate(migrator.add_column(table, field.column_name, field))
+                    print(f'Added column {table}.{field.column_name}')
+
+    create_indexes()
+    print('Migration completed successfully')
+
+def create_indexes() -> None:
+    '''
+    Create the indexes declared in models.py that the database does not have yet.
+
+    On Postgres they are built CONCURRENTLY, outside of a transaction, so the bot
+    keeps writing to the table meanwhile. An interrupted concurrent build leaves
+    an invalid index behind; it is dropped and built again.
+    '''
+    postgres = isinstance(db, PostgresqlDatabase)
+    for model in MODELS:
+        table = model._meta.table_name
+        existing = {index.name for index in db.get_indexes(table)}
+        if postgres:
+            invalid = db.execute_sql(
+                'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                'WHERE i.indrelid = %s::regclass AND NOT i.indisvalid',
+                (table,)
+            )
+            for name, in invalid.fetchall():
+                db.execute_sql(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+                existing.discard(name)
+                print(f'Dropped invalid index {name}')
+
+        for index in model._meta.fields_to_index():
+            if index._name in existing:
+                continue
+            sql, params = model._schema._create_index(index).query()
+            if postgres:
+                sql = sql.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+            db.execute_sql(sql, params)
+            print(f'Created index {table}.{index._name}')
+
+def hot_queries() -> list[tuple[str, object, str]]:
+    '''
+    The queries run on every update, with the index each of them should use.
+
+    Only ids are selected so the check also runs before ``migrate`` adds new columns.
+    '''
+    since = datetime.now() - timedelta(hours=24)
+    return [
+        (
+            'daily story limit (services.story_times)',
+            Story.select(Story.created_at).where((Story.user == 0) & (Story.created_at > since))
+            .order_by(Story.created_at.desc()).limit(10),
+            'story_user_id_created_at',
+        ),
+        (
+            'daily chat limit (services.chat_message_times)',
+            Chat.select(Chat.created_at).where(
+                (Chat.user == 0) & (Chat.is_system == False) & (Chat.created_at > since)
+            ).order_by(Chat.created_at.desc()).limit(10),
+            'chat_user_id_created_at_messages',
+        ),
+        (
+            'active session (ChatService.__get_current_session)',
+            Session.select(Session.id).where((Session.user == 0) & (Session.active == True)).limit(1),
+            'session_user_id_active',
+        ),
+        (
+            'story history (Story.sections_histories)',
+            Section.select(Section.id).where(Section.story == 0).order_by(Section.created_at),
+            'section_story_id_created_at',
+        ),
+        (
+            'chat history (Session.chat_histories)',
+            Chat.select(Chat.id).where(Chat.session == 0).order_by(Chat.created_at),
+            'chat_session_id_created_at',
+        ),
+    ]
+
+def check_indexes() -> bool:
+    '''
+    EXPLAIN every hot query and check that its plan uses the expected index.
+
+    Returns:
+        bool: Whether every query uses its index
+    '''
+    postgres = isinstance(db, PostgresqlDatabase)
+    all_used = True
+    with db.atomic() as transaction:
+        if postgres:
+            # on small tables a scan is cheaper, the question is whether the index is usable
+            db.execute_sql('SET LOCAL enable_seqscan = off')
+        for title, query, index in hot_queries():
+            sql, params = query.sql()
+            explain = 'EXPLAIN ' if postgres else 'EXPLAIN QUERY PLAN '
+            plan = [str(row[-1]) for row in db.execute_sql(explain + sql, params).fetchall()]
+            used = any(index in line for line in plan)
+            all_used &= used
+            print(f'{"✅" if used else "❌"} {title}: {index}')
+            if not used:
+                print('\n'.join(f'    {line}' for line in plan))
+        transaction.rollback()
+
+    print('All hot queries use their indexes' if all_used else 'Run `python cli.py migrate` to create missing indexes')
+    return all_used
+
+def dedupe_prompts(batch_size: int = 1000) -> None:
+    '''
+    Move the system prompt copied into the first section of every story and
+    the first message of every chat session into the prompt registry.
+
+    Rows are processed in batches, each in its own transaction, so the command
+    can be interrupted and run again.
+    '''
+    # the Prompt table and prompt columns are needed below
+    migrate_schema()
+
+    for model, parent, name in ((Section, Section.story, 'story'), (Chat, Chat.session, 'chat')):
+        table = model._meta.table_name
+        first_ids = [row_id for row_id, in model.select(fn.MIN(model.id)).group_by(parent).tuples()]
+        moved = 0
+        for start in range(0, len(first_ids), batch_size):
+            batch = first_ids[start:start + batch_size]
+            with db.atomic():
+                rows = (
+                    model
+                    .select(model.id, model.text)
+                    .where(
+                        (model.id.in_(batch)) &
+                        (model.is_system == True) &
+                        (model.prompt.is_null()) &
+                        (model.text != '')
+                    )
+                )
+                ids_by_text = defaultdict(list)
+                for row in rows:
+                    ids_by_text[row.text].append(row.id)
+                for text, ids in ids_by_text.items():
+                    prompt = Prompt.get_or_create_version(name, text)
+                    model.update(text='', prompt=prompt).where(model.id.in_(ids)).execute()
+                    moved += len(ids)
+            print(f'{table}: {min(start + batch_size, len(first_ids)):,}/{len(first_ids):,} checked, {moved:,} moved')
+
+    print(f'Prompt versions: {Prompt.select().count():,}')
+    print('Prompts deduplicated successfully (run VACUUM to reclaim the space)')
+
+def backfill_sections(batch_size: int = 1000) -> None:
+    '''
+    Parse the raw JSON of AI sections written before their title, body, options
+    and end flag were stored, and store them.
+
+    Rows are processed in batches of ``batch_size`` ids, each in its own
+    transaction, so the command can be interrupted and run again. Sections
+    that do not parse are left as they are.
+    '''
+    # utils imports the bot stack, only this command needs it
+    from utils import story_parser
+
+    # the columns are needed below
+    migrate_schema()
+
+    last_id = 0
+    parsed = skipped = 0
+    while True:
+        with db.atomic():
+            rows = list(
+                Section
+                .select(Section.id, Section.text)
+                .where(
+                    (Section.id > last_id) &
+                    (Section.is_system == True) &
+                    (Section.prompt.is_null()) &
+                    (Section.body.is_null()) &
+                    (Section.text != '')
+                )
+                .order_by(Section.id)
+                .limit(batch_size)
+            )
+            if not rows:
+                break
+            for row in rows:
+                response = story_parser(row.text, record=False)
+                if response is None:
+                    skipped += 1
+                    continue
+                # the raw response stays as it is
+                fields = {name: value for name, value in response.section_fields.items() if name != 'text'}
+                Section.update(**fields).where(Section.id == row.id).execute()
+                parsed += 1
+        last_id = rows[-1].id
+        print(f'section: up to id {last_id:,}, {parsed:,} parsed, {skipped:,} skipped')
+
+    print('Sections backfilled successfully')
+
+def image_report(sample: int = 10, store_legacy: bool = False, evict: bool = False) -> None:
+    '''
+    Disk usage of the image store and how long images take to transcode.
+
+    Up to ``sample`` images are transcoded in the worker pool into a temporary
+    directory to time it, images saved before the store are preferred.
+    ``store_legacy`` moves those images into the store, ``evict`` deletes
+    sent covers until the store fits its quota.
+    '''
+    # the bot stack (LLM client, Pillow, service singletons) is only needed here
+    from core import image_store
+    from services import cover_images_in_use
+
+    def is_stored(path: Path) -> bool:
+        return len(path.stem) == 64 and path.parent.name == path.stem[:2]
+
+    async def time_transcodes(paths: list[Path]) -> tuple[list[tuple[int, int, float]], float]:
+        start = perf_counter()
+        with tempfile.TemporaryDirectory() as directory:
+            results = await asyncio.gather(*(
+                image_store.transcode(path, Path(directory) / f'{index}.tmp') for index, path in enumerate(paths)
+            ))
+        return results, perf_counter() - start
+
+    async def store(paths: list[Path]) -> None:
+        for path in paths:
+            digest = hashlib.sha256(path.read_bytes()).hexdigest()
+            stored = await image_store.put(path, digest)
+            CoverJob.update(image_path=str(stored)).where(CoverJob.image_path == str(path)).execute()
+
+    if evict:
+        image_store.evict(cover_images_in_use())
+
+    stored, legacy = [], []
+    for entry in image_store.files():
+        path = Path(entry.path)
+        (stored if is_stored(path) else legacy).append((path, entry.stat().st_size))
+    in_use = {os.path.abspath(path) for path in cover_images_in_use()}
+    used_size = sum(size for path, size in stored + legacy if os.path.abspath(path) in in_use)
+    total = sum(size for _, size in stored + legacy)
+    quota = f'{image_store.quota / 1024 / 1024:,.0f} MB' if image_store.quota else 'none'
+
+    report_lines = [
+        '\n🖼️ **Image Store Report** 🖼️',
+        '---------------------------',
+        f'Directory:          {image_store.root} ({image_store.image_format}, quality {image_store.quality})',
+        f'Stored images:      {len(stored):,} ({sum(size for _, size in stored) / 1024 / 1024:,.1f} MB)',
+        f'Legacy images:      {len(legacy):,} ({sum(size for _, size in legacy) / 1024 / 1024:,.1f} MB)',
+        f'Unsent covers:      {len(in_use):,} ({used_size / 1024 / 1024:,.1f} MB)',
+        f'Total:              {total / 1024 / 1024:,.1f} MB, quota {quota}',
+    ]
+    if evict:
+        report_lines.append(f'Evicted:            {image_store.metrics["evicted"]:,} ({image_store.metrics["evicted_bytes"] / 1024 / 1024:,.1f} MB)')
+
+    paths = [path for path, _ in legacy + stored][:sample]
+    try:
+        if paths:
+            results, seconds = asyncio.run(time_transcodes(paths))
+            timings = sorted(result[2] for result in results)
+            size_in = sum(result[0] for result in results)
+            size_out = sum(result[1] for result in results)
+            report_lines += [
+                '',
+                f'Transcoded {len(paths)} images with {image_store.workers} workers in {seconds:.2f}s:',
+                f'Per image:          p50 {timings[len(timings) // 2] * 1000:.0f} ms, max {timings[-1] * 1000:.0f} ms',
+                f'Size:               {size_in / len(paths) / 1024:,.0f} KB -> {size_out / len(paths) / 1024:,.0f} KB ({size_out / size_in:.0%})',
+            ]
+        if store_legacy and legacy:
+            asyncio.run(store([path for path, _ in legacy]))
+            report_lines.append(f'Moved {len(legacy):,} legacy images into the store')
+    finally:
+        image_store.shutdown()
+
+    report_lines.append('---------------------------')
+    report_lines.append('✅ Image Store Report Generated Successfully!')
+    print('\n'.join(report_lines))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -224,6 +660,24 @@ if __name__ == '__main__':
     import_parser = subparsers.add_parser('import', help='Import data from a JSON file')
     import_parser.add_argument('--path', type=str, default='dump.json', help='Path to the input file')
 
+    migrate_parser = subparsers.add_parser('migrate', help='Add missing tables, columns and indexes')
+    check_parser = subparsers.add_parser('check_indexes', help='Check with EXPLAIN that the hot queries use their indexes')
+
+    cost_parser = subparsers.add_parser('cost_report', help='LLM usage and cost per day, model and story')
+    cost_parser.add_argument('--days', type=int, default=30, help='Number of days to report on')
+    cost_parser.add_argument('--top', type=int, default=10, help='Number of most expensive stories to list')
+
+    backfill_parser = subparsers.add_parser('backfill_sections', help='Store the parsed fields of sections written before they were kept')
+    backfill_parser.add_argument('--batch-size', type=int, default=1000, help='Rows updated per transaction')
+
+    images_parser = subparsers.add_parser('images', help='Image store disk usage and transcode timing')
+    images_parser.add_argument('--sample', type=int, default=10, help='Number of images to transcode for timing')
+    images_parser.add_argument('--store-legacy', action='store_true', help='Move images saved before the store into it')
+    images_parser.add_argument('--evict', action='store_true', help='Delete sent covers until the store fits its quota')
+
+    dedupe_parser = subparsers.add_parser('dedupe_prompts', help='Move prompts copied into sections and chats into the prompt registry')
+    dedupe_parser.add_argument('--batch-size', type=int, default=1000, help='Rows updated per transaction')
+
     args = parser.parse_args()
 
     if args.command == 'dump':
@@ -234,3 +688,16 @@ if __name__ == '__main__':
         report()
     elif args.command == 'daily_report':
         daily_activity_report()
+    elif args.command == 'cost_report':
+        cost_report(args.days, args.top)
+    elif args.command == 'migrate':
+        migrate_schema()
+    elif args.command == 'check_indexes':
+        if not check_indexes():
+            raise SystemExit(1)
+    elif args.command == 'dedupe_prompts':
+        dedupe_prompts(args.batch_size)
+    elif args.command == 'backfill_sections':
+        backfill_sections(args.batch_size)
+    elif args.command == 'images':
+        image_report(args.sample, args.store_legacy, args.evict)
@@ -8,13 +8,123 @@ OPENAPI_SECONDARY_MODEL = config('OPENAPI_SECONDARY_MODEL', default='gpt-4o-mini
 # price of token per millions
 INPUT_TOKEN_PRICE = config('INPUT_TOKEN_PRICE', cast=float)
 OUTPUT_TOKEN_PRICE = config('OUTPUT_TOKEN_PRICE', cast=float)
+# input tokens served from the provider's prompt cache
+CACHED_INPUT_TOKEN_PRICE = config('CACHED_INPUT_TOKEN_PRICE', cast=float, default=INPUT_TOKEN_PRICE / 2)
+
+
+def model_price(value: str) -> tuple[str, tuple[float, float, float]]:
+    model, input_price, output_price, *cached_price = value.split(':')
+    input_price, output_price = float(input_price), float(output_price)
+    return model, (input_price, output_price, float(cached_price[0]) if cached_price else input_price / 2)
+
+
+# prices of models priced differently from the ones above, as model:input:output[:cached input],
+# e.g. gpt-4o:2.5:10:1.25,gpt-4o-mini:0.15:0.6:0.075
+MODEL_PRICES = config('MODEL_PRICES', cast=Csv(cast=model_price, post_process=dict), default='')
 MAX_RETRIES = config('MAX_RETRIES', cast=int, default=30)
+# requests to the provider running at the same time
+LLM_MAX_IN_FLIGHT = config('LLM_MAX_IN_FLIGHT', cast=int, default=16)
+# tokens per minute the bot may spend (0 for no limit)
+LLM_TOKENS_PER_MINUTE = config('LLM_TOKENS_PER_MINUTE', cast=int, default=0)
+# seconds a user request may wait for a slot before it is rejected as busy (0 to never reject)
+LLM_MAX_QUEUE_WAIT = config('LLM_MAX_QUEUE_WAIT', cast=float, default=20)
+# seconds a single LLM call may take including all of its retries
+LLM_REQUEST_DEADLINE = config('LLM_REQUEST_DEADLINE', cast=float, default=45)
+# exponential backoff between retries, in seconds
+LLM_BACKOFF_BASE = config('LLM_BACKOFF_BASE', cast=float, default=1)
+LLM_BACKOFF_MAX = config('LLM_BACKOFF_MAX', cast=float, default=20)
+# retries allowed per request across the process, and the most that can be saved up
+LLM_RETRY_BUDGET_RATIO = config('LLM_RETRY_BUDGET_RATIO', cast=float, default=0.2)
+LLM_RETRY_BUDGET_MAX = config('LLM_RETRY_BUDGET_MAX', cast=float, default=20)
+# a model is skipped for BREAKER_COOLDOWN seconds once this share of its recent calls failed
+BREAKER_ERROR_THRESHOLD = config('BREAKER_ERROR_THRESHOLD', cast=float, default=0.5)
+BREAKER_WINDOW = config('BREAKER_WINDOW', cast=int, default=20)
+BREAKER_MIN_REQUESTS = config('BREAKER_MIN_REQUESTS', cast=int, default=10)
+BREAKER_COOLDOWN = config('BREAKER_COOLDOWN', cast=float, default=30)
+# send a backup request when the primary model is slower than its usual p90 latency
+LLM_HEDGING = config('LLM_HEDGING', cast=bool, default=False)
+LLM_HEDGE_MODEL = config('LLM_HEDGE_MODEL', default=OPENAPI_SECONDARY_MODEL)
+LLM_HEDGE_PERCENTILE = config('LLM_HEDGE_PERCENTILE', cast=float, default=90)
+LLM_HEDGE_MIN_SAMPLES = config('LLM_HEDGE_MIN_SAMPLES', cast=int, default=20)
+# ask the provider for JSON output: text (prompt only), json_object or json_schema
+LLM_RESPONSE_FORMAT = config('LLM_RESPONSE_FORMAT', default='text')
+# stream story sections and edit the message in place while they are generated
+STREAM_STORY = config('STREAM_STORY', cast=bool, default=False)
+# minimum seconds between two edits of a streamed message
+STREAM_EDIT_INTERVAL = config('STREAM_EDIT_INTERVAL', cast=float, default=1.5)
+# generate the continuation of every option in the background before the user clicks
+SPECULATIVE_GENERATION = config('SPECULATIVE_GENERATION', cast=bool, default=False)
+# seconds a single speculative branch may take before it is cancelled
+SPECULATIVE_TIMEOUT = config('SPECULATIVE_TIMEOUT', cast=float, default=60)
+# seconds an unclaimed speculation is kept before it is discarded
+SPECULATIVE_TTL = config('SPECULATIVE_TTL', cast=float, default=600)
+SPECULATIVE_MAX_STORIES = config('SPECULATIVE_MAX_STORIES', cast=int, default=50)
+# unused AI scenarios kept ready; a refill starts when the pool drops below the low watermark
+SCENARIO_POOL_TARGET = config('SCENARIO_POOL_TARGET', cast=int, default=40)
+SCENARIO_POOL_LOW_WATERMARK = config('SCENARIO_POOL_LOW_WATERMARK', cast=int, default=12)
+# seconds between two background checks of the scenario pool
+SCENARIO_POOL_INTERVAL = config('SCENARIO_POOL_INTERVAL', cast=float, default=60)
+# seconds scenarios offered to a user stay hidden from other users
+SCENARIO_RESERVATION_TTL = config('SCENARIO_RESERVATION_TTL', cast=float, default=600)
+# memory budget (bytes) of the in-memory cache of active stories' LLM messages
+STORY_CACHE_MAX_BYTES = config('STORY_CACHE_MAX_BYTES', cast=int, default=64 * 1024 * 1024)
+# users kept in memory, and seconds before a cached user is read again
+USER_CACHE_MAX_ENTRIES = config('USER_CACHE_MAX_ENTRIES', cast=int, default=10_000)
+USER_CACHE_TTL = config('USER_CACHE_TTL', cast=float, default=60)
+# users whose daily story and chat counts are kept in memory, and seconds before they are counted again
+DAILY_LIMIT_CACHE_MAX_ENTRIES = config('DAILY_LIMIT_CACHE_MAX_ENTRIES', cast=int, default=10_000)
+DAILY_LIMIT_CACHE_TTL = config('DAILY_LIMIT_CACHE_TTL', cast=float, default=300)
+# usage ledger rows are written in batches of this size, or every LEDGER_FLUSH_INTERVAL seconds
+LEDGER_BATCH_SIZE = config('LEDGER_BATCH_SIZE', cast=int, default=50)
+LEDGER_FLUSH_INTERVAL = config('LEDGER_FLUSH_INTERVAL', cast=float, default=10)
+# remember handled updates for DEDUPE_TTL seconds, at most DEDUPE_MAX_KEYS per namespace
+DEDUPE_TTL = config('DEDUPE_TTL', cast=int, default=3600)
+DEDUPE_MAX_KEYS = config('DEDUPE_MAX_KEYS', cast=int, default=100_000)
+# memory, or database to share de-duplication between bot processes
+DEDUPE_BACKEND = config('DEDUPE_BACKEND', default='memory')
+# where user locks live: memory, database, or postgres (advisory locks)
+LOCK_BACKEND = config('LOCK_BACKEND', default='memory')
+# seconds after which a user lock is considered abandoned
+LOCK_TTL = config('LOCK_TTL', cast=int, default=300)
+# most users locked at once in memory
+LOCK_MAX_ENTRIES = config('LOCK_MAX_ENTRIES', cast=int, default=10_000)
+# updates handled at once (across users), and updates a single user may have waiting
+CONCURRENT_UPDATES = config('CONCURRENT_UPDATES', cast=int, default=256)
+USER_QUEUE_LIMIT = config('USER_QUEUE_LIMIT', cast=int, default=5)
 
 STORY_COVER_GENERATION = config('STORY_COVER_GENERATION', cast=bool, default=False)
 IMAGE_MODEL = config('IMAGE_MODEL', default='dall-e-3')
 IMAGE_SIZE = config('IMAGE_SIZE', default='1024x1024')
 IMAGE_PRICE = config('IMAGE_PRICE', cast=float, default=0.04)
 IMAGE_DIR = config('IMAGE_DIR', default='images')
+# images are stored re-encoded as JPEG, WEBP or PNG, scaled down to IMAGE_MAX_SIZE pixels (0 keeps the size)
+IMAGE_FORMAT = config('IMAGE_FORMAT', default='JPEG')
+IMAGE_QUALITY = config('IMAGE_QUALITY', cast=int, default=85)
+IMAGE_MAX_SIZE = config('IMAGE_MAX_SIZE', cast=int, default=0)
+# processes re-encoding images
+IMAGE_WORKERS = config('IMAGE_WORKERS', cast=int, default=1)
+# megabytes of images kept on disk (0 for no limit), sent covers are deleted least recently used first
+IMAGE_STORE_QUOTA_MB = config('IMAGE_STORE_QUOTA_MB', cast=int, default=1024)
+# covers generated at once by each bot process, and attempts before a cover job is given up
+COVER_CONCURRENCY = config('COVER_CONCURRENCY', cast=int, default=2)
+COVER_MAX_ATTEMPTS = config('COVER_MAX_ATTEMPTS', cast=int, default=3)
+# seconds between checks for due cover jobs, and seconds a worker may hold a job before another takes it over
+COVER_POLL_INTERVAL = config('COVER_POLL_INTERVAL', cast=float, default=30)
+COVER_JOB_LEASE = config('COVER_JOB_LEASE', cast=float, default=600)
+# the cover prompt is updated in the background once this many characters were added to a story,
+# 0 generates it once when the story ends
+VISUAL_PROMPT_UPDATE_CHARS = config('VISUAL_PROMPT_UPDATE_CHARS', cast=int, default=0)
+
+# outgoing HTTP (LLM API and image downloads): pooled connections in total and per host,
+# and seconds an idle connection is kept open for reuse
+HTTP_POOL_SIZE = config('HTTP_POOL_SIZE', cast=int, default=100)
+HTTP_POOL_SIZE_PER_HOST = config('HTTP_POOL_SIZE_PER_HOST', cast=int, default=32)
+HTTP_KEEPALIVE = config('HTTP_KEEPALIVE', cast=float, default=30)
+# seconds to connect, and seconds an image download may take
+HTTP_CONNECT_TIMEOUT = config('HTTP_CONNECT_TIMEOUT', cast=float, default=10)
+HTTP_DOWNLOAD_TIMEOUT = config('HTTP_DOWNLOAD_TIMEOUT', cast=float, default=120)
+# proxy for outgoing HTTP, e.g. socks5://127.0.0.1:2080 (empty for none)
+HTTP_PROXY = config('HTTP_PROXY', default='')
 
 BOT_TOKEN = config('BOT_TOKEN')
 
@@ -42,6 +152,8 @@ if not USE_SQLITE:
     PGDB_NAME = config('PGDB_NAME')
     PGDB_HOST = config('PGDB_HOST', default='localhost')
     PGDB_PORT = config('PGDB_PORT', cast=int, default=5432)
+# number of worker threads (and therefore database connections) used for queries
+DB_POOL_SIZE = config('DB_POOL_SIZE', cast=int, default=8)
 
 USE_BALE_MESSENGER = config('USE_BALE_MESSENGER', cast=bool, default=False)
 if USE_BALE_MESSENGER:
@@ -49,6 +161,21 @@ if USE_BALE_MESSENGER:
 else:
     BASE_URL = 'https://api.telegram.org/bot'
 
+# receive updates through a local webhook server instead of polling
+WEBHOOK_MODE = config('WEBHOOK_MODE', cast=bool, default=False)
+# public URL the server is reachable at; the webhook is registered on start when set
+WEBHOOK_URL = config('WEBHOOK_URL', default='')
+WEBHOOK_LISTEN = config('WEBHOOK_LISTEN', default='0.0.0.0')
+WEBHOOK_PORT = config('WEBHOOK_PORT', cast=int, default=8080)
+WEBHOOK_PATH = config('WEBHOOK_PATH', default='/webhook')
+WEBHOOK_SECRET = config('WEBHOOK_SECRET', default='')
+# worker processes; each user's updates always go to the same worker
+WEBHOOK_WORKERS = config('WEBHOOK_WORKERS', cast=int, default=2)
+# updates buffered per worker before the server answers 503
+WEBHOOK_QUEUE_SIZE = config('WEBHOOK_QUEUE_SIZE', cast=int, default=1000)
+# seconds a worker gets to finish its queued updates on shutdown
+WEBHOOK_DRAIN_TIMEOUT = config('WEBHOOK_DRAIN_TIMEOUT', cast=int, default=60)
+
 BOT_CHANNEL = config('BOT_CHANNEL')
 
 ERROR_MESSAGE_LINK = config('ERROR_MESSAGE_LINK')
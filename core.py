@@ -1,12 +1,24 @@
 import logging
 import asyncio
+import contextvars
+import enum
+import hashlib
+import heapq
+import itertools
 import json
+import random
 import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Awaitable, Callable, TypeVar
 
 import aiohttp
 import aiofiles
-from openai import AsyncOpenAI, RateLimitError, InternalServerError
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError, InternalServerError, APITimeoutError,\
+    APIConnectionError, APIStatusError, NOT_GIVEN
 from aiohttp_socks import ProxyConnector
 
 from config import (
@@ -17,87 +29,712 @@ from config import (
     IMAGE_MODEL,
     IMAGE_SIZE,
     IMAGE_DIR,
+    IMAGE_FORMAT,
+    IMAGE_QUALITY,
+    IMAGE_MAX_SIZE,
+    IMAGE_WORKERS,
+    IMAGE_STORE_QUOTA_MB,
     OPENAPI_SECONDARY_MODEL,
     LOG_LLM,
+    LLM_MAX_IN_FLIGHT,
+    LLM_TOKENS_PER_MINUTE,
+    LLM_MAX_QUEUE_WAIT,
+    LLM_REQUEST_DEADLINE,
+    LLM_BACKOFF_BASE,
+    LLM_BACKOFF_MAX,
+    LLM_RETRY_BUDGET_RATIO,
+    LLM_RETRY_BUDGET_MAX,
+    BREAKER_ERROR_THRESHOLD,
+    BREAKER_WINDOW,
+    BREAKER_MIN_REQUESTS,
+    BREAKER_COOLDOWN,
+    LLM_HEDGING,
+    LLM_HEDGE_MODEL,
+    LLM_HEDGE_PERCENTILE,
+    LLM_HEDGE_MIN_SAMPLES,
+    HTTP_POOL_SIZE,
+    HTTP_POOL_SIZE_PER_HOST,
+    HTTP_KEEPALIVE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_DOWNLOAD_TIMEOUT,
+    HTTP_PROXY,
 )
-from models import LLMHistory
-from prompts import SUMMARIZE_STORY_FOR_IMAGE
+from models import LLMHistory, run_db
+from images import ImageStore
+from prompts import SUMMARIZE_STORY_FOR_IMAGE, UPDATE_STORY_IMAGE_PROMPT
 from exceptions import *
 
 logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+
+@dataclass(frozen=True)
+class LLMUsage:
+    '''What a completion cost, as reported by the provider.'''
+    model: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0  # input tokens served from the provider's prompt cache
+    latency: float | None = None  # seconds from sending the request to the last token
+
+
+# usage of the last completion received in the current context
+response_usage: contextvars.ContextVar[LLMUsage] = contextvars.ContextVar(
+    'response_usage', default=LLMUsage(OPENAPI_MODEL)
+)
+
 IMAGE_DIR = Path(IMAGE_DIR)
 IMAGE_DIR.mkdir(parents=True, exist_ok=True)
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+image_store = ImageStore(IMAGE_DIR, IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_MAX_SIZE,
+                         IMAGE_STORE_QUOTA_MB * 1024 * 1024, IMAGE_WORKERS)
  
+# retries are handled by with_retries, not by the client
 openai_client = AsyncOpenAI(
     base_url=OPENAPI_URL,
-    api_key=OPENAPI_API_KEY
+    api_key=OPENAPI_API_KEY,
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_SIZE,
+            max_keepalive_connections=HTTP_POOL_SIZE,
+            keepalive_expiry=HTTP_KEEPALIVE
+        ),
+        proxy=HTTP_PROXY or None
+    )
 )
 
 
+class HTTPSessions:
+    '''
+    aiohttp sessions shared for the lifetime of the application, so requests
+    reuse pooled keep-alive connections instead of connecting (DNS, TCP, TLS)
+    every time.
+
+    Sessions are created on first use, in the running event loop, and closed
+    together with the LLM client by ``close`` at shutdown.
+    '''
+
+    def __init__(self, limit: int, limit_per_host: int, keepalive: float, connect_timeout: float,
+                 total_timeout: float, proxy: str = ''):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, sock_connect=connect_timeout)
+        self.proxy = proxy
+        self.sessions: dict[str, aiohttp.ClientSession] = {}
+
+    def get(self, name: str = 'default') -> aiohttp.ClientSession:
+        '''
+        The session called ``name``, created if needed.
+
+        Args:
+            name (str): Separate names get separate connection pools.
+
+        Returns:
+            aiohttp.ClientSession: The session, not to be closed by the caller
+        '''
+        session = self.sessions.get(name)
+        if session is None or session.closed:
+            pool = {'limit': self.limit, 'limit_per_host': self.limit_per_host, 'keepalive_timeout': self.keepalive}
+            if self.proxy:
+                connector = ProxyConnector.from_url(self.proxy, **pool)
+            else:
+                connector = aiohttp.TCPConnector(ttl_dns_cache=300, **pool)
+            session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self.sessions[name] = session
+        return session
+
+    async def close(self) -> None:
+        sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            await session.close()
+        await openai_client.close()
+
+
+http_sessions = HTTPSessions(HTTP_POOL_SIZE, HTTP_POOL_SIZE_PER_HOST, HTTP_KEEPALIVE,
+                             HTTP_CONNECT_TIMEOUT, HTTP_DOWNLOAD_TIMEOUT, HTTP_PROXY)
+
+
+class LLMPriority(enum.IntEnum):
+    '''Lower values are served first.'''
+    PAID = 0  # users who have charged their account
+    STORY = 1  # story continuations
+    CHAT = 2
+    BACKGROUND = 3  # scenario refills, covers, speculation
+
+
+class LLMScheduler:
+    '''
+    Limits how many provider requests run at once and how many tokens are
+    spent per minute, serving waiting requests by priority.
+    
+    User-facing requests that wait longer than ``LLM_MAX_QUEUE_WAIT`` are
+    shed with ``LLMBusyException``; background requests always wait.
+    '''
+    
+    def __init__(self, max_in_flight: int, tokens_per_minute: int = 0):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        self.queue: list[tuple[int, int, asyncio.Future]] = []
+        self.usage: deque[tuple[float, int]] = deque()
+        self._order = itertools.count()
+        self._wakeup: asyncio.TimerHandle | None = None
+        self.metrics = {
+            'requests': 0,
+            'shed': 0,
+            'max_queue_depth': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0,
+        }
+    
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, waiter in self.queue if not waiter.done())
+    
+    @property
+    def average_wait(self) -> float:
+        return self.metrics['total_wait'] / self.metrics['requests'] if self.metrics['requests'] else 0.0
+    
+    def _tokens_in_window(self, now: float) -> int:
+        while self.usage and now - self.usage[0][0] > 60:
+            self.usage.popleft()
+        return sum(tokens for _, tokens in self.usage)
+    
+    def _wake(self) -> None:
+        self._wakeup = None
+        self._dispatch()
+    
+    def _dispatch(self) -> None:
+        while self.queue and self.in_flight < self.max_in_flight:
+            now = time.monotonic()
+            if self.tokens_per_minute and self._tokens_in_window(now) >= self.tokens_per_minute:
+                # try again once the oldest usage leaves the one minute window
+                if self._wakeup is None:
+                    delay = 60 - (now - self.usage[0][0])
+                    self._wakeup = asyncio.get_running_loop().call_later(delay, self._wake)
+                return None
+            
+            _, _, waiter = heapq.heappop(self.queue)
+            if waiter.done():
+                # gave up waiting
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+    
+    async def acquire(self, priority: LLMPriority) -> None:
+        '''
+        Wait for a request slot.
+        
+        Args:
+            priority (LLMPriority): Priority of the request
+            
+        Raises:
+            LLMBusyException: If a user-facing request waited longer than ``LLM_MAX_QUEUE_WAIT``
+        '''
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self._order), waiter))
+        self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], self.queue_depth)
+        started = time.monotonic()
+        self._dispatch()
+        
+        max_wait = LLM_MAX_QUEUE_WAIT if LLM_MAX_QUEUE_WAIT and priority < LLMPriority.BACKGROUND else None
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted while we gave up
+                self.release()
+            else:
+                waiter.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.metrics['shed'] += 1
+                logger.warning(f'LLM queue wait exceeded {LLM_MAX_QUEUE_WAIT}s, shedding request')
+                raise LLMBusyException('LLM queue is full, try again later')
+            raise
+        
+        waited = time.monotonic() - started
+        self.metrics['requests'] += 1
+        self.metrics['total_wait'] += waited
+        self.metrics['max_wait'] = max(self.metrics['max_wait'], waited)
+    
+    def release(self, tokens: int = 0) -> None:
+        '''
+        Give a slot back, recording the tokens the request used.
+        
+        Args:
+            tokens (int): Input and output tokens spent by the request
+        '''
+        self.in_flight -= 1
+        if tokens:
+            self.usage.append((time.monotonic(), tokens))
+        self._dispatch()
+
+
+llm_scheduler = LLMScheduler(LLM_MAX_IN_FLIGHT, LLM_TOKENS_PER_MINUTE)
+
+
+class RetryBudget:
+    '''
+    Process-wide limit on retries: every request earns ``ratio`` retries, up
+    to ``maximum`` saved, so during an outage retries stay a small fraction
+    of traffic instead of multiplying it.
+    '''
+    
+    def __init__(self, ratio: float, maximum: float):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = maximum
+        self.exhausted = 0
+    
+    def deposit(self) -> None:
+        self.tokens = min(self.maximum, self.tokens + self.ratio)
+    
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            self.exhausted += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    '''
+    Stops sending requests to a model whose recent error rate is too high.
+    
+    Once open, the breaker rejects requests for ``BREAKER_COOLDOWN`` seconds
+    and then lets a single trial request through: success closes it, failure
+    opens it again.
+    '''
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.results: deque[bool] = deque(maxlen=BREAKER_WINDOW)
+        self.opened_at: float | None = None
+        self.trial_in_flight = False
+        self.times_opened = 0
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.trial_in_flight else 'open'
+    
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if not self.trial_in_flight and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            self.trial_in_flight = True
+            return True
+        return False
+    
+    def abandon(self) -> None:
+        '''Forget a request that ended without an answer, freeing the trial slot if it held it.'''
+        if self.opened_at is not None:
+            self.trial_in_flight = False
+    
+    def _open(self) -> None:
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        logger.warning(f'Circuit breaker for {self.name} opened')
+    
+    def record(self, success: bool) -> None:
+        if self.opened_at is not None:
+            if not self.trial_in_flight:
+                # a request that started before the breaker opened
+                return None
+            self.trial_in_flight = False
+            if success:
+                self.opened_at = None
+                self.results.clear()
+                logger.info(f'Circuit breaker for {self.name} closed')
+            else:
+                self._open()
+            return None
+        
+        self.results.append(success)
+        failures = self.results.count(False)
+        if len(self.results) >= BREAKER_MIN_REQUESTS and failures / len(self.results) >= BREAKER_ERROR_THRESHOLD:
+            self._open()
+
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    '''Seconds to wait before retrying: the provider's Retry-After if sent, else full-jitter exponential backoff.'''
+    response = getattr(error, 'response', None)
+    headers = response.headers if response is not None else {}
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+retry_budget = RetryBudget(LLM_RETRY_BUDGET_RATIO, LLM_RETRY_BUDGET_MAX)
+circuit_breakers: dict[str, CircuitBreaker] = {}
+
+
+def circuit_breaker(model: str) -> CircuitBreaker:
+    if model not in circuit_breakers:
+        circuit_breakers[model] = CircuitBreaker(model)
+    return circuit_breakers[model]
+
+
+class Hedger:
+    '''
+    Tracks recent primary model latencies and decides when to hedge.
+    
+    A request still running after the ``LLM_HEDGE_PERCENTILE`` latency of the
+    last calls gets a backup request to ``LLM_HEDGE_MODEL``; the first valid
+    answer wins and the other request is cancelled.
+    '''
+    
+    def __init__(self, percentile: float, min_samples: int, window: int = 200):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.metrics = {
+            'requests': 0,
+            'hedged': 0,
+            'backup_wins': 0,
+            'cancelled': 0,
+            'extra_input_tokens': 0,
+            'extra_output_tokens': 0,
+        }
+    
+    @property
+    def hedge_rate(self) -> float:
+        return self.metrics['hedged'] / self.metrics['requests'] if self.metrics['requests'] else 0.0
+    
+    @property
+    def win_rate(self) -> float:
+        return self.metrics['backup_wins'] / self.metrics['hedged'] if self.metrics['hedged'] else 0.0
+    
+    def threshold(self) -> float | None:
+        '''Seconds after which a request is hedged, or None while there are too few samples.'''
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+    
+    def record(self, latency: float) -> None:
+        self.latencies.append(latency)
+    
+    def waste(self, task: asyncio.Task) -> None:
+        '''Cancel a losing request, or count its tokens as hedging cost if it already finished.'''
+        if not task.done():
+            task.cancel()
+            self.metrics['cancelled'] += 1
+        elif not task.cancelled() and task.exception() is None:
+            _, input_tokens, output_tokens = task.result()
+            self.metrics['extra_input_tokens'] += input_tokens
+            self.metrics['extra_output_tokens'] += output_tokens
+
+
+hedger = Hedger(LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES)
+
+
 async def download_image(image_url: str) -> str:
-    """Downloads an image from the given URL and saves it to a file in the specified directory.
+    """Downloads an image from the given URL and saves it in the image store.
 
     Args:
         image_url (str): The URL of the image to download.
 
     Returns:
-        str: The path to the downloaded image file.
+        str: The path to the stored image file.
     """
-    filename = IMAGE_DIR / f'ai_image_{int(time.time() * 1000)}.png'
+    # concurrent downloads within the same millisecond must not share a file
+    partial = IMAGE_DIR / f'ai_image_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}.part'
+    digest = hashlib.sha256()
     logger.info(f'Downloading image from: {image_url}')
-    # connector = ProxyConnector.from_url('socks5://127.0.0.1:2080') connector=connector
-    async with aiohttp.ClientSession() as session:
-        async with session.get(image_url) as response:
-            if response.status == 200:
-                async with aiofiles.open(filename, 'wb') as f:
-                    await f.write(await response.read())
-                logger.info(f'Image saved at: {filename}')
-                return str(filename)
-            else:
-                logger.error(f'Failed to download image: {response.status}')
+    async with http_sessions.get('images').get(image_url) as response:
+        if response.status != 200:
+            logger.error(f'Failed to download image: {response.status}')
+            return None
+        # a truncated body, a timeout or cancellation must not leave the partial file behind
+        downloaded = False
+        try:
+            async with aiofiles.open(partial, 'wb') as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    await f.write(chunk)
+            downloaded = True
+        finally:
+            if not downloaded:
+                partial.unlink(missing_ok=True)
+    filename = await image_store.put(partial, digest.hexdigest())
+    logger.info(f'Image saved at: {filename}')
+    return str(filename)
+
+async def with_retries(request: Callable[[str, float], Awaitable[T]], models: tuple[str, ...]) -> T:
+    """
+    Runs a provider request, retrying transient failures.
 
-async def llm(messages: list[dict], use_secondary_model: bool = False) -> tuple[str, int, int]:
+    Retries back off exponentially with jitter (or as long as the provider's
+    Retry-After asks), stop at the request deadline and draw from the
+    process-wide retry budget. Models whose circuit breaker is open are
+    skipped in favour of the next one in ``models``.
+
+    Args:
+        request (Callable[[str, float], Awaitable[T]]): Called with the model and the seconds left until the deadline.
+        models (tuple[str, ...]): Models to use, in order of preference.
+
+    Returns:
+        T: Whatever ``request`` returns.
+
+    Raises:
+        LLMUnavailableException: If every model's breaker is open, the deadline passed or the retry budget is spent.
+        NotEnoughCreditsException: If the maximum number of retries is reached without a successful response.
+    """
+    deadline = time.monotonic() + LLM_REQUEST_DEADLINE
+    retry_budget.deposit()
+    for attempt in range(MAX_RETRIES):
+        model = next((model for model in models if circuit_breaker(model).allow()), None)
+        if model is None:
+            raise LLMUnavailableException(f'Circuit open for {", ".join(models)}')
+
+        try:
+            logger.info(f'Attempt {attempt + 1} of {MAX_RETRIES} to get response from OpenAI API.[{model}]')
+            result = await request(model, deadline - time.monotonic())
+            circuit_breaker(model).record(True)
+            return result
+        except (RateLimitError, InternalServerError, APITimeoutError, APIConnectionError) as e:
+            circuit_breaker(model).record(False)
+            if attempt == MAX_RETRIES - 1:
+                break
+            delay = backoff_delay(attempt, e)
+            if time.monotonic() + delay >= deadline:
+                raise LLMUnavailableException(f'Deadline of {LLM_REQUEST_DEADLINE}s reached') from e
+            if not retry_budget.withdraw():
+                raise LLMUnavailableException('Retry budget exhausted') from e
+            logger.warning(f'{type(e).__name__} from {model}. Retrying after {delay:.1f} seconds...')
+            await asyncio.sleep(delay)
+        except APIStatusError:
+            # the provider answered, the request itself was bad
+            circuit_breaker(model).record(True)
+            raise
+        except (asyncio.CancelledError, Exception):
+            # says nothing about the provider: a request shed by the scheduler (LLMBusyException),
+            # an error in a callback such as on_content, or cancellation
+            circuit_breaker(model).abandon()
+            raise
+
+    logger.error('Max retries reached. Failed to get response.')
+    raise NotEnoughCreditsException('Max retries reached. Failed to get response.')
+
+def cached_tokens(usage) -> int:
+    '''Prompt tokens the provider served from its cache; not every provider reports them.'''
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return getattr(details, 'cached_tokens', None) or 0
+
+def chat_models(use_secondary_model: bool) -> tuple[str, ...]:
+    if use_secondary_model:
+        return (OPENAPI_SECONDARY_MODEL,)
+    return (OPENAPI_MODEL, OPENAPI_SECONDARY_MODEL)
+
+async def complete(messages: list[dict], models: tuple[str, ...], priority: LLMPriority,
+                   response_format: dict | None = None) -> tuple[str, int, int]:
+    """
+    Requests a chat completion from the first available model in ``models``.
+
+    Args:
+        messages (list[dict]): A list of message dictionaries to send to the OpenAI API.
+        models (tuple[str, ...]): Models to use, in order of preference.
+        priority (LLMPriority): Scheduling priority of the request.
+        response_format (dict | None): Structured output format requested from the provider.
+
+    Returns:
+        tuple[str, int, int]: A tuple containing the content of the response, the number of input tokens used, and the number of output tokens used.
+    """
+    async def request(model: str, timeout: float) -> tuple[str, int, int]:
+        await llm_scheduler.acquire(priority)
+        response = None
+        started = time.monotonic()
+        try:
+            response = await openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                response_format=response_format or NOT_GIVEN,
+                timeout=timeout
+            )
+        finally:
+            llm_scheduler.release(response.usage.total_tokens if response and response.usage else 0)
+        logger.info(f'Successfully received response from OpenAI API.[{model}]')
+        input_tokens = response.usage.prompt_tokens
+        output_tokens = response.usage.completion_tokens
+        response_usage.set(LLMUsage(
+            model, input_tokens, output_tokens, cached_tokens(response.usage), time.monotonic() - started
+        ))
+        content = response.choices[0].message.content.strip()
+        if LOG_LLM:
+            await run_db(
+                LLMHistory.create,
+                model=model,
+                prompt=json.dumps(messages, ensure_ascii=False),
+                response=content
+            )
+        return content, input_tokens, output_tokens
+
+    return await with_retries(request, models)
+
+async def hedged_complete(messages: list[dict], priority: LLMPriority,
+                          validate: Callable[[str], bool] | None,
+                          response_format: dict | None = None) -> tuple[str, int, int]:
+    """
+    Requests a chat completion from the primary model, sending a backup request to
+    ``LLM_HEDGE_MODEL`` if the primary is slower than usual.
+
+    Args:
+        messages (list[dict]): A list of message dictionaries to send to the OpenAI API.
+        priority (LLMPriority): Scheduling priority of the request.
+        validate (Callable[[str], bool] | None): Whether a response is usable; an invalid
+            response only wins if the other request fails too.
+        response_format (dict | None): Structured output format requested from the provider.
+
+    Returns:
+        tuple[str, int, int]: A tuple containing the content of the response, the number of input tokens used, and the number of output tokens used.
+    """
+    hedger.metrics['requests'] += 1
+    started = time.monotonic()
+    # each request runs in its own context, see won() below
+    contexts: dict[asyncio.Task, contextvars.Context] = {}
+
+    def start(models: tuple[str, ...]) -> asyncio.Task:
+        context = contextvars.copy_context()
+        task = asyncio.create_task(complete(messages, models, priority, response_format), context=context)
+        contexts[task] = context
+        return task
+
+    def won(task: asyncio.Task) -> tuple[str, int, int]:
+        result = task.result()
+        response_usage.set(contexts[task][response_usage])
+        return result
+
+    primary = start(chat_models(False))
+
+    def record_latency(task: asyncio.Task) -> None:
+        # a cancelled primary took at least this long, which still counts
+        if task.cancelled() or task.exception() is None:
+            hedger.record(time.monotonic() - started)
+
+    primary.add_done_callback(record_latency)
+
+    try:
+        threshold = hedger.threshold()
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+        if done:
+            return won(primary)
+
+        logger.info(f'Primary model slower than {threshold:.1f}s, hedging with {LLM_HEDGE_MODEL}')
+        hedger.metrics['hedged'] += 1
+        backup = start((LLM_HEDGE_MODEL,))
+        pending = {primary, backup}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and (validate is None or validate(task.result()[0])):
+                    if task is backup:
+                        hedger.metrics['backup_wins'] += 1
+                    hedger.waste(backup if task is primary else primary)
+                    return won(task)
+        # neither answer is usable, hand one back for the caller's own retries
+        loser, winner = (backup, primary) if primary.exception() is None else (primary, backup)
+        if winner.exception() is None:
+            hedger.waste(loser)
+        return won(winner)
+    finally:
+        # also when the caller is cancelled while waiting: no request may keep its scheduler slot
+        for task in contexts:
+            if not task.done():
+                task.cancel()
+
+async def llm(messages: list[dict], use_secondary_model: bool = False,
+              priority: LLMPriority = LLMPriority.STORY,
+              validate: Callable[[str], bool] | None = None,
+              response_format: dict | None = None) -> tuple[str, int, int]:
     """
     Sends a list of messages to the OpenAI API and returns the response content along with token usage.
 
+    User-facing requests are hedged when ``LLM_HEDGING`` is on, see ``hedged_complete``.
+
     Args:
         messages (list[dict]): A list of message dictionaries to send to the OpenAI API.
+        use_secondary_model (bool): Whether to use the secondary model.
+        priority (LLMPriority): Scheduling priority of the request.
+        validate (Callable[[str], bool] | None): Whether a response is usable, used to pick a hedged response.
+        response_format (dict | None): Structured output format requested from the provider.
 
     Returns:
         tuple[str, int, int]: A tuple containing the content of the response, the number of input tokens used, and the number of output tokens used.
 
     Raises:
-        Exception: If the maximum number of retries is reached without a successful response.
+        Exception: If the request cannot be completed, see ``with_retries``.
     """
-    for attempt in range(MAX_RETRIES):
-        model = OPENAPI_MODEL if not use_secondary_model else OPENAPI_SECONDARY_MODEL
+    if LLM_HEDGING and not use_secondary_model and priority != LLMPriority.BACKGROUND:
+        return await hedged_complete(messages, priority, validate, response_format)
+    return await complete(messages, chat_models(use_secondary_model), priority, response_format)
+
+async def llm_stream(messages: list[dict], on_content: Callable[[str], Awaitable[None]],
+                     use_secondary_model: bool = False,
+                     priority: LLMPriority = LLMPriority.STORY,
+                     response_format: dict | None = None) -> tuple[str, int, int]:
+    """
+    Streams a completion from the OpenAI API, reporting the text received so far as it arrives.
+
+    Args:
+        messages (list[dict]): A list of message dictionaries to send to the OpenAI API.
+        on_content (Callable[[str], Awaitable[None]]): Awaited with the accumulated content after every chunk.
+            A retried attempt starts again from an empty string.
+        use_secondary_model (bool): Whether to use the secondary model.
+        priority (LLMPriority): Scheduling priority of the request.
+        response_format (dict | None): Structured output format requested from the provider.
+
+    Returns:
+        tuple[str, int, int]: A tuple containing the content of the response, the number of input tokens used, and the number of output tokens used.
+
+    Raises:
+        Exception: If the request cannot be completed, see ``with_retries``.
+    """
+    async def request(model: str, timeout: float) -> tuple[str, int, int]:
+        await llm_scheduler.acquire(priority)
+        content = ''
+        input_tokens = output_tokens = cached = 0
+        started = time.monotonic()
         try:
-            logger.info(f'Attempt {attempt + 1} of {MAX_RETRIES} to get response from OpenAI API.')
-            response = await openai_client.chat.completions.create(
+            stream = await openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                response_format=response_format or NOT_GIVEN,
+                stream=True,
+                stream_options={'include_usage': True},
+                timeout=timeout
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    input_tokens = chunk.usage.prompt_tokens
+                    output_tokens = chunk.usage.completion_tokens
+                    cached = cached_tokens(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content += chunk.choices[0].delta.content
+                    await on_content(content)
+        finally:
+            llm_scheduler.release(input_tokens + output_tokens)
+        logger.info(f'Successfully streamed response from OpenAI API.[{model}]')
+        response_usage.set(LLMUsage(model, input_tokens, output_tokens, cached, time.monotonic() - started))
+        content = content.strip()
+        if LOG_LLM:
+            await run_db(
+                LLMHistory.create,
                 model=model,
-                messages=messages
+                prompt=json.dumps(messages, ensure_ascii=False),
+                response=content
             )
-            logger.info(f'Successfully received response from OpenAI API.[{model}]')
-            input_tokens = response.usage.prompt_tokens
-            output_tokens = response.usage.completion_tokens
-            content = response.choices[0].message.content.strip()
-            if LOG_LLM:
-                LLMHistory.create(
-                    model=OPENAPI_MODEL,
-                    prompt=json.dumps(messages, ensure_ascii=False),
-                    response=content
-                )
-            return content, input_tokens, output_tokens
-        #TODO or balance is too low
-        except RateLimitError:
-            logger.warning('Rate limit exceeded. Retrying after 2 seconds...')
-            await asyncio.sleep(2)
-        except InternalServerError:
-            logger.warning('Internal server error. Retrying after 2 seconds...')
-            await asyncio.sleep(2)
-    
-    logger.error('Max retries reached. Failed to translate text.')
-    raise NotEnoughCreditsException('Max retries reached. Failed to translate text.')
+        return content, input_tokens, output_tokens
+
+    return await with_retries(request, chat_models(use_secondary_model))
 
 async def generate_image_from_prompt(prompt: str) -> str:
     """
@@ -110,46 +747,47 @@ async def generate_image_from_prompt(prompt: str) -> str:
         str: The path to the generated image file.
 
     Raises:
-        Exception: If the maximum number of retries is reached without a successful response.
+        Exception: If the image cannot be generated, see ``with_retries``.
     """
     if len(prompt) > 1000:
         prompt = prompt[:1000]
 
-    for attempt in range(MAX_RETRIES):
+    async def request(model: str, timeout: float) -> str:
+        await llm_scheduler.acquire(LLMPriority.BACKGROUND)
         try:
-            logger.info(f'Attempt {attempt + 1} of {MAX_RETRIES} to get image from OpenAI API.')
             response = await openai_client.images.generate(
-                model=IMAGE_MODEL,
+                model=model,
                 prompt=prompt,
                 n=1,
-                size=IMAGE_SIZE
+                size=IMAGE_SIZE,
+                timeout=timeout
+            )
+        finally:
+            llm_scheduler.release()
+        logger.info('Successfully received response from OpenAI API.')
+        image_url = response.data[0].url
+        if LOG_LLM:
+            await run_db(
+                LLMHistory.create,
+                model=model,
+                prompt=prompt,
+                response=image_url
             )
-            logger.info('Successfully received response from OpenAI API.')
-            image_url = response.data[0].url
-            if LOG_LLM:
-                LLMHistory.create(
-                    model=IMAGE_MODEL,
-                    prompt=prompt,
-                    response=image_url
-                )
-            image_path = await download_image(image_url)
-            return image_path
-        except RateLimitError:
-            logger.warning('Rate limit exceeded. Retrying after 2 seconds...')
-            await asyncio.sleep(2)
-        except InternalServerError:
-            logger.warning('Internal server error. Retrying after 2 seconds...')
-            await asyncio.sleep(2)
-
-    logger.error('Max retries reached. Failed to generate image.')
-    raise FailedToGenerateImageException('Max retries reached. Failed to generate image.')
-
-async def generate_story_visual_prompt(story_text: str) -> tuple[str, int, int]:
+        return image_url
+
+    image_url = await with_retries(request, (IMAGE_MODEL,))
+    image_path = await download_image(image_url)
+    if not image_path:
+        raise FailedToGenerateImageException('Failed to download generated image.')
+    return image_path
+
+async def generate_story_visual_prompt(story_text: str, visual_prompt: str | None = None) -> tuple[str, int, int]:
     """
     Generates a visual prompt for a story based on the given text.
 
     Args:
-        story_text (str): The text of the story.
+        story_text (str): The text of the story, or of its continuation when ``visual_prompt`` is given.
+        visual_prompt (str | None): The prompt generated for the story so far, to be updated.
 
     Returns:
         tuple[str, int, int]: A tuple containing the generated prompt, the number of input tokens used, and the number of output tokens used.
@@ -158,12 +796,15 @@ async def generate_story_visual_prompt(story_text: str) -> tuple[str, int, int]:
         story_text = story_text[:2000]
         logger.warning('Story text is too long. Truncating to 2000 characters...')
 
-    prompt = SUMMARIZE_STORY_FOR_IMAGE.format(story_text=story_text)
+    if visual_prompt:
+        prompt = UPDATE_STORY_IMAGE_PROMPT.format(visual_prompt=visual_prompt, story_text=story_text)
+    else:
+        prompt = SUMMARIZE_STORY_FOR_IMAGE.format(story_text=story_text)
     messages = [
         {'role': 'system', 'content': 'You are an expert in visual storytelling..'},
         {'role': 'user', 'content': prompt}
     ]
-    content, input_tokens, output_tokens = await llm(messages)
+    content, input_tokens, output_tokens = await llm(messages, priority=LLMPriority.BACKGROUND)
 
     return content, input_tokens, output_tokens
 
@@ -21,3 +21,9 @@ class DailyStoryLimitExceededException(BaseException):
 
 class DailyChatLimitExceededException(BaseException):
     pass
+
+class LLMBusyException(BaseException):
+    pass
+
+class LLMUnavailableException(BaseException):
+    pass
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# file extension of each format Pillow can write
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+
+def transcode(source: str, target: str, image_format: str, quality: int, max_size: int) -> tuple[int, int, float]:
+    """
+    Re-encodes an image in another format. Runs in a worker process.
+
+    Args:
+        source (str): Path of the image to read.
+        target (str): Path to write the re-encoded image to.
+        image_format (str): JPEG, WEBP or PNG.
+        quality (int): Encoder quality, 1-100 (ignored for PNG).
+        max_size (int): Largest width or height kept, 0 to keep the original size.
+
+    Returns:
+        tuple[int, int, float]: The size of the source and of the target in bytes, and the seconds it took.
+    """
+    start = time.perf_counter()
+    with Image.open(source) as image:
+        if image_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        if max_size:
+            image.thumbnail((max_size, max_size))
+        image.save(target, image_format, quality=quality)
+    return os.path.getsize(source), os.path.getsize(target), time.perf_counter() - start
+
+
+class ImageStore:
+    '''
+    Images saved under the hash of their content, re-encoded to a compact format.
+
+    An image is stored once however often it is downloaded, at
+    ``root/ab/abcdef....jpg``. Encoding is CPU bound, so it runs in a pool of
+    ``workers`` processes instead of on the event loop.
+
+    The store is kept under ``quota`` bytes by ``evict``, which removes the
+    least recently used images that are no longer needed. Files written
+    within ``grace`` seconds are never evicted: they may not be referenced
+    anywhere yet. While the store stays over quota anyway, ``eviction_due``
+    asks for a scan at most every ``evict_interval`` seconds.
+    '''
+
+    def __init__(self, root: str | Path, image_format: str = 'JPEG', quality: int = 85, max_size: int = 0,
+                 quota: int = 0, workers: int = 1, grace: float = 3600, evict_interval: float = 300):
+        self.root = Path(root)
+        self.image_format = image_format.upper()
+        if self.image_format not in EXTENSIONS:
+            raise ValueError(f'Unsupported image format: {image_format}')
+        self.quality = quality
+        self.max_size = max_size
+        self.quota = quota
+        self.workers = workers
+        self.grace = grace
+        self.evict_interval = evict_interval
+        # monotonic time of the last eviction scan
+        self.evicted_at: float | None = None
+        self.executor: ProcessPoolExecutor | None = None
+        # digest -> the same image being stored by another download
+        self.storing: dict[str, asyncio.Future] = {}
+        # bytes on disk, counted on first use and kept up to date by this process
+        self.used: int | None = None
+        self.metrics = {
+            'stored': 0,
+            'deduplicated': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'transcode_seconds': 0.0,
+            'evicted': 0,
+            'evicted_bytes': 0,
+        }
+
+    @property
+    def average_transcode(self) -> float:
+        return self.metrics['transcode_seconds'] / self.metrics['stored'] if self.metrics['stored'] else 0.0
+
+    @property
+    def compression(self) -> float:
+        '''Stored size as a fraction of the downloaded size.'''
+        return self.metrics['bytes_out'] / self.metrics['bytes_in'] if self.metrics['bytes_in'] else 0.0
+
+    def path_for(self, digest: str) -> Path:
+        return self.root / digest[:2] / f'{digest}.{EXTENSIONS[self.image_format]}'
+
+    def files(self) -> Iterable[os.DirEntry]:
+        '''Every image file under the root, including ones saved before the store existed.'''
+        stack = [self.root]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif not entry.name.endswith(('.part', '.tmp')):
+                        yield entry
+
+    async def transcode(self, source: Path, target: Path) -> tuple[int, int, float]:
+        '''Encode ``source`` into ``target`` in the worker pool, see ``transcode``.'''
+        if self.executor is None:
+            # forking would copy the bot's threads (database executor, lock connection) and their locks
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, transcode, str(source), str(target), self.image_format, self.quality, self.max_size
+        )
+
+    async def put(self, source: Path, digest: str) -> Path:
+        '''
+        Store a downloaded image and delete the download.
+
+        Args:
+            source (Path): The downloaded file, removed once stored
+            digest (str): Hex digest of the downloaded content
+
+        Returns:
+            Path: Where the image is stored
+        '''
+        path = self.path_for(digest)
+        try:
+            if digest in self.storing:
+                await asyncio.shield(self.storing[digest])
+            if path.exists():
+                # seen before: keep the stored copy and mark it as recently used
+                os.utime(path)
+                self.metrics['deduplicated'] += 1
+                return path
+            self.storing[digest] = asyncio.get_running_loop().create_future()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # encoded under another name so readers never see a half written image
+            temporary = path.with_name(f'{path.name}.{uuid.uuid4().hex[:8]}.tmp')
+            try:
+                size_in, size_out, seconds = await self.transcode(source, temporary)
+                os.replace(temporary, path)
+            except BaseException:
+                temporary.unlink(missing_ok=True)
+                raise
+            finally:
+                self.storing.pop(digest).set_result(None)
+        finally:
+            source.unlink(missing_ok=True)
+        self.metrics['stored'] += 1
+        self.metrics['bytes_in'] += size_in
+        self.metrics['bytes_out'] += size_out
+        self.metrics['transcode_seconds'] += seconds
+        if self.used is not None:
+            self.used += size_out
+        logger.info(f'Stored image {path.name}: {size_in:,} -> {size_out:,} bytes in {seconds * 1000:.0f} ms')
+        return path
+
+    @property
+    def over_quota(self) -> bool:
+        # None means not counted yet, evict counts
+        return bool(self.quota) and (self.used is None or self.used > self.quota)
+
+    @property
+    def eviction_due(self) -> bool:
+        return self.over_quota and (
+            self.evicted_at is None or time.monotonic() - self.evicted_at >= self.evict_interval
+        )
+
+    def evict(self, keep: set[str]) -> tuple[int, int]:
+        '''
+        Delete the least recently used images until the store fits its quota.
+        Blocking, scans the whole store.
+
+        Args:
+            keep (set[str]): Paths of images still needed, never deleted
+
+        Returns:
+            tuple[int, int]: The number of files deleted and the bytes freed
+        '''
+        self.evicted_at = time.monotonic()
+        keep = {os.path.abspath(path) for path in keep}
+        entries = [(entry.path, entry.stat()) for entry in self.files()]
+        self.used = sum(stat.st_size for _, stat in entries)
+        deleted = freed = 0
+        if not self.quota:
+            return deleted, freed
+        newest = time.time() - self.grace
+        # least recently used first
+        for path, stat in sorted(entries, key=lambda item: item[1].st_mtime):
+            if self.used <= self.quota:
+                break
+            if stat.st_mtime > newest or os.path.abspath(path) in keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # removed by another process
+                pass
+            else:
+                deleted += 1
+                freed += stat.st_size
+            self.used -= stat.st_size
+        self.metrics['evicted'] += deleted
+        self.metrics['evicted_bytes'] += freed
+        if deleted:
+            logger.info(f'Evicted {deleted} images ({freed:,} bytes), {self.used:,} bytes in use')
+        return deleted, freed
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
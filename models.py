@@ -1,9 +1,16 @@
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+import asyncio
+import hashlib
+import json
 import uuid
 
 from peewee import *
+from peewee import Expression
 
-from config import USE_SQLITE
+from config import USE_SQLITE, DB_POOL_SIZE
 
 
 if USE_SQLITE:
@@ -19,12 +26,53 @@ else:
     db = PostgresqlDatabase(PGDB_NAME, user=PGDB_USER, password=PGDB_PASS,
                             host=PGDB_HOST, port=PGDB_PORT)
 
+# peewee keeps connection state per thread, so each worker owns a single connection
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+
+def _call_with_connection(func: Callable, *args, **kwargs) -> Any:
+    db.connect(reuse_if_open=True)
+    return func(*args, **kwargs)
+
+
+async def run_db(func: Callable, *args, **kwargs) -> Any:
+    '''
+    Run a blocking database call on the database executor.
+
+    Args:
+        func (Callable): Function doing the peewee work
+        *args: Positional arguments for ``func``
+        **kwargs: Keyword arguments for ``func``
+
+    Returns:
+        Any: Whatever ``func`` returns
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        db_executor,
+        partial(_call_with_connection, func, *args, **kwargs)
+    )
+
+
+def shutdown_db_executor() -> None:
+    db_executor.shutdown(wait=True)
+
 
 class BaseModel(Model):
     class Meta:
         database = db
 
 
+class JSONField(TextField):
+    '''JSON stored as text, the same on SQLite and Postgres.'''
+
+    def db_value(self, value: Any) -> str | None:
+        return None if value is None else json.dumps(value, ensure_ascii=False)
+
+    def python_value(self, value: str | None) -> Any:
+        return None if value is None else json.loads(value)
+
+
 class User(BaseModel):
     user_id = BigIntegerField(primary_key=True, index=True)
     username = CharField(max_length=50, null=True)
@@ -53,17 +101,66 @@ class User(BaseModel):
     @classmethod
     def get_or_create(cls, user_id: int, username: str = None,
                       first_name: str = None, last_name: str = None) -> tuple['User', bool]:
-        user = cls.select().where(User.user_id == user_id)
-        if user.exists():
-            return user.first(), False
-        
-        user = cls.create(
-            user_id=user_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name
+        # read first: almost every call finds the user, and an upsert would write the row each time
+        user = cls.get_or_none(cls.user_id == user_id)
+        if user is not None:
+            return user, False
+        created = (
+            cls
+            .insert(
+                user_id=user_id,
+                username=username,
+                first_name=first_name,
+                last_name=last_name
+            )
+            .on_conflict_ignore()
+            .as_rowcount()
+            .execute()
         )
-        return user, True
+        # nothing inserted when another request created the user in the meantime
+        return cls.get(cls.user_id == user_id), bool(created)
+
+    @classmethod
+    def add_charge(cls, user_id: int, amount: float) -> None:
+        '''Atomically add ``amount`` (negative to spend) to the balance, without rewriting the row.'''
+        cls.update(charge=cls.charge + amount).where(cls.user_id == user_id).execute()
+
+
+class Prompt(BaseModel):
+    '''A system prompt version, stored once and referenced by sections and chats.'''
+    id = BigAutoField()
+    name = CharField(max_length=50)
+    content_hash = CharField(max_length=64, unique=True)
+    text = TextField()
+    created_at = DateTimeField(default=datetime.now)
+
+    @property
+    def as_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'content_hash': self.content_hash,
+            'text': self.text,
+            'created_at': str(self.created_at)
+        }
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @classmethod
+    def get_or_create_version(cls, name: str, text: str) -> 'Prompt':
+        content_hash = cls.hash_text(text)
+        prompt = cls.get_or_none(cls.content_hash == content_hash)
+        if prompt:
+            return prompt
+
+        try:
+            with db.atomic():
+                return cls.create(name=name, content_hash=content_hash, text=text)
+        except IntegrityError:
+            # created by another worker in the meantime
+            return cls.get(cls.content_hash == content_hash)
 
 
 class Story(BaseModel):
@@ -72,6 +169,24 @@ class Story(BaseModel):
     is_end = BooleanField(default=False)
     created_at = DateTimeField(default=datetime.now)
     rate = IntegerField(null=True)
+    # Telegram file_id of the uploaded cover, sending it again is a reference instead of an upload
+    cover_file_id = CharField(max_length=255, null=True)
+    # plain text of the story so far, appended as sections are created, and how many AI sections it has
+    text = TextField(default='')
+    text_sections = IntegerField(default=0)
+    # image prompt for the cover, covering the first visual_prompt_chars characters of text
+    visual_prompt = TextField(null=True)
+    visual_prompt_chars = IntegerField(default=0)
+    # tokens spent on visual_prompt and their cost, charged with the cover
+    visual_prompt_input_tokens = IntegerField(default=0)
+    visual_prompt_output_tokens = IntegerField(default=0)
+    visual_prompt_cost = FloatField(default=0)
+
+    class Meta:
+        # daily story limit: a user's stories of the last 24 hours
+        indexes = (
+            (('user', 'created_at'), False),
+        )
 
     @property
     def as_dict(self) -> dict:
@@ -83,6 +198,15 @@ class Story(BaseModel):
             'rate': self.rate
         }
 
+    def append_text(self, text: str) -> None:
+        '''Append the text of a section to ``text`` without reading it back.'''
+        (
+            Story
+            .update(text=Story.text.concat(text + '\n'), text_sections=Story.text_sections + 1)
+            .where(Story.id == self.id)
+            .execute()
+        )
+
     def sections_histories(self) -> list['Section']:
         query = (
             self.sections
@@ -96,8 +220,21 @@ class StoryScenario(BaseModel):
     story = ForeignKeyField(Story, on_delete=None, null=True)
     text = TextField()
     is_system = BooleanField()
+    # user who was offered this scenario and until when nobody else may see it
+    reserved_by = BigIntegerField(null=True)
+    reserved_until = DateTimeField(null=True)
     created_at = DateTimeField(default=datetime.now)
 
+    @classmethod
+    def available(cls, now: datetime | None = None) -> Expression:
+        '''Condition matching unused system scenarios that are not reserved by anyone.'''
+        now = now or datetime.now()
+        return (
+            (cls.story.is_null()) &
+            (cls.is_system == True) &
+            (cls.reserved_until.is_null() | (cls.reserved_until < now))
+        )
+
     @property
     def as_dict(self) -> dict:
         return {
@@ -109,26 +246,87 @@ class StoryScenario(BaseModel):
         }
 
 
+# the unused pool is tiny compared to the table, so only index rows without a story
+StoryScenario.add_index(
+    StoryScenario.index(StoryScenario.is_system, StoryScenario.reserved_until,
+                        where=StoryScenario.story.is_null())
+)
+
+
 class Section(BaseModel):
     id = BigAutoField()
     story = ForeignKeyField(Story, backref='sections')
+    # empty when the section is a system prompt stored in `prompt`
     text = TextField()
+    prompt = ForeignKeyField(Prompt, null=True)
     is_system = BooleanField()
     used = BooleanField(default=False)
+    # the parsed AI response, written with the section; text keeps the raw JSON sent back to the LLM
+    title = TextField(null=True)
+    body = TextField(null=True)
+    # {"1": "option text", ...} like the LLM's own options object
+    options = JSONField(null=True)
+    is_end = BooleanField(null=True)
+    # usage of the completion that produced an AI section, recorded when it is written
+    model = CharField(max_length=50, null=True)
+    input_tokens = IntegerField(default=0)
+    output_tokens = IntegerField(default=0)
+    cached_tokens = IntegerField(default=0)
+    latency = FloatField(null=True)
+    cost = FloatField(default=0)
     created_at = DateTimeField(default=datetime.now)
 
+    class Meta:
+        indexes = (
+            # sections_histories, in order without a sort
+            (('story', 'created_at'), False),
+            # cost_report groups by day and model over a date range
+            (('created_at', 'model'), False),
+        )
+
     @property
     def as_dict(self) -> dict:
         return {
             'id': self.id,
             'story_id': self.story.id,
             'text': self.text,
+            'prompt_id': self.prompt_id,
             'is_system': self.is_system,
             'used': self.used,
+            'title': self.title,
+            'body': self.body,
+            'options': self.options,
+            'is_end': self.is_end,
+            'model': self.model,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'cached_tokens': self.cached_tokens,
+            'latency': self.latency,
+            'cost': self.cost,
             'created_at': str(self.created_at)
         }
 
 
+class UsageLedger(BaseModel):
+    '''Append-only record of what each request cost; balances live in ``User.charge``.'''
+    id = BigAutoField()
+    user = ForeignKeyField(User, null=True)
+    # story, section, cover, chat, or charge for admin top-ups (negative cost)
+    kind = CharField(max_length=20)
+    model = CharField(max_length=50, null=True)
+    input_tokens = IntegerField(default=0)
+    output_tokens = IntegerField(default=0)
+    cost = FloatField()
+    story = ForeignKeyField(Story, null=True)
+    section = ForeignKeyField(Section, null=True)
+    created_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = (
+            (('user', 'created_at'), False),
+        )
+
+
 class LLMHistory(BaseModel):
     id = BigAutoField()
     user = ForeignKeyField(User, null=True)
@@ -157,13 +355,78 @@ class Chat(BaseModel):
     id = BigAutoField()
     session = ForeignKeyField(Session, backref='chats')
     user = ForeignKeyField(User, null=True)
+    # empty when the message is a system prompt stored in `prompt`
     text = TextField()
+    prompt = ForeignKeyField(Prompt, null=True)
     is_system = BooleanField()
+    # usage of the completion that produced an AI message, recorded when it is written
+    model = CharField(max_length=50, null=True)
+    input_tokens = IntegerField(default=0)
+    output_tokens = IntegerField(default=0)
+    cached_tokens = IntegerField(default=0)
+    latency = FloatField(null=True)
+    cost = FloatField(default=0)
     created_at = DateTimeField(default=datetime.now)
 
+    class Meta:
+        indexes = (
+            # chat_histories, in order without a sort
+            (('session', 'created_at'), False),
+            (('created_at', 'model'), False),
+        )
+
+
+# partial indexes hold only the rows their query looks for
+# daily chat limit: a user's own messages of the last 24 hours
+Chat.add_index(Chat.user, Chat.created_at, where=(Chat.is_system == False), name='chat_user_id_created_at_messages')
+# the user's active chat session
+Session.add_index(Session.user, where=(Session.active == True), name='session_user_id_active')
+
+
+class ProcessedUpdate(BaseModel):
+    '''An update already handled by one of the bot processes, shared for de-duplication.'''
+    namespace = CharField(max_length=20)
+    key = CharField(max_length=64)
+    created_at = DateTimeField(default=datetime.now, index=True)
+
+    class Meta:
+        primary_key = CompositeKey('namespace', 'key')
+
+
+class UserLock(BaseModel):
+    '''A lease on processing a user's updates, shared by every bot process.'''
+    key = BigIntegerField(primary_key=True)
+    token = CharField(max_length=32)
+    expires_at = DateTimeField(index=True)
+
+
+class CoverJob(BaseModel):
+    '''A story cover to generate and send in the background, see ``CoverQueue``.'''
+    id = BigAutoField()
+    story = ForeignKeyField(Story, unique=True)
+    chat_id = BigIntegerField()
+    # pending, running, done or failed
+    status = CharField(max_length=10, default='pending')
+    attempts = IntegerField(default=0)
+    # kept so a retry after a failed upload does not generate (and charge) the cover again
+    image_path = CharField(max_length=255, null=True)
+    error = TextField(null=True)
+    # a pending job is due from this time on, a running job's lease ends then
+    run_after = DateTimeField(default=datetime.now)
+    created_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = (
+            (('status', 'run_after'), False),
+        )
+
+
+MODELS = [User, Prompt, Story, StoryScenario, Section, LLMHistory, Session, Chat, ProcessedUpdate, UserLock,
+          UsageLedger, CoverJob]
+
 
 def create_tables() -> None:
-    db.create_tables([User, Story, StoryScenario, Section, LLMHistory, Session, Chat])
+    db.create_tables(MODELS)
 
 if __name__ == '__main__':
     create_tables()
\ No newline at end of file
@@ -61,6 +61,20 @@ Then, generate a cinematic illustration prompt suitable for DALL·E 3, focusing
 Ensure the response is less than 1000 characters and only return the image prompt without any extra information.
 '''
 
+UPDATE_STORY_IMAGE_PROMPT = '''
+Here is a cinematic illustration prompt for DALL·E 3 written for the beginning of a detective story:
+
+"{visual_prompt}"
+
+The story continues like this:
+
+"{story_text}"
+
+Rewrite the prompt so it reflects the story so far, keeping the elements that still define it. Follow the same rules as the original prompt: focus on the setting, the main detective, important objects or clues and the overall mood, with a film-noir aesthetic, dramatic lighting and a painterly or photorealistic style. Avoid any mention of weapons, bodies, or direct depictions of crime scenes, and any sensitive content that might violate OpenAI's content policies.
+
+Ensure the response is less than 1000 characters and only return the image prompt without any extra information.
+'''
+
 CHAT_PROMPT = '''
 تو یک راوی داستان جنایی هستی که وظیفه‌ات تعامل با کاربر و پاسخ‌گویی به نیازهای او بر اساس اطلاعاتی‌ست که در ادامه آورده شده. کاربر با تو صحبت می‌کند، و وظیفه‌ی تو این است که با دقت به صحبت‌های او گوش دهی، نیازش را تشخیص دهی، و بر اساس آن واکنش مناسبی نشان دهی.
 
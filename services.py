@@ -1,20 +1,267 @@
-import random
 import logging
-from collections import defaultdict
-from functools import wraps
+import asyncio
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque, OrderedDict
+from functools import lru_cache, partial, wraps
 from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable
 
-from models import User, Story, Section, StoryScenario, Session, Chat, fn
+from peewee import IntegrityError, PostgresqlDatabase
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from models import User, Story, Section, StoryScenario, Session, Chat, Prompt, ProcessedUpdate, UserLock, UsageLedger,\
+    CoverJob, fn, run_db, db
 from utils import generate_crime_story_scenarios, story_parser, AIStoryResponse,\
-    calculate_token_price, ai_chat_parser, AIChatResponse, ChatCommand
-from core import llm, generate_image_from_prompt, generate_story_visual_prompt
+    calculate_token_price, ai_chat_parser, AIChatResponse, ChatCommand,\
+    PartialStoryResponse, StoryStreamParser, response_format, STORY_RESPONSE_SCHEMA, CHAT_RESPONSE_SCHEMA
+from core import llm, llm_stream, generate_image_from_prompt, generate_story_visual_prompt, LLMPriority, LLMUsage, response_usage,\
+    image_store
 from prompts import STORY_PROMPT, CHAT_PROMPT
-from config import IMAGE_PRICE, MAX_DAILY_STORY_CREATION, MAX_DAILY_CHAT_MESSAGE, MAX_SESSION_MESSAGES
+from config import IMAGE_PRICE, MAX_DAILY_STORY_CREATION, MAX_DAILY_CHAT_MESSAGE, MAX_SESSION_MESSAGES,\
+    SPECULATIVE_GENERATION, SPECULATIVE_TIMEOUT, SPECULATIVE_TTL, SPECULATIVE_MAX_STORIES,\
+    SCENARIO_POOL_TARGET, SCENARIO_POOL_LOW_WATERMARK, SCENARIO_RESERVATION_TTL, USE_SQLITE,\
+    STORY_CACHE_MAX_BYTES, DEDUPE_TTL, DEDUPE_MAX_KEYS, DEDUPE_BACKEND, LOCK_BACKEND, LOCK_TTL, LOCK_MAX_ENTRIES,\
+    USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL, LEDGER_BATCH_SIZE, IMAGE_MODEL,\
+    DAILY_LIMIT_CACHE_MAX_ENTRIES, DAILY_LIMIT_CACHE_TTL, COVER_CONCURRENCY, COVER_MAX_ATTEMPTS, COVER_POLL_INTERVAL,\
+    COVER_JOB_LEASE, STORY_COVER_GENERATION, VISUAL_PROMPT_UPDATE_CHARS
 from exceptions import *
 
 
 logger = logging.getLogger(__name__)
-session = defaultdict(lambda: {'is_processing': False})
+ProgressCallback = Callable[[PartialStoryResponse], Awaitable[None]]
+
+
+def user_priority(user: User, default: LLMPriority) -> LLMPriority:
+    '''Users who charged their account go ahead of everyone else.'''
+    return LLMPriority.PAID if user.charge > 0 else default
+
+
+def charge_user(user: User, cost: float) -> None:
+    '''
+    Take ``cost`` off the user's balance with an atomic update and mirror it
+    on ``user``, which may be the cached instance. Runs on the database executor.
+    '''
+    User.add_charge(user.user_id, -cost)
+    user.charge -= cost
+
+
+class UsageLedgerWriter:
+    '''
+    Buffers usage ledger rows and inserts them in batches.
+    
+    A flush starts once ``batch_size`` rows are waiting; ``flush`` is also
+    run periodically and on shutdown. Rows of a failed flush are kept for
+    the next one.
+    '''
+    
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.rows: list[dict] = []
+        self.flushing: asyncio.Task | None = None
+        self.metrics = {
+            'recorded': 0,
+            'flushed': 0,
+            'failed_flushes': 0,
+        }
+    
+    def record(self, user: User | None, kind: str, cost: float, input_tokens: int = 0, output_tokens: int = 0,
+               model: str | None = None, story: Story | None = None, section: Section | None = None) -> None:
+        self.rows.append({
+            'user': user.user_id if user else None,
+            'kind': kind,
+            'model': model,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'cost': cost,
+            'story': story.id if story else None,
+            'section': section.id if section else None,
+            'created_at': datetime.now(),
+        })
+        self.metrics['recorded'] += 1
+        if len(self.rows) >= self.batch_size and not (self.flushing and not self.flushing.done()):
+            self.flushing = asyncio.ensure_future(self.flush())
+    
+    @staticmethod
+    def _insert(rows: list[dict]) -> None:
+        with db.atomic():
+            UsageLedger.insert_many(rows).execute()
+    
+    async def flush(self) -> None:
+        rows, self.rows = self.rows, []
+        if not rows:
+            return None
+        try:
+            await run_db(self._insert, rows)
+            self.metrics['flushed'] += len(rows)
+        except Exception as e:
+            logger.exception(f'Failed to write {len(rows)} usage ledger rows: {e}')
+            self.metrics['failed_flushes'] += 1
+            self.rows = rows + self.rows
+
+
+usage_ledger = UsageLedgerWriter(LEDGER_BATCH_SIZE)
+
+
+class UserCache:
+    '''
+    LRU cache of ``User`` rows keyed by user id.
+    
+    Entries expire after ``ttl`` seconds so changes made by other processes
+    are picked up, and are invalidated when an admin changes a user. Safe to
+    use from the database executor.
+    '''
+    
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[int, tuple[User, float]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+    
+    @property
+    def hit_rate(self) -> float:
+        total = self.metrics['hits'] + self.metrics['misses']
+        return self.metrics['hits'] / total if total else 0.0
+    
+    def get(self, user_id: int) -> User | None:
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[1] <= time.monotonic():
+                self.metrics['misses'] += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.metrics['hits'] += 1
+            return entry[0]
+    
+    def put(self, user: User) -> None:
+        with self.lock:
+            self.entries[user.user_id] = (user, time.monotonic() + self.ttl)
+            self.entries.move_to_end(user.user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.metrics['evictions'] += 1
+    
+    def invalidate(self, user_id: int) -> None:
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+user_cache = UserCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL)
+
+
+class DailyLimitCounter:
+    '''
+    Rolling 24 hour count of the rows a user created, so daily limits are
+    enforced without a COUNT query on every request.
+    
+    A user's counter is loaded from the database on first use and read again
+    once it is ``ttl`` seconds old, which picks up rows written by other
+    processes and keeps it correct across restarts. In between, rows inserted
+    by this process are added with ``record``. Only the ``limit`` newest
+    timestamps are kept per user, all a limit check needs. Safe to use from
+    the database executor.
+    '''
+    WINDOW = timedelta(hours=24)
+    
+    def __init__(self, load: Callable[[int, datetime, int], list[datetime]], limit: int,
+                 max_entries: int, ttl: float):
+        '''
+        Args:
+            load (Callable[[int, datetime, int], list[datetime]]): Returns the creation times of
+                at most ``limit`` of the user's newest rows created after the given time
+            limit (int): The daily limit
+            max_entries (int): Users kept in memory
+            ttl (float): Seconds before a user's counter is read from the database again
+        '''
+        self.load = load
+        self.limit = limit
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[int, tuple[deque[datetime], float]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+    
+    @property
+    def hit_rate(self) -> float:
+        total = self.metrics['hits'] + self.metrics['misses']
+        return self.metrics['hits'] / total if total else 0.0
+    
+    def count(self, user_id: int) -> int:
+        '''
+        Rows the user created in the last 24 hours, counting at most up to the limit.
+        
+        Args:
+            user_id (int): The user to count for
+            
+        Returns:
+            int: The number of rows, never more than ``limit``
+        '''
+        since = datetime.now() - self.WINDOW
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(user_id)
+                self.metrics['hits'] += 1
+                return sum(created_at > since for created_at in entry[0])
+            self.metrics['misses'] += 1
+        
+        timestamps = deque(sorted(self.load(user_id, since, self.limit)), maxlen=self.limit)
+        with self.lock:
+            self.entries[user_id] = (timestamps, time.monotonic() + self.ttl)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.metrics['evictions'] += 1
+        return len(timestamps)
+    
+    def record(self, user_id: int, created_at: datetime) -> None:
+        '''Count a row the user just created; users not in memory are counted when loaded.'''
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                entry[0].append(created_at)
+
+
+def story_times(user_id: int, since: datetime, limit: int) -> list[datetime]:
+    query = (
+        Story
+        .select(Story.created_at)
+        .where((Story.user == user_id) & (Story.created_at > since))
+        .order_by(Story.created_at.desc())
+        .limit(limit)
+    )
+    return [created_at for created_at, in query.tuples()]
+
+
+def chat_message_times(user_id: int, since: datetime, limit: int) -> list[datetime]:
+    query = (
+        Chat
+        .select(Chat.created_at)
+        .where((Chat.user == user_id) & (Chat.is_system == False) & (Chat.created_at > since))
+        .order_by(Chat.created_at.desc())
+        .limit(limit)
+    )
+    return [created_at for created_at, in query.tuples()]
+
+
+daily_stories = DailyLimitCounter(story_times, MAX_DAILY_STORY_CREATION, DAILY_LIMIT_CACHE_MAX_ENTRIES,
+                                  DAILY_LIMIT_CACHE_TTL)
+daily_chat_messages = DailyLimitCounter(chat_message_times, MAX_DAILY_CHAT_MESSAGE, DAILY_LIMIT_CACHE_MAX_ENTRIES,
+                                        DAILY_LIMIT_CACHE_TTL)
 
 
 class UserService:
@@ -42,17 +289,34 @@ class UserService:
         Raises:
             Exception: If the user exists but is deactivated
         '''
+        user = user_cache.get(user_id) or self._load_user(user_id, username, first_name, last_name)
+        return self._check_active(user, only_active)
+    
+    async def aget_user(self, user_id: int, username: str | None = None, first_name: str | None = None,
+                        last_name: str | None = None, only_active: bool = True) -> User:
+        '''
+        Like ``get_user``, but a cached user is returned without leaving the event loop.
+        '''
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await run_db(self._load_user, user_id, username, first_name, last_name)
+        return self._check_active(user, only_active)
+    
+    def _load_user(self, user_id: int, username: str | None, first_name: str | None,
+                   last_name: str | None) -> User:
         user, created = User.get_or_create(user_id, username, first_name, last_name)
+        user_cache.put(user)
         
         if created:
             logger.info(f'Created new user with ID: {user_id}')
         else:
             logger.debug(f'Retrieved existing user with ID: {user_id}')
-            
+        return user
+    
+    def _check_active(self, user: User, only_active: bool) -> User:
         if only_active and not user.active:
-            logger.warning(f'Attempted to get deactivated user: {user_id}')
+            logger.warning(f'Attempted to get deactivated user: {user.user_id}')
             raise UserNotActiveException(f'User {user.user_id} is deactivated.')
-            
         return user
     
     def get_by_username(self, username: str) -> User:
@@ -68,6 +332,438 @@ class UserService:
         logger.info(f'Deactivating user: {user.user_id}')
         user.active = True
         user.save()
+        user_cache.invalidate(user.user_id)
+
+
+class PromptRegistry:
+    '''
+    Content-addressed store of the system prompts sections and chats start with.
+    
+    A prompt version never changes once stored, so lookups in both directions
+    are cached for the lifetime of the process. Methods query the database on
+    a miss and are meant to run on the database executor.
+    '''
+    
+    def __init__(self):
+        self.ids: dict[str, int] = {}
+        self.texts: dict[int, str] = {}
+    
+    def version(self, name: str, text: str) -> int:
+        '''
+        Get the id of a prompt version, storing it if it is new.
+        
+        Args:
+            name (str): Name of the prompt, e.g. ``story``
+            text (str): Full text of the prompt
+            
+        Returns:
+            int: The prompt id
+        '''
+        content_hash = Prompt.hash_text(text)
+        if content_hash not in self.ids:
+            prompt = Prompt.get_or_create_version(name, text)
+            self.ids[content_hash] = prompt.id
+            self.texts[prompt.id] = prompt.text
+        return self.ids[content_hash]
+    
+    def text(self, prompt_id: int) -> str:
+        if prompt_id not in self.texts:
+            self.texts[prompt_id] = Prompt.get_by_id(prompt_id).text
+        return self.texts[prompt_id]
+    
+    def content(self, row: Section | Chat) -> str:
+        '''The text of a section or chat message, resolving prompt references.'''
+        return row.text if row.prompt_id is None else self.text(row.prompt_id)
+
+
+prompt_registry = PromptRegistry()
+
+
+class StoryContextCache:
+    '''
+    LRU cache of the LLM message list of active stories.
+    
+    Entries are written through when sections are stored, so continuing a
+    story does not re-read its sections. The cache is bounded by the memory
+    held by message texts and is safe to use from the database executor.
+    '''
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[int, tuple[list[dict], int]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+    
+    @property
+    def hit_rate(self) -> float:
+        total = self.metrics['hits'] + self.metrics['misses']
+        return self.metrics['hits'] / total if total else 0.0
+    
+    def _pop(self, story_id: int) -> None:
+        entry = self.entries.pop(story_id, None)
+        if entry:
+            self.size -= entry[1]
+    
+    def get(self, story_id: int) -> list[dict] | None:
+        with self.lock:
+            entry = self.entries.get(story_id)
+            if entry is None:
+                self.metrics['misses'] += 1
+                return None
+            self.entries.move_to_end(story_id)
+            self.metrics['hits'] += 1
+            # callers append to the list they get back
+            return list(entry[0])
+    
+    def put(self, story_id: int, messages: list[dict]) -> None:
+        size = sum(sys.getsizeof(message['content']) for message in messages)
+        with self.lock:
+            self._pop(story_id)
+            if size > self.max_bytes:
+                return None
+            self.entries[story_id] = (list(messages), size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.metrics['evictions'] += 1
+    
+    def invalidate(self, *story_ids: int) -> None:
+        with self.lock:
+            for story_id in story_ids:
+                self._pop(story_id)
+
+
+story_context_cache = StoryContextCache(STORY_CACHE_MAX_BYTES)
+
+
+class DedupeStore:
+    '''
+    Remembers recently handled updates so repeated deliveries are ignored.
+    
+    Keys live in separate namespaces (message ids are only unique per chat,
+    update ids per bot). Each namespace keeps two generations of keys: the
+    current set is retired once it is ``ttl / 2`` seconds old or holds
+    ``max_keys / 2`` keys, and the retired set is dropped at the next
+    rotation. A key is therefore remembered for at least ``ttl / 2`` seconds
+    unless the namespace is flooded, and memory stays bounded either way.
+    '''
+    
+    def __init__(self, ttl: float, max_keys: int, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.clock = clock
+        # namespace -> [current keys, previous keys, time the current generation started]
+        self.namespaces: dict[str, list] = {}
+        self.metrics = {
+            'duplicates': 0,
+            'rotations': 0,
+        }
+    
+    def __len__(self) -> int:
+        return sum(len(current) + len(previous) for current, previous, _ in self.namespaces.values())
+    
+    def _generations(self, namespace: str, now: float) -> list:
+        generations = self.namespaces.get(namespace)
+        if generations is None:
+            generations = self.namespaces[namespace] = [set(), set(), now]
+        elif now - generations[2] >= self.ttl / 2 or len(generations[0]) >= self.max_keys / 2:
+            generations[:] = [set(), generations[0] if now - generations[2] < self.ttl else set(), now]
+            self.metrics['rotations'] += 1
+        return generations
+    
+    def seen_sync(self, namespace: str, key: int | str) -> bool:
+        current, previous, _ = self._generations(namespace, self.clock())
+        if key in current or key in previous:
+            self.metrics['duplicates'] += 1
+            return True
+        current.add(key)
+        return False
+    
+    async def seen(self, namespace: str, key: int | str) -> bool:
+        '''
+        Record a key and tell whether it was already recorded.
+        
+        Args:
+            namespace (str): Kind of key, for example 'message' or 'update'
+            key (int | str): The key
+            
+        Returns:
+            bool: True if the key was seen recently
+        '''
+        return self.seen_sync(namespace, key)
+    
+    async def prune(self) -> None:
+        now = self.clock()
+        for namespace in self.namespaces:
+            self._generations(namespace, now)
+
+
+class DatabaseDedupeStore(DedupeStore):
+    '''
+    De-duplication shared by every bot process using the same database.
+    
+    Keys are claimed by inserting them; a failing insert means another
+    process (or an earlier delivery) already handled the update.
+    '''
+    
+    def _claim(self, namespace: str, key: int | str) -> bool:
+        try:
+            with db.atomic():
+                ProcessedUpdate.create(namespace=namespace, key=str(key))
+            return True
+        except IntegrityError:
+            return False
+    
+    async def seen(self, namespace: str, key: int | str) -> bool:
+        # the local store answers repeated deliveries to this process without a query
+        if self.seen_sync(namespace, key):
+            return True
+        if await run_db(self._claim, namespace, key):
+            return False
+        self.metrics['duplicates'] += 1
+        return True
+    
+    async def prune(self) -> None:
+        await super().prune()
+        expired = datetime.now() - timedelta(seconds=self.ttl)
+        deleted = await run_db(ProcessedUpdate.delete().where(ProcessedUpdate.created_at < expired).execute)
+        logger.info(f'Pruned {deleted} processed updates')
+
+
+if DEDUPE_BACKEND == 'database':
+    dedupe_store = DatabaseDedupeStore(DEDUPE_TTL, DEDUPE_MAX_KEYS)
+else:
+    dedupe_store = DedupeStore(DEDUPE_TTL, DEDUPE_MAX_KEYS)
+
+
+class SectionSpeculator:
+    '''
+    Generates the continuation of every option of a story section in the
+    background, so a click can be answered without waiting for the LLM.
+    
+    Each branch runs in its own task with its own deadline. When the user
+    picks an option the matching branch is handed over and the others are
+    cancelled, as is the matching branch when it has not finished yet;
+    nothing is charged to the user for discarded branches. The
+    waste metrics count finished branches exactly and cancelled ones by the
+    estimated size of their prompt, which the provider may already have read.
+    '''
+    
+    def __init__(self):
+        self.branches: dict[int, dict] = {}
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'cancelled': 0,
+            'wasted_tokens': 0,
+            'wasted_cost': 0.0,
+        }
+    
+    @property
+    def hit_rate(self) -> float:
+        total = self.metrics['hits'] + self.metrics['misses']
+        return self.metrics['hits'] / total if total else 0.0
+    
+    async def _generate(self, messages: list[dict], choice: int) -> tuple[AIStoryResponse | None, int, int, LLMUsage]:
+        messages = messages + [{'role': 'user', 'content': str(choice)}]
+        content, input_tokens, output_tokens = await asyncio.wait_for(
+            llm(messages, priority=LLMPriority.BACKGROUND,
+                response_format=response_format('story', STORY_RESPONSE_SCHEMA)),
+            SPECULATIVE_TIMEOUT
+        )
+        # every branch runs in its own task, so this is the usage of this branch
+        return story_parser(content), input_tokens, output_tokens, response_usage.get()
+    
+    def _waste(self, task: asyncio.Task, prompt_tokens: int) -> None:
+        if not task.done():
+            task.cancel()
+            self.metrics['cancelled'] += 1
+            self.metrics['wasted_tokens'] += prompt_tokens
+            self.metrics['wasted_cost'] += calculate_token_price(prompt_tokens, 0)
+        elif not task.cancelled() and task.exception() is None:
+            _, input_tokens, output_tokens, usage = task.result()
+            self.metrics['wasted_tokens'] += input_tokens + output_tokens
+            self.metrics['wasted_cost'] += calculate_token_price(input_tokens, output_tokens, usage.model,
+                                                                 usage.cached_tokens)
+    
+    def schedule(self, story: Story, messages: list[dict], options: list, usage: LLMUsage) -> None:
+        '''
+        Start generating every option of the section the user is looking at.
+        
+        Args:
+            story (Story): The story the section belongs to
+            messages (list[dict]): LLM messages up to and including the section
+            options (list[Option]): Options offered to the user
+            usage (LLMUsage): Usage of the request that wrote the section
+        '''
+        now = time.monotonic()
+        for story_id, entry in list(self.branches.items()):
+            if now - entry['created_at'] > SPECULATIVE_TTL:
+                self.discard(story_id)
+        self.discard(story.id)
+        
+        if len(self.branches) >= SPECULATIVE_MAX_STORIES:
+            logger.info(f'Too many speculations in flight, skipping story {story.id}')
+            return None
+        
+        self.branches[story.id] = {
+            'user_id': story.user_id,
+            'created_at': now,
+            # a branch's prompt is the section's prompt and answer, and the choice
+            'prompt_tokens': usage.input_tokens + usage.output_tokens,
+            'tasks': {
+                option.id: asyncio.create_task(self._generate(messages, option.id))
+                for option in options
+            }
+        }
+        logger.debug(f'Speculating {len(options)} branches for story {story.id}')
+    
+    async def take(self, story: Story, choice: int) -> tuple[AIStoryResponse, int, int, LLMUsage] | None:
+        '''
+        Claim the speculated continuation for a choice, if it is ready, and drop the other branches.
+        
+        Args:
+            story (Story): The story being continued
+            choice (int): The option the user picked
+            
+        Returns:
+            tuple[AIStoryResponse, int, int, LLMUsage] | None: The parsed response, its token
+                counts and usage, or None when there is no usable branch
+        '''
+        entry = self.branches.pop(story.id, None)
+        if entry is None:
+            self.metrics['misses'] += 1
+            return None
+        
+        task = entry['tasks'].pop(choice, None)
+        for other in entry['tasks'].values():
+            self._waste(other, entry['prompt_tokens'])
+        
+        result = None
+        if task is not None and not task.done():
+            # it runs at background priority, a fresh request at the user's priority is faster
+            self._waste(task, entry['prompt_tokens'])
+        elif task is not None and not task.cancelled():
+            try:
+                result = task.result()
+            except Exception as e:
+                logger.warning(f'Speculative branch for story {story.id} failed: {e}')
+        
+        if result is None or result[0] is None:
+            if result is not None:
+                self.metrics['wasted_tokens'] += result[1] + result[2]
+                self.metrics['wasted_cost'] += calculate_token_price(result[1], result[2], result[3].model,
+                                                                     result[3].cached_tokens)
+            self.metrics['misses'] += 1
+            return None
+        
+        self.metrics['hits'] += 1
+        logger.info(f'Speculation hit for story {story.id}, hit rate {self.hit_rate:.0%}')
+        return result
+    
+    def discard(self, story_id: int) -> None:
+        entry = self.branches.pop(story_id, None)
+        if entry:
+            for task in entry['tasks'].values():
+                self._waste(task, entry['prompt_tokens'])
+    
+    def discard_user(self, user_id: int) -> None:
+        for story_id, entry in list(self.branches.items()):
+            if entry['user_id'] == user_id:
+                self.discard(story_id)
+
+
+speculator = SectionSpeculator()
+
+
+class VisualPromptBuilder:
+    '''
+    Prepares the cover prompt of a story while it is played, so generating
+    the cover only waits for the image.
+    
+    After a section is added the prompt is updated in the background with the
+    story text added since the last update, once it is ``update_chars`` long,
+    and when the story ends (only then if ``update_chars`` is 0). Updates of
+    a story run one after the other. Their tokens are charged with the cover.
+    '''
+    
+    def __init__(self, update_chars: int):
+        self.update_chars = update_chars
+        self.tasks: dict[int, asyncio.Task] = {}
+    
+    def schedule(self, story: Story, is_end: bool) -> None:
+        '''
+        Update the prompt of a story a section was just added to, if it is due.
+        
+        Args:
+            story (Story): The story
+            is_end (bool): Whether the section ended the story
+        '''
+        if not is_end and not self.update_chars:
+            return None
+        task = asyncio.create_task(self._update(story.id, is_end, self.tasks.get(story.id)))
+        self.tasks[story.id] = task
+        task.add_done_callback(partial(self._done, story.id))
+    
+    def _done(self, story_id: int, task: asyncio.Task) -> None:
+        if self.tasks.get(story_id) is task:
+            del self.tasks[story_id]
+        if not task.cancelled() and task.exception():
+            logger.warning(f'Failed to update the visual prompt of story {story_id}: {task.exception()}')
+    
+    async def _update(self, story_id: int, final: bool, previous: asyncio.Task | None = None) -> Story:
+        if previous is not None:
+            # its errors are logged by _done
+            await asyncio.wait({previous})
+        
+        story = await run_db(Story.get_by_id, story_id)
+        new_text = story.text[story.visual_prompt_chars:]
+        if not new_text.strip():
+            return story
+        if not final and (not self.update_chars or len(new_text) < self.update_chars):
+            return story
+        
+        visual_prompt, input_tokens, output_tokens = await generate_story_visual_prompt(new_text, story.visual_prompt)
+        usage = response_usage.get()
+        cost = calculate_token_price(input_tokens, output_tokens, usage.model, usage.cached_tokens)
+        
+        def save() -> Story:
+            (
+                Story
+                .update(
+                    visual_prompt=visual_prompt,
+                    visual_prompt_chars=len(story.text),
+                    visual_prompt_input_tokens=Story.visual_prompt_input_tokens + input_tokens,
+                    visual_prompt_output_tokens=Story.visual_prompt_output_tokens + output_tokens,
+                    visual_prompt_cost=Story.visual_prompt_cost + cost
+                )
+                .where(Story.id == story_id)
+                .execute()
+            )
+            return Story.get_by_id(story_id)
+        
+        return await run_db(save)
+    
+    async def get(self, story: Story) -> Story:
+        '''
+        Bring the cover prompt of a story up to date with all of its text.
+        
+        Args:
+            story (Story): The story
+            
+        Returns:
+            Story: The story read again, with ``visual_prompt`` set unless it has no text
+        '''
+        return await self._update(story.id, True, self.tasks.get(story.id))
+
+
+visual_prompts = VisualPromptBuilder(VISUAL_PROMPT_UPDATE_CHARS)
 
 
 class StoryService:
@@ -79,14 +775,14 @@ class StoryService:
     '''
     
     async def get_by_id(self, story_id: int) -> Story | None:
-        return Story.get_by_id(story_id)
+        return await run_db(Story.get_by_id, story_id)
     
     async def update_story_rate(self, story: Story, rate: int) -> None:
         if 0 > rate > 5:
             raise ValueError('Invalid rate value')
         
         story.rate = rate
-        story.save()
+        await run_db(story.save, only=[Story.rate])
     
     async def create(self, user: User) -> Story:
         '''
@@ -99,16 +795,14 @@ class StoryService:
             Story: The newly created story
         '''
         logger.info(f'Creating new story for user: {user.user_id}')
-        qs = Story.select().where(
-            (Story.user == user) &
-            (Story.created_at > datetime.now() - timedelta(hours=24))
-        )
         # if freemium user has reached the maximum daily story creation limit
-        if  user.charge < 0.0 and qs.count() >= MAX_DAILY_STORY_CREATION:
+        if  user.charge < 0.0 and await run_db(daily_stories.count, user.user_id) >= MAX_DAILY_STORY_CREATION:
             logger.warning(f'User {user.user_id} has reached the maximum daily story creation limit.')
             raise DailyStoryLimitExceededException(f'User {user.user_id} has reached the maximum daily story creation limit.') 
         
-        return Story.create(user=user)
+        story = await run_db(Story.create, user=user)
+        daily_stories.record(user.user_id, story.created_at)
+        return story
     
     def get_history(self, story: Story) -> list[Section]:
         '''
@@ -127,12 +821,18 @@ class StoryService:
         '''
         Convert story sections to message format for the LLM.
         
+        Served from ``story_context_cache`` when possible.
+        
         Args:
             story (Story): The story to convert
             
         Returns:
             list[dict]: Messages in the format expected by the LLM
         '''
+        cached = story_context_cache.get(story.id)
+        if cached is not None:
+            return cached
+        
         messages = []
         sections = self.get_history(story)
         
@@ -140,7 +840,7 @@ class StoryService:
             if section.is_system:
                 messages.append({
                     'role': 'assistant' if index else 'system',
-                    'content': section.text
+                    'content': prompt_registry.content(section)
                 })
             else:
                 messages.append({
@@ -149,6 +849,7 @@ class StoryService:
                 })
                 
         logger.debug(f'Converted story {story.id} to {len(messages)} messages')
+        story_context_cache.put(story.id, messages)
         return messages
     
     def deactivate(self, story: Story) -> None:
@@ -159,16 +860,69 @@ class StoryService:
             story (Story): The story to deactivate
         '''
         logger.info(f'Marking story {story.id} as ended')
+        speculator.discard(story.id)
+        story_context_cache.invalidate(story.id)
         story.is_end = True
-        story.save()
+        # text and the cover fields are written with queries, do not overwrite them
+        story.save(only=[Story.is_end])
     
-    async def start_story(self, story: Story, story_scenario: StoryScenario, user: User) -> tuple[Section, AIStoryResponse]:
+    async def generate_section_response(self, messages: list[dict], error_message: str,
+                                        on_progress: ProgressCallback | None = None,
+                                        priority: LLMPriority = LLMPriority.STORY) -> tuple[AIStoryResponse, int, int]:
+        '''
+        Call the LLM for a story section, retrying on unparsable responses.
+        
+        Args:
+            messages (list[dict]): Messages to send to the LLM
+            error_message (str): Message of the exception raised when every attempt fails
+            on_progress (ProgressCallback, optional): When given, the response is streamed
+                and the callback is awaited with the fields parsed so far
+            priority (LLMPriority, optional): Scheduling priority of the LLM requests
+            
+        Returns:
+            tuple[AIStoryResponse, int, int]: The parsed AI response, input tokens and output tokens
+        '''
+        story_format = response_format('story', STORY_RESPONSE_SCHEMA)
+        # a reply validated for hedging is not parsed (and counted in the repair metrics) again below
+        parse = lru_cache(maxsize=None)(story_parser)
+        # unparsable responses are repaired locally first, see utils.loads_llm_json
+        for i in range(3):
+            use_secondary_model = i >= 2
+            if use_secondary_model:
+                logger.warning('Using secondary model for LLM request')
+
+            if on_progress:
+                parser = StoryStreamParser()
+
+                async def on_content(content: str) -> None:
+                    await on_progress(parser.update(content))
+
+                content, input_tokens, output_tokens = await llm_stream(
+                    messages, on_content, use_secondary_model=use_secondary_model, priority=priority,
+                    response_format=story_format
+                )
+            else:
+                content, input_tokens, output_tokens = await llm(
+                    messages, use_secondary_model=use_secondary_model, priority=priority,
+                    validate=lambda content: parse(content) is not None, response_format=story_format
+                )
+
+            ai_response = parse(content)
+            if ai_response:
+                return ai_response, input_tokens, output_tokens
+            logger.warning('Failed to parse AI response, retrying...')
+
+        raise FailedToGenerateStoryException(error_message)
+
+    async def start_story(self, story: Story, story_scenario: StoryScenario, user: User,
+                          on_progress: ProgressCallback | None = None) -> tuple[Section, AIStoryResponse]:
         '''
         Start a new story with the given scenario.
         
         Args:
             story (Story): The story to start
             story_scenario (StoryScenario): The initial scenario for the story
+            on_progress (ProgressCallback, optional): Receives partial sections while streaming
             
         Returns:
             tuple[Section, AIStoryResponse]: The created section and parsed AI response
@@ -182,54 +936,110 @@ class StoryService:
         ]
         
         logger.debug('Calling LLM for initial story content')
-        for i in range(3):
-            if i < 2:
-                content, input_tokens, output_tokens = await llm(messages)
-            else:
-                logger.warning('Using secondary model for LLM request')
-                content, input_tokens, output_tokens = await llm(messages, use_secondary_model=True)
+        ai_response, input_tokens, output_tokens = await self.generate_section_response(
+            messages, 'Failed to generate initial story content', on_progress,
+            user_priority(user, LLMPriority.STORY)
+        )
+        usage = response_usage.get()
 
-            ai_response = story_parser(content)
-            if ai_response:
-                break
-            else:
-                logger.warning('Failed to parse AI response, retrying...')
-        else:
-            raise FailedToGenerateStoryException('Failed to generate initial story content')
+        request_cost = calculate_token_price(input_tokens, output_tokens, usage.model, usage.cached_tokens)
 
-        request_cost = calculate_token_price(input_tokens, output_tokens)
-        user.charge -= request_cost
-        user.save()
-        
-        # Link scenario to story
-        story_scenario.story = story
-        story_scenario.save()
-        
-        # Create sections
-        system_section = Section.create(
-            story=story,
-            text=STORY_PROMPT,
-            is_system=True
-        )
+        def persist() -> Section:
+            charge_user(user, request_cost)
+
+            # Link scenario to story
+            story_scenario.story = story
+            story_scenario.save()
+
+            # Create sections
+            Section.create(
+                story=story,
+                text='',
+                prompt=prompt_registry.version('story', STORY_PROMPT),
+                is_system=True
+            )
+
+            Section.create(
+                story=story,
+                text=scenario,
+                is_system=False
+            )
+
+            story.append_text(ai_response.story)
+            return Section.create(
+                story=story,
+                is_system=True,
+                **ai_response.section_fields,
+                model=usage.model,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                cached_tokens=usage.cached_tokens,
+                latency=usage.latency,
+                cost=request_cost
+            )
+
+        system_section = await run_db(persist)
+        usage_ledger.record(user, 'story', request_cost, input_tokens, output_tokens, usage.model, story, system_section)
+        if STORY_COVER_GENERATION:
+            visual_prompts.schedule(story, ai_response.is_end)
         
-        user_section = Section.create(
-            story=story,
-            text=scenario,
-            is_system=False
-        )
+        # same messages as_messages would build from the stored sections
+        history = [
+            {'role': 'system', 'content': STORY_PROMPT},
+            {'role': 'user', 'content': scenario},
+            {'role': 'assistant', 'content': ai_response.raw_data}
+        ]
+        story_context_cache.put(story.id, history)
         
-        system_section = Section.create(
-            story=story,
-            text=ai_response.raw_data,
-            is_system=True
-        )
+        if SPECULATIVE_GENERATION and not ai_response.is_end:
+            speculator.schedule(story, history, ai_response.options, usage)
         
         logger.info(f'Story {story.id} started successfully')
         return system_section, ai_response
 
+    def complete_story_text(self, story_id: int) -> str:
+        '''
+        Rebuild the text of a story from its sections if it misses some of them:
+        stories started before the text was kept, or played while that changed,
+        only have the sections added since. The cover prompt of a rebuilt story
+        is made again from the whole text. Blocking, runs on the database executor.
+        
+        Args:
+            story_id (int): The story
+            
+        Returns:
+            str: The full story text
+        '''
+        story = Story.select(Story.text, Story.text_sections).where(Story.id == story_id).get()
+        ai_sections = Section.select().where((Section.story == story_id) & (Section.is_system == True))
+        # the first system section is the system prompt, every other one an AI response
+        section_count = ai_sections.count() - 1
+        if story.text_sections >= section_count:
+            return story.text
+        
+        parts = []
+        query = ai_sections.select(Section.body, Section.text).order_by(Section.created_at, Section.id).offset(1)
+        for body, text in query.tuples():
+            if body is None:
+                # written before the parsed fields were kept, see cli.py backfill_sections
+                parsed_section = story_parser(text, record=False)
+                body = parsed_section.story if parsed_section else None
+            if body is not None:
+                parts.append(body + '\n')
+        full_story = ''.join(parts)
+        (
+            Story
+            .update(text=full_story, text_sections=section_count, visual_prompt=None, visual_prompt_chars=0)
+            # unless a section was added in the meantime
+            .where((Story.id == story_id) & (Story.text_sections == story.text_sections))
+            .execute()
+        )
+        logger.info(f'Rebuilt the text of story {story_id} from {section_count} sections')
+        return full_story
+
     async def get_full_story(self, story: Story) -> str:
         """
-        Retrieve the full story text for a given story by combining all its sections.
+        Retrieve the full story text for a given story, kept up to date as its sections are created.
         
         Args:
             story (Story): The story to retrieve the full story text for
@@ -237,17 +1047,7 @@ class StoryService:
         Returns:
             str: The full story text
         """
-        sections = Section.select().where(Section.story == story)
-        full_story = ''
-        for section in sections:
-            try:
-                parsed_section = story_parser(section.text)
-                if parsed_section:
-                    full_story += parsed_section.story + '\n'
-            except Exception:
-                pass
-        
-        return full_story
+        return await run_db(self.complete_story_text, story.id)
 
     async def generate_story_cover(self, story: Story, user: User | None = None) -> str:
         '''
@@ -261,16 +1061,21 @@ class StoryService:
             str: The path to the generated image
         '''
         logger.info(f'Generating cover for story {story.id}')
-        full_story = await self.get_full_story(story)
-        content, input_tokens, output_tokens = await generate_story_visual_prompt(full_story)
-        image_path = await generate_image_from_prompt(content)
+        await run_db(self.complete_story_text, story.id)
+        # usually prepared while the story was played, see VisualPromptBuilder
+        story = await visual_prompts.get(story)
+        if not story.visual_prompt:
+            raise FailedToGenerateImageException(f'Story {story.id} has no text to draw')
+        image_path = await generate_image_from_prompt(story.visual_prompt)
         logger.info(f'Generated cover image for story {story.id} at {image_path}')
         
-        request_cost = calculate_token_price(input_tokens, output_tokens)
+        input_tokens, output_tokens = story.visual_prompt_input_tokens, story.visual_prompt_output_tokens
+        request_cost = story.visual_prompt_cost + IMAGE_PRICE
         if not user:
-            user = story.user
-        user.charge -= request_cost + IMAGE_PRICE
-        user.save()
+            # charge_user mirrors the charge on the cached instance, which the freemium checks read
+            user = user_cache.get(story.user_id) or await run_db(lambda: story.user)
+        await run_db(charge_user, user, request_cost)
+        usage_ledger.record(user, 'cover', request_cost, input_tokens, output_tokens, IMAGE_MODEL, story)
         
         return image_path
 
@@ -305,7 +1110,8 @@ class StoryService:
         
         for scenario in _scenarios:
             scenarios.append(
-                StoryScenario.create(
+                await run_db(
+                    StoryScenario.create,
                     story=None,
                     text=scenario,
                     is_system=True
@@ -315,46 +1121,130 @@ class StoryService:
         logger.info(f'Generated {len(scenarios)} new AI scenarios')
         return scenarios
 
-    async def get_unused_scenarios(self, limit: int = 4) -> list[StoryScenario]:
+    def reserve_scenarios(self, user_id: int, limit: int = 4) -> list[StoryScenario]:
         '''
-        Get unused system-generated scenarios.
+        Atomically reserve unused system scenarios for a user.
+        
+        Reserved scenarios are hidden from everyone else for
+        ``SCENARIO_RESERVATION_TTL`` seconds; after that they return to the
+        pool without any cleanup. Scenarios previously offered to the same
+        user are released first.
         
         Args:
-            limit (int, optional): Maximum number of scenarios to return. Defaults to 4.
+            user_id (int): The user the scenarios are offered to
+            limit (int, optional): Maximum number of scenarios to reserve. Defaults to 4.
             
         Returns:
-            list[StoryScenario]: List of unused scenarios
+            list[StoryScenario]: The reserved scenarios
         '''
-        logger.debug(f'Retrieving up to {limit} unused scenarios')
+        now = datetime.now()
+        reserved_until = now + timedelta(seconds=SCENARIO_RESERVATION_TTL)
         
-        # Query for unused scenarios
-        query = (
+        candidates = (
             StoryScenario
-            .select()
-            .where(
-                (StoryScenario.story == None) &
-                (StoryScenario.is_system == True)
-            )
-            .limit(100)
+            .select(StoryScenario.id)
+            .where(StoryScenario.available(now))
+            .order_by(fn.Random())
+            .limit(limit)
         )
-        scenarios = list(query)
+        # SQLite runs one writer at a time, so the UPDATE below is already exclusive there
+        if not USE_SQLITE:
+            candidates = candidates.for_update(skip_locked=True)
+        
+        with db.atomic():
+            (StoryScenario
+             .update(reserved_by=None, reserved_until=None)
+             .where(StoryScenario.story.is_null() & (StoryScenario.reserved_by == user_id))
+             .execute())
+            (StoryScenario
+             .update(reserved_by=user_id, reserved_until=reserved_until)
+             .where(StoryScenario.id.in_(candidates) & StoryScenario.available(now))
+             .execute())
+            return list(
+                StoryScenario
+                .select()
+                .where(
+                    (StoryScenario.story.is_null()) &
+                    (StoryScenario.reserved_by == user_id) &
+                    (StoryScenario.reserved_until == reserved_until)
+                )
+            )
+    
+    def claim_scenario(self, scenario_id: int, user_id: int) -> StoryScenario | None:
+        '''
+        Claim a scenario the user picked and release the others offered with it.
+        
+        Args:
+            scenario_id (int): ID of the picked scenario
+            user_id (int): The user picking it
+            
+        Returns:
+            StoryScenario | None: The scenario, or None if it was already used or is
+                reserved by someone else
+        '''
+        now = datetime.now()
+        with db.atomic():
+            claimed = (
+                StoryScenario
+                .update(reserved_by=user_id, reserved_until=now + timedelta(seconds=SCENARIO_RESERVATION_TTL))
+                .where(
+                    (StoryScenario.id == scenario_id) &
+                    (StoryScenario.story.is_null()) &
+                    (
+                        (StoryScenario.reserved_by == user_id) |
+                        (StoryScenario.reserved_until.is_null()) |
+                        (StoryScenario.reserved_until < now)
+                    )
+                )
+                .execute()
+            )
+            if not claimed:
+                logger.info(f'Scenario {scenario_id} is no longer available for user {user_id}')
+                return None
+            
+            (StoryScenario
+             .update(reserved_by=None, reserved_until=None)
+             .where(
+                 (StoryScenario.story.is_null()) &
+                 (StoryScenario.reserved_by == user_id) &
+                 (StoryScenario.id != scenario_id)
+             )
+             .execute())
+            return StoryScenario.get_by_id(scenario_id)
+    
+    async def get_unused_scenarios(self, user_id: int, limit: int = 4) -> list[StoryScenario]:
+        '''
+        Reserve unused system-generated scenarios for a user.
         
-        # Generate new scenarios if needed
+        Never calls the LLM: when the pool runs dry a background refill is
+        requested and whatever could be reserved right now is returned.
+        
+        Args:
+            user_id (int): The user the scenarios are offered to
+            limit (int, optional): Maximum number of scenarios to return. Defaults to 4.
+            
+        Returns:
+            list[StoryScenario]: List of reserved scenarios, possibly fewer than ``limit``
+        '''
+        logger.debug(f'Reserving up to {limit} unused scenarios for user {user_id}')
+        scenarios = await run_db(self.reserve_scenarios, user_id, limit)
+        
+        # Top the pool up in the background if needed
         if len(scenarios) < limit:
-            logger.info(f'Only {len(scenarios)} scenarios available, generating more')
-            scenarios = await self.generate_ai_scenarios()
+            logger.info(f'Only {len(scenarios)} scenarios available, requesting a refill')
+            scenario_pool.refill()
         
-        # Randomize and limit results
-        random.shuffle(scenarios)
-        return scenarios[:limit]
+        return scenarios
 
-    async def create_section(self, user: User, story: Story, choice: int) -> tuple[Section, AIStoryResponse]:
+    async def create_section(self, user: User, story: Story, choice: int,
+                             on_progress: ProgressCallback | None = None) -> tuple[Section, AIStoryResponse]:
         '''
         Create a new section in the story based on user choice.
         
         Args:
             story (Story): The story to add a section to
             choice (int): The user's choice number
+            on_progress (ProgressCallback, optional): Receives partial sections while streaming
             
         Returns:
             tuple[Section, AIStoryResponse]: The created section and parsed AI response
@@ -362,46 +1252,62 @@ class StoryService:
         logger.info(f'Creating new section for story {story.id} with choice {choice}')
         
         # Prepare messages for LLM
-        messages = self.as_messages(story)
+        messages = await run_db(self.as_messages, story)
         messages.append({
             'role': 'user',
             'content': str(choice)
         })
         
-        # Get AI response
-        logger.debug('Calling LLM for next story section')
-        for i in range(3):
-            if i < 2:
-                content, input_tokens, output_tokens = await llm(messages)
-            else:
-                logger.warning('Using secondary model for LLM request')
-                content, input_tokens, output_tokens = await llm(messages, use_secondary_model=True)
-
-            ai_response = story_parser(content)
-            if ai_response:
-                break
-            else:
-                logger.warning('Failed to parse AI response, retrying...')
+        # Get AI response, preferring a branch generated while the user was reading
+        speculated = await speculator.take(story, choice) if SPECULATIVE_GENERATION else None
+        if speculated:
+            ai_response, input_tokens, output_tokens, usage = speculated
         else:
-            raise FailedToGenerateStoryException('Failed to generate story section content')
+            logger.debug('Calling LLM for next story section')
+            ai_response, input_tokens, output_tokens = await self.generate_section_response(
+                messages, 'Failed to generate story section content', on_progress,
+                user_priority(user, LLMPriority.STORY)
+            )
+            usage = response_usage.get()
         
-        request_cost = calculate_token_price(input_tokens, output_tokens)
-        user.charge -= request_cost
-        user.save()
+        request_cost = calculate_token_price(input_tokens, output_tokens, usage.model, usage.cached_tokens)
         logger.debug(f'Story end status: {ai_response.is_end}')
 
-        # Create sections in database
-        user_section = Section.create(
-            story=story,
-            text=str(choice),
-            is_system=False
-        )
-        
-        system_section = Section.create(
-            story=story,
-            text=ai_response.raw_data,
-            is_system=True
-        )
+        def persist() -> Section:
+            charge_user(user, request_cost)
+
+            # Create sections in database
+            Section.create(
+                story=story,
+                text=str(choice),
+                is_system=False
+            )
+
+            story.append_text(ai_response.story)
+            return Section.create(
+                story=story,
+                is_system=True,
+                **ai_response.section_fields,
+                model=usage.model,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                cached_tokens=usage.cached_tokens,
+                latency=usage.latency,
+                cost=request_cost
+            )
+
+        system_section = await run_db(persist)
+        usage_ledger.record(user, 'section', request_cost, input_tokens, output_tokens, usage.model, story, system_section)
+        if STORY_COVER_GENERATION:
+            visual_prompts.schedule(story, ai_response.is_end)
+
+        messages.append({'role': 'assistant', 'content': ai_response.raw_data})
+        if ai_response.is_end:
+            story_context_cache.invalidate(story.id)
+        else:
+            story_context_cache.put(story.id, messages)
+            if SPECULATIVE_GENERATION:
+                speculator.schedule(story, messages, ai_response.options, usage)
 
         return system_section, ai_response
 
@@ -455,17 +1361,17 @@ class StoryService:
             Section | None: The retrieved section or None if not found
         '''
         logger.debug(f'Looking for unused section with ID: {section_id}')
-        section = (
+        query = (
             Section
-            .select()
+            .select(Section, Story)
             .join(Story)
             .where(
                 (Section.id == section_id) &
                 (Section.used == False) &
                 (Story.is_end == False)
             )
-            .get_or_none()
         )
+        section = await run_db(query.get_or_none)
         
         if section:
             logger.debug(f'Found unused section: {section_id}')
@@ -482,8 +1388,14 @@ class StoryService:
             user (User): The user whose stories to deactivate
         '''
         logger.info(f'Deactivating all active stories for user: {user.user_id}')
-        query = Story.update(is_end=True).where((Story.user == user) & (Story.is_end == False))
-        affected_rows = query.execute()
+        speculator.discard_user(user.user_id)
+
+        def deactivate() -> int:
+            active = Story.select(Story.id).where((Story.user == user) & (Story.is_end == False))
+            story_context_cache.invalidate(*[story.id for story in active])
+            return Story.update(is_end=True).where((Story.user == user) & (Story.is_end == False)).execute()
+
+        affected_rows = await run_db(deactivate)
         logger.info(f'Deactivated {affected_rows} stories for user: {user.user_id}')
 
     async def damage_report(self, user: User) -> tuple[int,int,float]:
@@ -499,19 +1411,22 @@ class StoryService:
         logger.info(f'Calculating damage report for user: {user.user_id}')
         
         # Count active stories
-        stories_count = Story.select().where(Story.user == user).count()
+        stories_count = await run_db(Story.select().where(Story.user == user).count)
 
-        section_count = (
+        section_count = await run_db(
             Section
             .select(fn.COUNT(Section.id))
             .join(Story)
             .join(User)
             .where(User.user_id == user.user_id)
-            .scalar()
-        )        
+            .scalar
+        )
+        
+        # the cached user may lag behind charges made by other processes
+        charge = await run_db(User.select(User.charge).where(User.user_id == user.user_id).scalar)
         
         logger.info(f'Damage report for user {user.user_id}')
-        return stories_count, section_count, user.charge
+        return stories_count, section_count, charge
 
 
 class ChatService:
@@ -530,7 +1445,7 @@ class ChatService:
             list[Chat]: The chat history
         '''
         logger.info(f'Getting session history for session {session.id}')
-        return session.chat_histories()
+        return await run_db(session.chat_histories)
     
     async def __start_new_session(self, user: User) -> Session:
         # deactivate previous session
@@ -544,27 +1459,26 @@ class ChatService:
             Session: The newly created session
         '''
         logger.info(f'Starting new session for user {user.user_id}')
-        Session.update(active=False).where(Session.user == user).execute()
+        await run_db(Session.update(active=False).where(Session.user == user).execute)
         
-        query = Chat.select().where(
-            (Chat.user == user) &
-            (Chat.is_system == False) &
-            (Chat.created_at > datetime.now() - timedelta(hours=24))
-        )
         # if freemium user has reached the maximum daily chat message limit
-        if  user.charge < 0.0 and query.count() >= MAX_DAILY_CHAT_MESSAGE:
+        if  user.charge < 0.0 and await run_db(daily_chat_messages.count, user.user_id) >= MAX_DAILY_CHAT_MESSAGE:
             logger.info(f'User {user.user_id} has reached the maximum daily chat message limit.')
             raise DailyChatLimitExceededException(f'User {user.user_id} has reached the maximum daily chat message limit.')
         
-        # create new session
-        session = Session.create(user=user)
-        chat = Chat.create(
-            session=session,
-            user=user,
-            text=CHAT_PROMPT,
-            is_system=True
-        )
-        return session
+        def persist() -> Session:
+            # create new session
+            session = Session.create(user=user)
+            Chat.create(
+                session=session,
+                user=user,
+                text='',
+                prompt=prompt_registry.version('chat', CHAT_PROMPT),
+                is_system=True
+            )
+            return session
+
+        return await run_db(persist)
 
     async def __get_current_session(self, user: User) -> Session | None:
         '''
@@ -578,10 +1492,8 @@ class ChatService:
         '''
 
         logger.info(f'Getting current session for user {user.user_id}')
-        session = Session.select().where((Session.user == user) & (Session.active == True))
-        if session.exists():
-            return session.get()
-        return None
+        query = Session.select().where((Session.user == user) & (Session.active == True))
+        return await run_db(query.first)
 
     async def __chat_history_as_messages(self, session: Session) -> list[dict]:
         '''
@@ -598,9 +1510,12 @@ class ChatService:
         messages = []
         for index, message in enumerate(chat_histories):
             if message.is_system:
+                content = message.text
+                if message.prompt_id is not None:
+                    content = await run_db(prompt_registry.text, message.prompt_id)
                 messages.append({
                     'role': 'assistant' if index else 'system',
-                    'content': message.text
+                    'content': content
                 })
             else:
                 messages.append({
@@ -620,7 +1535,7 @@ class ChatService:
         session = await self.__get_current_session(user)
         if session:
             session.active = False
-            session.save()
+            await run_db(session.save)
 
     async def chat(self, user: User, text: str) -> AIChatResponse:
         '''
@@ -649,7 +1564,7 @@ class ChatService:
         if len(messages) > MAX_SESSION_MESSAGES:
             logger.warning(f'Session {session.id} has more than {MAX_SESSION_MESSAGES} messages!, deactivating session')
             session.active = False
-            session.save()
+            await run_db(session.save)
 
         messages.append({
             'role': 'user',
@@ -657,14 +1572,23 @@ class ChatService:
         })
 
         logger.info(f'Sending messages to LLM for processing')
+        priority = user_priority(user, LLMPriority.CHAT)
+        chat_format = response_format('chat', CHAT_RESPONSE_SCHEMA)
+        # a reply validated for hedging is not parsed (and counted in the repair metrics) again below
+        parse = lru_cache(maxsize=None)(ai_chat_parser)
         for i in range(3):
             if i < 2:
-                content, input_tokens, output_tokens = await llm(messages)
+                content, input_tokens, output_tokens = await llm(
+                    messages, priority=priority, validate=lambda content: parse(content) is not None,
+                    response_format=chat_format
+                )
             else:
                 logger.warning('Using secondary model for LLM request')
-                content, input_tokens, output_tokens = await llm(messages, use_secondary_model=True)
+                content, input_tokens, output_tokens = await llm(
+                    messages, use_secondary_model=True, priority=priority, response_format=chat_format
+                )
 
-            ai_response = ai_chat_parser(content)
+            ai_response = parse(content)
             if ai_response:
                 break
             else:
@@ -672,62 +1596,509 @@ class ChatService:
         else:
             raise FailedToGenerateChatException('Failed to generate chat response')
 
-        request_cost = calculate_token_price(input_tokens, output_tokens)
-        user.charge -= request_cost
-        user.save()
-        
-        Chat.create(session=session, user=user, text=text, is_system=False)
-        Chat.create(session=session, user=user, text=content, is_system=True)
+        usage = response_usage.get()
+        request_cost = calculate_token_price(input_tokens, output_tokens, usage.model, usage.cached_tokens)
+
+        def persist() -> None:
+            charge_user(user, request_cost)
+            message = Chat.create(session=session, user=user, text=text, is_system=False)
+            daily_chat_messages.record(user.user_id, message.created_at)
+            Chat.create(
+                session=session,
+                user=user,
+                text=content,
+                is_system=True,
+                model=usage.model,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                cached_tokens=usage.cached_tokens,
+                latency=usage.latency,
+                cost=request_cost
+            )
+
+        await run_db(persist)
+        usage_ledger.record(user, 'chat', request_cost, input_tokens, output_tokens, usage.model)
 
         return ai_response
 
 
+class ScenarioPool:
+    '''
+    Keeps a stock of unused AI scenarios so users never wait for scenario generation.
+    
+    Refills run in the background and are single-flight: concurrent requests
+    share the refill already in progress instead of starting their own.
+    '''
+    
+    def __init__(self, story_service: StoryService):
+        self.story_service = story_service
+        self._refill_task: asyncio.Task | None = None
+    
+    async def size(self) -> int:
+        query = StoryScenario.select().where(StoryScenario.available())
+        return await run_db(query.count)
+    
+    async def _refill(self) -> None:
+        available = await self.size()
+        while available < SCENARIO_POOL_TARGET:
+            logger.info(f'Scenario pool has {available} scenarios, refilling to {SCENARIO_POOL_TARGET}')
+            scenarios = await self.story_service.generate_ai_scenarios()
+            if not scenarios:
+                logger.warning('Scenario generation returned nothing, stopping refill')
+                break
+            available += len(scenarios)
+    
+    def refill(self) -> asyncio.Task:
+        '''
+        Start a refill, or return the one already running.
+        
+        Returns:
+            asyncio.Task: The in-flight refill
+        '''
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+            self._refill_task.add_done_callback(self._log_refill_error)
+        return self._refill_task
+    
+    async def top_up(self) -> None:
+        '''Refill if the pool is below the low watermark and wait for it.'''
+        if await self.size() < SCENARIO_POOL_LOW_WATERMARK:
+            try:
+                await self.refill()
+            except Exception:
+                # already logged by _log_refill_error
+                pass
+    
+    @staticmethod
+    def _log_refill_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logger.error(f'Scenario pool refill failed: {task.exception()}')
+
+
 user_service = UserService()
+scenario_pool = ScenarioPool(StoryService())
 
 
-def user_lock(user):
-    """Locks the user session by setting the 'is_processing' flag to True.
+def cover_images_in_use() -> set[str]:
+    '''Images of covers not sent yet; sent ones are resent by file_id.'''
+    query = (
+        CoverJob
+        .select(CoverJob.image_path)
+        .join(Story)
+        .where(CoverJob.image_path.is_null(False) & Story.cover_file_id.is_null())
+    )
+    return {image_path for image_path, in query.tuples()}
 
-    Args:
-        user (str): The identifier of the user to be locked.
 
-    Side Effects:
-        Updates the global `session` dictionary.
-    """
-    session[user]['is_processing'] = True
-    logger.info(f'User {user} has been locked for processing.')
+async def evict_cover_images() -> tuple[int, int]:
+    '''Keep the image store under its quota, see ``ImageStore.evict``.'''
+    keep = await run_db(cover_images_in_use)
+    # scanning the store is file system work, it does not hold up database queries
+    return await asyncio.to_thread(image_store.evict, keep)
 
 
-def user_unlock(user):
-    """Unlocks the user session by setting the 'is_processing' flag to False.
+class CoverQueue:
+    '''
+    Persistent queue of story covers, generated and sent in the background.
+    
+    Jobs are rows of ``CoverJob``, so they survive restarts and every bot
+    process can work on them. A claimed job is leased for ``lease`` seconds;
+    its worker gives up before the lease ends, and when the worker dies
+    another one takes the job over after the lease. At most
+    ``concurrency`` covers are generated at once in each process and failed
+    jobs are retried, each time a little later, up to ``max_attempts`` times.
+    
+    Covers are sent with ``deliver``, set by the application, which returns
+    the Telegram file_id of the photo. It is stored on the story so the cover
+    is never uploaded twice, and its image may then be evicted from the
+    image store.
+    '''
+    
+    def __init__(self, story_service: StoryService, concurrency: int, max_attempts: int,
+                 lease: float, retry_delay: float):
+        self.story_service = story_service
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.deliver: Callable[[int, str | Path], Awaitable[str]] | None = None
+        self.running: dict[asyncio.Task, int] = {}
+        self.polling = asyncio.Lock()
+        self.evicting = asyncio.Lock()
+        self.metrics = {
+            'enqueued': 0,
+            'sent': 0,
+            'retried': 0,
+            'failed': 0,
+            'uploads_saved': 0,
+        }
+    
+    async def submit(self, story: Story, chat_id: int) -> None:
+        '''
+        Queue the cover of a story; a story only ever gets one cover job.
+        
+        Args:
+            story (Story): The story to draw a cover for
+            chat_id (int): Chat the cover is sent to
+        '''
+        await run_db(CoverJob.insert(story=story, chat_id=chat_id).on_conflict_ignore().execute)
+        self.metrics['enqueued'] += 1
+        self.wake()
+    
+    def wake(self) -> None:
+        asyncio.ensure_future(self.poll())
+    
+    def _claim(self, limit: int) -> list[CoverJob]:
+        now = datetime.now()
+        due = CoverJob.status.in_(('pending', 'running')) & (CoverJob.run_after <= now)
+        claimed = []
+        for job in CoverJob.select().where(due).order_by(CoverJob.run_after).limit(limit):
+            # another process may have claimed the job since it was selected
+            updated = (
+                CoverJob
+                .update(status='running', attempts=CoverJob.attempts + 1,
+                        run_after=now + timedelta(seconds=self.lease))
+                .where((CoverJob.id == job.id) & due)
+                .execute()
+            )
+            if updated:
+                job.attempts += 1
+                claimed.append(job)
+        return claimed
+    
+    async def poll(self) -> None:
+        '''Start due jobs while fewer than ``concurrency`` covers are in progress here.'''
+        if self.deliver is None:
+            return None
+        async with self.polling:
+            free = self.concurrency - len(self.running)
+            if free <= 0:
+                return None
+            try:
+                jobs = await run_db(self._claim, free)
+            except Exception as e:
+                # the jobs stay in the table, the next poll picks them up
+                logger.warning(f'Failed to claim cover jobs: {e}')
+                return None
+            for job in jobs:
+                task = asyncio.create_task(self._run(job))
+                self.running[task] = job.id
+                task.add_done_callback(self._done)
+    
+    def _done(self, task: asyncio.Task) -> None:
+        self.running.pop(task, None)
+        if not task.cancelled():
+            self.wake()
+    
+    async def _run(self, job: CoverJob) -> None:
+        try:
+            # given up before the lease ends, so another worker never takes over a job
+            # (and draws and charges the cover again) while this one still works on it
+            async with asyncio.timeout(self.lease * 0.9):
+                story = await run_db(Story.get_by_id, job.story_id)
+                if story.cover_file_id:
+                    photo = story.cover_file_id
+                    self.metrics['uploads_saved'] += 1
+                else:
+                    if not (job.image_path and os.path.exists(job.image_path)):
+                        job.image_path = await self.story_service.generate_story_cover(story)
+                        await run_db(CoverJob.update(image_path=job.image_path).where(CoverJob.id == job.id).execute)
+                    photo = Path(job.image_path)
+                file_id = await self.deliver(job.chat_id, photo)
+        except Exception as e:
+            given_up = job.attempts >= self.max_attempts
+            logger.exception(f'Cover for story {job.story_id} failed (attempt {job.attempts}): {e}')
+            self.metrics['failed' if given_up else 'retried'] += 1
+            await run_db(
+                CoverJob
+                .update(status='failed' if given_up else 'pending', error=str(e),
+                        run_after=datetime.now() + timedelta(seconds=self.retry_delay * 2 ** job.attempts))
+                .where(CoverJob.id == job.id)
+                .execute
+            )
+            return None
+        
+        def finish() -> None:
+            with db.atomic():
+                Story.update(cover_file_id=file_id).where(Story.id == job.story_id).execute()
+                CoverJob.update(status='done', error=None).where(CoverJob.id == job.id).execute()
+        
+        await run_db(finish)
+        self.metrics['sent'] += 1
+        logger.info(f'Sent cover of story {job.story_id} to chat {job.chat_id}')
+        # the image just sent may be evicted now that Telegram has it
+        if image_store.eviction_due and not self.evicting.locked():
+            async with self.evicting:
+                try:
+                    await evict_cover_images()
+                except Exception as e:
+                    logger.warning(f'Failed to evict cover images: {e}')
+    
+    async def stop(self) -> None:
+        '''Cancel the covers in progress and hand their jobs back to the queue.'''
+        jobs = list(self.running.values())
+        for task in list(self.running):
+            task.cancel()
+        await asyncio.gather(*self.running, return_exceptions=True)
+        if jobs:
+            await run_db(
+                CoverJob
+                .update(status='pending', attempts=CoverJob.attempts - 1, run_after=datetime.now())
+                .where(CoverJob.id.in_(jobs) & (CoverJob.status == 'running'))
+                .execute
+            )
+    
+    async def pending(self) -> int:
+        query = CoverJob.select().where(CoverJob.status.in_(('pending', 'running')))
+        return await run_db(query.count)
 
-    Args:
-        user (str): The identifier of the user to be unlocked.
 
-    Side Effects:
-        Updates the global `session` dictionary.
-    """
-    session[user]['is_processing'] = False
-    logger.info(f'User {user} has been unlocked.')
+cover_queue = CoverQueue(StoryService(), COVER_CONCURRENCY, COVER_MAX_ATTEMPTS, COVER_JOB_LEASE, COVER_POLL_INTERVAL)
 
 
-def is_user_lock(user):
-    """Checks if the user session is currently locked.
+class MemoryLockBackend:
+    '''
+    Per-user processing locks held in this process.
+    
+    A lock is a lease: it is released by its holder, or considered abandoned
+    after ``ttl`` seconds so a crashed handler cannot block a user forever.
+    Only locked users have an entry, and at most ``max_entries`` of them.
+    '''
+    
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (token, expiry on the monotonic clock)
+        self.leases: dict[int, tuple[str, float]] = {}
+    
+    def _expire(self, now: float) -> list[int]:
+        expired = [key for key, (_, expires_at) in self.leases.items() if expires_at <= now]
+        for key in expired:
+            del self.leases[key]
+        return expired
+    
+    async def acquire(self, key: int) -> str | None:
+        '''
+        Try to lock ``key`` without waiting.
+        
+        Args:
+            key (int): The user id
+            
+        Returns:
+            str | None: Token needed to release the lock, or None if it is held
+        '''
+        now = time.monotonic()
+        lease = self.leases.get(key)
+        if lease and lease[1] > now:
+            return None
+        if lease:
+            logger.warning(f'Lock of user {key} expired, taking it over')
+        elif len(self.leases) >= self.max_entries:
+            self._expire(now)
+            if len(self.leases) >= self.max_entries:
+                logger.error(f'{len(self.leases)} users locked, refusing to lock user {key}')
+                return None
+        
+        token = uuid.uuid4().hex
+        self.leases[key] = (token, now + self.ttl)
+        return token
+    
+    async def release(self, key: int, token: str) -> None:
+        '''Release the lock of ``key`` if ``token`` still holds it.'''
+        lease = self.leases.get(key)
+        if lease and lease[0] == token:
+            del self.leases[key]
+    
+    async def is_locked(self, key: int) -> bool:
+        lease = self.leases.get(key)
+        return bool(lease) and lease[1] > time.monotonic()
 
-    Args:
-        user (str): The identifier of the user.
 
-    Returns:
-        bool: True if the user session is locked, False otherwise.
-    """
-    return session[user]['is_processing']
+class DatabaseLockBackend:
+    '''
+    Per-user processing locks stored in the ``userlock`` table, shared by every
+    bot process using the database (SQLite or PostgreSQL).
+    
+    Rows carry an expiry, so the lock of a crashed process is taken over
+    after ``ttl`` seconds.
+    '''
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+    
+    def _acquire(self, key: int) -> str | None:
+        now = datetime.now()
+        token = uuid.uuid4().hex
+        try:
+            with db.atomic():
+                # only locked users have rows, so clearing abandoned leases is cheap
+                UserLock.delete().where(UserLock.expires_at <= now).execute()
+                UserLock.create(key=key, token=token, expires_at=now + timedelta(seconds=self.ttl))
+            return token
+        except IntegrityError:
+            return None
+    
+    async def acquire(self, key: int) -> str | None:
+        return await run_db(self._acquire, key)
+    
+    async def release(self, key: int, token: str) -> None:
+        await run_db(UserLock.delete().where((UserLock.key == key) & (UserLock.token == token)).execute)
+    
+    async def is_locked(self, key: int) -> bool:
+        return await run_db(
+            UserLock.select().where((UserLock.key == key) & (UserLock.expires_at > datetime.now())).exists
+        )
+
+
+class PostgresAdvisoryLockBackend(MemoryLockBackend):
+    '''
+    Per-user processing locks shared between processes through PostgreSQL
+    advisory locks.
+    
+    The advisory locks are held by one dedicated connection, so PostgreSQL
+    releases all of them when the process dies. Leases are tracked in memory
+    as well, since advisory locks are re-entrant within a connection.
+    '''
+    
+    def __init__(self, ttl: float, max_entries: int):
+        super().__init__(ttl, max_entries)
+        # one connection shared by the executor threads, guarded by lock_guard
+        self.lock_db = PostgresqlDatabase(db.database, thread_safe=False, **db.connect_params)
+        self.lock_guard = threading.Lock()
+    
+    def _query(self, sql: str, key: int) -> bool:
+        with self.lock_guard:
+            self.lock_db.connect(reuse_if_open=True)
+            return self.lock_db.execute_sql(sql, (key,)).fetchone()[0]
+    
+    def _expire(self, now: float) -> list[int]:
+        expired = super()._expire(now)
+        for key in expired:
+            asyncio.ensure_future(run_db(self._query, 'SELECT pg_advisory_unlock(%s)', key))
+        return expired
+    
+    async def acquire(self, key: int) -> str | None:
+        # an expired lease of this process still holds the advisory lock
+        held = key in self.leases
+        token = await super().acquire(key)
+        if token is None or held:
+            return token
+        if not await run_db(self._query, 'SELECT pg_try_advisory_lock(%s)', key):
+            del self.leases[key]
+            return None
+        return token
+    
+    async def release(self, key: int, token: str) -> None:
+        lease = self.leases.get(key)
+        if lease and lease[0] == token:
+            del self.leases[key]
+            await run_db(self._query, 'SELECT pg_advisory_unlock(%s)', key)
+    
+    async def is_locked(self, key: int) -> bool:
+        if await super().is_locked(key):
+            return True
+        if not await run_db(self._query, 'SELECT pg_try_advisory_lock(%s)', key):
+            return True
+        await run_db(self._query, 'SELECT pg_advisory_unlock(%s)', key)
+        return False
+
+
+if LOCK_BACKEND == 'postgres' and not USE_SQLITE:
+    user_locks = PostgresAdvisoryLockBackend(LOCK_TTL, LOCK_MAX_ENTRIES)
+elif LOCK_BACKEND in ('database', 'postgres'):
+    user_locks = DatabaseLockBackend(LOCK_TTL)
+else:
+    user_locks = MemoryLockBackend(LOCK_TTL, LOCK_MAX_ENTRIES)
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    '''
+    Handles updates of different users concurrently and updates of the same
+    user one after another, in the order they arrived.
+    
+    A user with ``max_queued`` updates already waiting has further updates
+    dropped. Only running updates hold one of the ``max_concurrent_updates``
+    slots, never updates waiting for their user, so users flooding the bot
+    cannot take every slot.
+    
+    Written against python-telegram-bot 22.8 (pinned in requirements.txt):
+    ``BaseUpdateProcessor.process_update`` takes a slot of its own before
+    calling ``do_process_update``, for waiting and dropped updates as well,
+    so that limit is set out of reach and the slots are taken here instead.
+    '''
+    
+    def __init__(self, max_concurrent_updates: int, max_queued: int):
+        # PTB's own slots never run out, self.slots bounds the running updates
+        super().__init__(sys.maxsize)
+        self.max_queued = max_queued
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.running = 0
+        # user id -> [lock held while an update of the user runs, updates running or waiting]
+        self.users: dict[int, list] = {}
+        self.metrics = {
+            'processed': 0,
+            'dropped': 0,
+        }
+    
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self.running
+    
+    @staticmethod
+    def user_key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+    
+    async def run(self, coroutine: Awaitable) -> None:
+        async with self.slots:
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = self.user_key(update)
+        if key is None:
+            return await self.run(coroutine)
+        
+        state = self.users.setdefault(key, [asyncio.Lock(), 0])
+        if state[1] >= self.max_queued:
+            self.metrics['dropped'] += 1
+            logger.warning(f'User {key} has {state[1]} updates queued, dropping update {getattr(update, "update_id", None)}')
+            coroutine.close()
+            return None
+        
+        state[1] += 1
+        try:
+            # asyncio locks are first come, first served
+            async with state[0]:
+                await self.run(coroutine)
+            self.metrics['processed'] += 1
+        finally:
+            state[1] -= 1
+            if not state[1]:
+                del self.users[key]
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
 
 
 def asession_lock(func, only_private=True):
     """Decorator that prevents concurrent execution of an async function 
     for the same user by implementing a session lock.
 
-    If the user is already processing another request, the function call is skipped.
+    Updates of one user already arrive one at a time (see ``UserOrderedUpdateProcessor``);
+    the lock guards against another bot process handling the same user. If the user
+    is already processing another request, the function call is skipped.
 
     Args:
         func (Callable): The async function to be wrapped.
@@ -736,8 +2107,8 @@ def asession_lock(func, only_private=True):
         Callable: The wrapped async function with session locking.
 
     Side Effects:
-        - Locks the user before execution.
-        - Unlocks the user after execution.
+        - Locks the user in ``user_locks`` before execution.
+        - Unlocks the user after execution, even if it raised.
     """
     @wraps(func)
     async def wrapped(update, *args, **kwargs):
@@ -745,20 +2116,24 @@ def asession_lock(func, only_private=True):
             logger.info(f'Ignored non-private message')
             return None
         
-        user = user_service.get_user(
+        user = await user_service.aget_user(
             update.effective_user.id,
             update.effective_user.username,
             update.effective_user.first_name,
             update.effective_user.last_name
         )
 
-        if is_user_lock(user):
+        token = await user_locks.acquire(user.user_id)
+        if token is None:
             logger.warning(f'User {user} is already locked, skipping execution.')
             return None
         
-        user_lock(user)
-        await func(update, *args, user=user, **kwargs)
-        user_unlock(user)
+        logger.info(f'User {user} has been locked for processing.')
+        try:
+            await func(update, *args, user=user, **kwargs)
+        finally:
+            await user_locks.release(user.user_id, token)
+            logger.info(f'User {user} has been unlocked.')
 
     return wrapped
 
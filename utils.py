@@ -2,13 +2,14 @@ import json
 from dataclasses import dataclass
 import logging
 import enum
+import re
 
 from telegram import Bot, InlineKeyboardMarkup
 
-from core import llm
+from core import llm, LLMPriority
 from prompts import GENERATE_CRIME_STORY_SCENARIOS_PROMPT
-from config import INPUT_TOKEN_PRICE, OUTPUT_TOKEN_PRICE, BOT_TOKEN, BASE_URL
-from models import User
+from config import INPUT_TOKEN_PRICE, OUTPUT_TOKEN_PRICE, CACHED_INPUT_TOKEN_PRICE, MODEL_PRICES, BOT_TOKEN, BASE_URL, LLM_RESPONSE_FORMAT
+from models import User, run_db
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +26,24 @@ class AIStoryResponse:
     is_end: bool
     raw_data: str
 
+    @property
+    def section_fields(self) -> dict:
+        """Values of the ``Section`` columns that store this response."""
+        return {
+            'text': self.raw_data,
+            'title': self.title,
+            'body': self.story,
+            'options': {str(option.id): option.text for option in self.options},
+            'is_end': self.is_end,
+        }
+
+@dataclass
+class PartialStoryResponse:
+    title: str | None = None
+    story: str | None = None
+    options: list[Option] | None = None
+    is_end: bool | None = None
+
 class ChatCommand(enum.Enum):
     CHAT_TEXT = 'CHAT_TEXT'
     SEND_AI_SCENARIO = 'SEND_AI_SCENARIO'
@@ -36,19 +55,51 @@ class AIChatResponse:
     COMMAND: ChatCommand
     TEXT: str
 
+STORY_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'title': {'type': 'string'},
+        'story': {'type': 'string'},
+        'options': {'type': 'object', 'additionalProperties': {'type': 'string'}},
+        'is_end': {'type': 'boolean'},
+    },
+    'required': ['title', 'story', 'options', 'is_end'],
+}
+
+CHAT_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'COMMAND': {'type': 'string', 'enum': [command.value for command in ChatCommand]},
+        'TEXT': {'type': 'string'},
+    },
+    'required': ['COMMAND', 'TEXT'],
+}
 
-def calculate_token_price(input_tokens: int, output_tokens: int) -> float:
+json_repair_metrics = {
+    'parsed': 0,
+    'repaired': 0,
+    'failed': 0,
+}
+
+
+def calculate_token_price(input_tokens: int, output_tokens: int, model: str | None = None,
+                          cached_tokens: int = 0) -> float:
     """Calculates the total token price based on input and output token usage.
 
     Args:
-        input_tokens (int): Number of input tokens.
+        input_tokens (int): Number of input tokens, cached ones included.
         output_tokens (int): Number of output tokens.
+        model (str | None): The model that answered, priced from ``MODEL_PRICES`` when listed there.
+        cached_tokens (int): Input tokens served from the provider's prompt cache.
 
     Returns:
         float: The total calculated price.
     """
-    input_cost = (input_tokens * INPUT_TOKEN_PRICE) / 1_000_000
-    output_cost = (output_tokens * OUTPUT_TOKEN_PRICE) / 1_000_000
+    input_price, output_price, cached_price = MODEL_PRICES.get(
+        model, (INPUT_TOKEN_PRICE, OUTPUT_TOKEN_PRICE, CACHED_INPUT_TOKEN_PRICE)
+    )
+    input_cost = ((input_tokens - cached_tokens) * input_price + cached_tokens * cached_price) / 1_000_000
+    output_cost = (output_tokens * output_price) / 1_000_000
     return input_cost + output_cost
 
 async def generate_crime_story_scenarios() -> list[str]:
@@ -61,23 +112,137 @@ async def generate_crime_story_scenarios() -> list[str]:
         {'role': 'system', 'content': GENERATE_CRIME_STORY_SCENARIOS_PROMPT},
         {'role': 'user', 'content': 'سناریو ها رو تولید کن'},
     ]
-    content, input_tokens, output_tokens = await llm(messages)
+    content, input_tokens, output_tokens = await llm(messages, priority=LLMPriority.BACKGROUND)
     #TODO request_cost?
     request_cost = calculate_token_price(input_tokens, output_tokens)
 
     return [scenario for scenario in content.split('\n') if scenario and len(scenario) > 10]
 
-def story_parser(text: str) -> AIStoryResponse | None:
+def response_format(name: str, schema: dict) -> dict | None:
+    """Builds the ``response_format`` argument for the configured ``LLM_RESPONSE_FORMAT``.
+
+    Args:
+        name (str): Name of the schema.
+        schema (dict): JSON schema of the expected response.
+
+    Returns:
+        dict | None: The response format, or None to rely on the prompt alone.
+    """
+    if LLM_RESPONSE_FORMAT == 'json_object':
+        return {'type': 'json_object'}
+    if LLM_RESPONSE_FORMAT == 'json_schema':
+        # not strict: the options object has free-form keys
+        return {'type': 'json_schema', 'json_schema': {'name': name, 'schema': schema, 'strict': False}}
+    return None
+
+def _repair_json(text: str) -> str:
+    """Fixes the malformations LLMs commonly produce in a JSON object.
+
+    Quotes inside string values that are not followed by a delimiter are
+    escaped, trailing commas are dropped, anything after the closing brace is
+    ignored, and a truncated object is closed.
+
+    Args:
+        text (str): Text starting at the opening brace of the object.
+
+    Returns:
+        str: The repaired JSON text.
+    """
+    result = []
+    closers = []
+    in_string = False
+    index = 0
+    while index < len(text):
+        char = text[index]
+        rest = text[index + 1:].lstrip()
+        if in_string:
+            if char == '\\':
+                result.append(text[index:index + 2])
+                index += 2
+                continue
+            if char == '"':
+                after_comma = rest[1:].lstrip()[:1]
+                if not rest or rest[0] in ':}]' or (rest[0] == ',' and after_comma in ('"', '}', ']', '')):
+                    in_string = False
+                    result.append(char)
+                else:
+                    result.append('\\"')
+            else:
+                result.append(char)
+        elif char == '"':
+            in_string = True
+            result.append(char)
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+            result.append(char)
+        elif char in '}]':
+            if closers:
+                closers.pop()
+            result.append(char)
+            if not closers:
+                break
+        elif char == ',' and rest[:1] in ('}', ']'):
+            pass
+        else:
+            result.append(char)
+        index += 1
+
+    repaired = ''.join(result)
+    if in_string:
+        repaired += '"'
+    return repaired.rstrip().rstrip(',') + ''.join(reversed(closers))
+
+def loads_llm_json(text: str, record: bool = True) -> dict | None:
+    """Parses the JSON object in an LLM response, repairing it locally if needed.
+
+    Args:
+        text (str): The raw LLM response.
+        record (bool): Whether to count the result in ``json_repair_metrics``; False for stored responses.
+
+    Returns:
+        dict | None: The parsed object, or None if it could not be repaired.
+    """
+    text = re.sub(r'^\s*```(?:json)?|```\s*$', '', text).strip()
+    try:
+        data = json.loads(text, strict=False)
+        if record:
+            json_repair_metrics['parsed'] += 1
+        return data
+    except json.decoder.JSONDecodeError as e:
+        error = e
+
+    start = text.find('{')
+    try:
+        if start == -1:
+            raise error
+        data = json.loads(_repair_json(text[start:]), strict=False)
+    except json.decoder.JSONDecodeError as e:
+        if record:
+            json_repair_metrics['failed'] += 1
+            logger.error(f'Failed to repair LLM JSON: {e}')
+        return None
+
+    if not record:
+        return data
+    json_repair_metrics['repaired'] += 1
+    attempted = json_repair_metrics['repaired'] + json_repair_metrics['failed']
+    logger.info(f'Repaired LLM JSON ({error}), repair success rate {json_repair_metrics["repaired"] / attempted:.0%} of {attempted}')
+    return data
+
+def story_parser(text: str, record: bool = True) -> AIStoryResponse | None:
     """Parses a JSON-formatted story response into an AIStoryResponse object.
 
     Args:
         text (str): The raw JSON string containing the story.
+        record (bool): Whether to count the result in the JSON repair metrics, see ``loads_llm_json``.
 
     Returns:
         AIStoryResponse: Parsed story data.
     """
+    json_data = loads_llm_json(text, record)
+    if json_data is None:
+        return None
     try:
-        json_data = json.loads(text.removeprefix('```json').removesuffix('```'))
         options = [Option(id=int(key), text=value) for key, value in json_data['options'].items()]
         return AIStoryResponse(
             title=json_data['title'],
@@ -86,10 +251,121 @@ def story_parser(text: str) -> AIStoryResponse | None:
             is_end=json_data['is_end'],
             raw_data=text
         )
-    except (json.decoder.JSONDecodeError, ValueError) as e:
-        logging.error(str(e))
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        logging.error(f'Invalid story response: {e!r}')
+        return None
+
+def _partial_json_string(text: str, key: str) -> tuple[str | None, bool]:
+    """Extracts the (possibly unterminated) string value of ``key`` from partial JSON.
+
+    Returns:
+        tuple[str | None, bool]: The decoded value so far and whether the string is closed.
+    """
+    match = re.search(rf'"{key}"\s*:\s*"', text)
+    if not match:
+        return None, False
+
+    start = index = match.end()
+    complete = False
+    while index < len(text):
+        if text[index] == '\\':
+            index += 2
+            continue
+        if text[index] == '"':
+            complete = True
+            break
+        index += 1
+
+    raw = text[start:index]
+    if not complete:
+        # drop a dangling escape sequence cut in half by the stream
+        raw = re.sub(r'\\(u[0-9a-fA-F]{0,3})?$', '', raw)
+    try:
+        return json.loads(f'"{raw}"', strict=False), complete
+    except json.decoder.JSONDecodeError:
+        return raw, complete
+
+def _complete_json_object(text: str, key: str) -> dict | None:
+    """Returns the object value of ``key`` once its closing brace has arrived."""
+    match = re.search(rf'"{key}"\s*:\s*{{', text)
+    if not match:
         return None
 
+    depth = 0
+    in_string = False
+    index = match.end() - 1
+    while index < len(text):
+        char = text[index]
+        if in_string:
+            if char == '\\':
+                index += 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                try:
+                    return json.loads(text[match.end() - 1:index + 1], strict=False)
+                except json.decoder.JSONDecodeError:
+                    return None
+        index += 1
+    return None
+
+class StoryStreamParser:
+    """Incrementally extracts story fields from a streamed JSON story response.
+
+    Fields are re-scanned only until they are complete, so the work per chunk
+    stays small once the title and options have been seen.
+    """
+
+    def __init__(self):
+        self.content = ''
+        self.partial = PartialStoryResponse()
+        self._complete = set()
+
+    def update(self, content: str) -> PartialStoryResponse:
+        """Updates the parsed fields with the content received so far.
+
+        Args:
+            content (str): The accumulated response text. Content that does not
+                extend the previous text (a retried request) resets the parser.
+
+        Returns:
+            PartialStoryResponse: Fields parsed so far.
+        """
+        if not content.startswith(self.content):
+            self.partial = PartialStoryResponse()
+            self._complete = set()
+        self.content = content
+
+        for key in ('title', 'story'):
+            if key in self._complete:
+                continue
+            value, complete = _partial_json_string(content, key)
+            if value is not None:
+                setattr(self.partial, key, value)
+            if complete:
+                self._complete.add(key)
+
+        if self.partial.options is None:
+            options = _complete_json_object(content, 'options')
+            if options is not None:
+                try:
+                    self.partial.options = [Option(id=int(key), text=value) for key, value in options.items()]
+                except ValueError:
+                    pass
+
+        if self.partial.is_end is None:
+            match = re.search(r'"is_end"\s*:\s*(true|false)', content)
+            if match:
+                self.partial.is_end = match.group(1) == 'true'
+
+        return self.partial
+
 def ai_chat_parser(text: str) -> AIChatResponse | None:
     """Parses a JSON-formatted chat response into an AIChatResponse object.
 
@@ -99,14 +375,16 @@ def ai_chat_parser(text: str) -> AIChatResponse | None:
     Returns:
         AIChatResponse: Parsed chat response data.
     """
+    json_data = loads_llm_json(text)
+    if json_data is None:
+        return None
     try:
-        json_data = json.loads(text.removeprefix('```json').removesuffix('```'))
         return AIChatResponse(
             COMMAND=ChatCommand(json_data['COMMAND']),
             TEXT=json_data['TEXT']
         )
-    except json.decoder.JSONDecodeError as e:
-        logging.error(str(e))
+    except (KeyError, TypeError, ValueError) as e:
+        logging.error(f'Invalid chat response: {e!r}')
         return None
 
 def replace_english_numbers_with_farsi(text: str | int) -> str:
@@ -144,7 +422,7 @@ async def push_notification(text: str, reply_markup: InlineKeyboardMarkup | None
         text (str): The message text to send.
         reply_markup (Optional[InlineKeyboardMarkup]): Optional reply markup to attach to the message.
     """
-    users = User.select(User.user_id).where(User.active == True)
+    users = await run_db(list, User.select(User.user_id).where(User.active == True))
     bot = Bot(token=BOT_TOKEN, base_url=BASE_URL)
 
     for user in users:
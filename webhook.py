@@ -0,0 +1,169 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import queue
+import signal
+from typing import Callable
+
+from aiohttp import web
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from config import (
+    BOT_TOKEN,
+    BASE_URL,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_DRAIN_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+ApplicationFactory = Callable[..., Application]
+
+
+class HashRing:
+    '''
+    Consistent hash ring assigning user ids to workers.
+    
+    Every worker owns ``replicas`` points on the ring, so changing the number
+    of workers only moves the users of the added or removed worker.
+    '''
+    
+    def __init__(self, nodes: int, replicas: int = 100):
+        self.ring = sorted(
+            (self._hash(f'{node}:{replica}'), node)
+            for node in range(nodes)
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in self.ring]
+    
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+    
+    def node(self, key: int) -> int:
+        index = bisect.bisect(self.hashes, self._hash(str(key))) % len(self.ring)
+        return self.ring[index][1]
+
+
+def update_user_id(data: dict) -> int:
+    '''The id of the user an update comes from, falling back to its chat and then the update id.'''
+    for value in data.values():
+        if isinstance(value, dict):
+            if 'from' in value:
+                return value['from']['id']
+            if 'chat' in value:
+                return value['chat']['id']
+    return data.get('update_id', 0)
+
+
+def run_worker(index: int, updates: multiprocessing.Queue, build_application: ApplicationFactory) -> None:
+    '''Entry point of a worker process: processes the updates of its share of users in order.'''
+    # the server process handles signals and tells the workers when to drain
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker(index, updates, build_application))
+
+
+async def _worker(index: int, updates: multiprocessing.Queue, build_application: ApplicationFactory) -> None:
+    # background jobs run once, in the first worker
+    application = build_application(run_jobs=index == 0, with_updater=False)
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.start()
+        logger.info(f'Webhook worker {index} started')
+        while (data := await loop.run_in_executor(None, updates.get)) is not None:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        logger.info(f'Webhook worker {index} draining {application.update_queue.qsize()} updates')
+        # stop() returns once every queued update has been handled
+        await application.stop()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    logger.info(f'Webhook worker {index} stopped')
+
+
+async def _serve(queues: list[multiprocessing.Queue], workers: list[multiprocessing.Process]) -> None:
+    ring = HashRing(len(queues))
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        index = ring.node(update_user_id(data))
+        if not workers[index].is_alive():
+            logger.error(f'Webhook worker {index} is not running')
+            return web.Response(status=503)
+        try:
+            queues[index].put_nowait(data)
+        except queue.Full:
+            # the update is delivered again later
+            logger.warning(f'Webhook worker {index} queue is full')
+            return web.Response(status=503)
+        return web.Response()
+
+    server = web.Application()
+    server.router.add_post(WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    logger.info(f'Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} with {len(workers)} workers')
+
+    if WEBHOOK_URL:
+        async with Bot(BOT_TOKEN, base_url=BASE_URL) as bot:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES
+            )
+        logger.info(f'Webhook registered at {WEBHOOK_URL}')
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+
+    # stop accepting updates, then let every worker finish the ones it has;
+    # the webhook stays registered so the platform keeps the backlog for us
+    logger.info('Shutting down webhook server...')
+    await runner.cleanup()
+    for updates in queues:
+        updates.put(None)
+    for index, worker in enumerate(workers):
+        await loop.run_in_executor(None, worker.join, WEBHOOK_DRAIN_TIMEOUT)
+        if worker.is_alive():
+            logger.error(f'Webhook worker {index} did not drain in {WEBHOOK_DRAIN_TIMEOUT}s, terminating')
+            worker.terminate()
+
+
+def serve(build_application: ApplicationFactory, workers: int = WEBHOOK_WORKERS) -> None:
+    '''
+    Run the webhook server and its worker processes until SIGINT or SIGTERM.
+
+    Args:
+        build_application (ApplicationFactory): Builds a worker's application, called
+            with ``run_jobs`` and ``with_updater`` keyword arguments
+        workers (int): Number of worker processes
+    '''
+    # fresh interpreters, so no database connection or thread is shared with the server
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+    processes = [
+        context.Process(target=run_worker, args=(index, queues[index], build_application), name=f'webhook-worker-{index}')
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    asyncio.run(_serve(queues, processes))